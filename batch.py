@@ -0,0 +1,156 @@
+import contextlib
+import json
+import sys
+from models import Book, User
+from storage import Storage, StorageError
+
+
+def _add_book(managers, op):
+    return managers['book'].add_book(Book(title=op['title'], author=op['author'], isbn=op['isbn'],
+                                          copies=op.get('copies', 1)))
+
+
+def _update_book(managers, op):
+    return managers['book'].update_book(op['isbn'], title=op.get('title'), author=op.get('author'),
+                                        new_isbn=op.get('new_isbn'), copies=op.get('copies'))
+
+
+def _delete_book(managers, op):
+    return managers['book'].remove_book(op['isbn'])
+
+
+def _add_user(managers, op):
+    return managers['user'].add_user(User(name=op['name'], user_id=op['user_id']))
+
+
+def _update_user(managers, op):
+    return managers['user'].update_user(op['user_id'], name=op.get('name'), new_user_id=op.get('new_user_id'))
+
+
+def _delete_user(managers, op):
+    return managers['user'].remove_user(op['user_id'])
+
+
+def _checkout(managers, op):
+    return managers['check'].check_out_book(user_id=op['user_id'], isbn=op['isbn'])
+
+
+def _return(managers, op):
+    return managers['check'].return_book(user_id=op['user_id'], isbn=op['isbn'])
+
+
+def _place_hold(managers, op):
+    return managers['check'].place_hold(user_id=op['user_id'], isbn=op['isbn'])
+
+
+def _cancel_hold(managers, op):
+    return managers['check'].cancel_hold(user_id=op['user_id'], isbn=op['isbn'])
+
+
+OPERATIONS = {
+    'add_book': _add_book,
+    'update_book': _update_book,
+    'delete_book': _delete_book,
+    'add_user': _add_user,
+    'update_user': _update_user,
+    'delete_user': _delete_user,
+    'checkout': _checkout,
+    'return': _return,
+    'place_hold': _place_hold,
+    'cancel_hold': _cancel_hold,
+}
+
+
+def read_operations(path):
+    """
+    Stream operations from a JSON Lines command file.
+
+    Each line is an object with an "op" field naming one of OPERATIONS and
+    the fields that operation needs, e.g.
+    {"op": "checkout", "user_id": "U1001", "isbn": "978-0451524935"}.
+    Blank lines and lines starting with '#' are ignored.
+
+    Parameters:
+        path (str): The path of the command file, or '-' for standard input.
+
+    Yields:
+        tuple: (line number, operation dict, or the error if the line is not valid JSON).
+    """
+
+    with (contextlib.nullcontext(sys.stdin) if path == '-' else open(path, 'r')) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, e
+
+
+def run_batch(operations, book_manager, user_manager, check_manager, flush_every=None):
+    """
+    Run operations against one set of managers, persisting at the end of the
+    batch (or every flush_every operations) instead of after each one.
+
+    Parameters:
+        operations (iterable): (line number, operation) pairs, as from read_operations.
+        book_manager (BookManager): The book manager.
+        user_manager (UserManager): The user manager.
+        check_manager (CheckManager): The check manager.
+        flush_every (int): Persist after this many operations (optional).
+
+    Yields:
+        dict: One result per operation, with "line", "op", "ok" and, on
+        failure, "error".
+    """
+
+    managers = {'book': book_manager, 'user': user_manager, 'check': check_manager}
+    with Storage.deferred():
+        for count, (line_number, op) in enumerate(operations, 1):
+            result = {'line': line_number, 'op': None, 'ok': False}
+            if isinstance(op, Exception):
+                result['error'] = f"invalid JSON: {op}"
+            elif not isinstance(op, dict) or op.get('op') not in OPERATIONS:
+                result['op'] = op.get('op') if isinstance(op, dict) else None
+                result['error'] = "unknown operation"
+            else:
+                result['op'] = op['op']
+                try:
+                    result['ok'] = bool(OPERATIONS[op['op']](managers, op))
+                except KeyError as e:
+                    result['error'] = f"missing field {e}"
+            yield result
+
+            if flush_every and count % flush_every == 0:
+                Storage.flush()
+
+
+def main(book_manager, user_manager, check_manager, path, output=None, flush_every=None):
+    """
+    Run a command file and write one JSON result line per operation.
+
+    The managers' events go wherever events.configure() sent them (standard
+    error when run from main.py), so that the results stream stays
+    machine-readable.
+
+    Parameters:
+        path (str): The command file, or '-' for standard input.
+        output (str): The file to write results to (default: standard output).
+        flush_every (int): Persist after this many operations (optional).
+
+    Returns:
+        bool: True if every operation succeeded and was persisted, False otherwise.
+    """
+
+    all_ok = True
+    with (open(output, 'w') if output else contextlib.nullcontext(sys.stdout)) as out:
+        try:
+            for result in run_batch(read_operations(path), book_manager, user_manager, check_manager,
+                                    flush_every=flush_every):
+                all_ok = all_ok and result['ok']
+                out.write(json.dumps(result) + '\n')
+        except StorageError as e:
+            out.write(json.dumps({'op': 'flush', 'ok': False, 'error': str(e)}) + '\n')
+            return False
+    return all_ok
@@ -0,0 +1,470 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from book import BookManager
+from check import CheckManager
+from models import Book, BookTable, User
+from sqlite_storage import SQLiteStore
+from storage import Storage
+from user import UserManager
+
+
+class PlainBook:
+    """
+    A Book as it was stored before __slots__, kept only as a baseline.
+    """
+
+    def __init__(self, title, author, isbn, is_checked_out=False):
+        self.title = title
+        self.author = author
+        self.isbn = isbn.strip()
+        self._is_checked_out = is_checked_out
+
+
+class PlainUser:
+    """
+    A User as it was stored before __slots__, kept only as a baseline.
+    """
+
+    def __init__(self, name, user_id, borrowed_books=None):
+        self.name = name
+        self.user_id = user_id
+        self.borrowed_books = borrowed_books if borrowed_books is not None else []
+
+
+def synthetic_books(count, seed=0):
+    """
+    Generate book dictionaries with realistic title, author and ISBN shapes.
+
+    Parameters:
+        count (int): The number of books.
+        seed (int): The random seed, so runs are reproducible.
+
+    Yields:
+        dict: One book dictionary per book.
+    """
+
+    rng = random.Random(seed)
+    authors = [f"Author {i}" for i in range(max(1, count // 20))]
+    for i in range(count):
+        yield {
+            'title': f"Title {i} {rng.randrange(10 ** 6)}",
+            'author': rng.choice(authors),
+            'isbn': f"978{i:010d}",
+            'is_checked_out': rng.random() < 0.1,
+        }
+
+
+def synthetic_users(count, seed=0):
+    """
+    Generate user dictionaries.
+
+    Parameters:
+        count (int): The number of users.
+        seed (int): The random seed, so runs are reproducible.
+
+    Yields:
+        dict: One user dictionary per user.
+    """
+
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            'name': f"Patron {i} {rng.randrange(10 ** 6)}",
+            'user_id': f"U{i:08d}",
+            'borrowed_books': [],
+        }
+
+
+def measure_memory(build, peak=False):
+    """
+    Measure the memory retained by the object graph that build() returns.
+
+    Parameters:
+        build (callable): Builds the objects to measure.
+        peak (bool): Report the peak allocated while building instead.
+
+    Returns:
+        int: The number of bytes still allocated once build() has returned,
+        or the peak number of bytes allocated during build().
+    """
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        retained = build()
+        current, highest = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del retained
+    return highest if peak else current
+
+
+def memory_benchmark(count):
+    """
+    Compare the per-record memory of the book and user representations.
+
+    Parameters:
+        count (int): The number of records in each collection.
+
+    Returns:
+        dict: Bytes per record for each representation.
+    """
+
+    # Materialize the inputs first so they are not counted
+    book_dicts = list(synthetic_books(count))
+    user_dicts = list(synthetic_users(count))
+
+    def copy(text):
+        # A fresh string, so each representation pays for its own strings
+        return ''.join(list(text))
+
+    def books_with(cls):
+        return lambda: {d['isbn']: cls(copy(d['title']), copy(d['author']), copy(d['isbn']), d['is_checked_out'])
+                        for d in book_dicts}
+
+    def users_with(cls):
+        return lambda: {d['user_id']: cls(copy(d['name']), copy(d['user_id']), [])
+                        for d in user_dicts}
+
+    def book_table():
+        return BookTable.from_dicts({'title': copy(d['title']), 'author': copy(d['author']),
+                                     'isbn': copy(d['isbn']), 'is_checked_out': d['is_checked_out']}
+                                    for d in book_dicts)
+
+    results = {
+        'books.plain': measure_memory(books_with(PlainBook)),
+        'books.slots': measure_memory(books_with(Book)),
+        'books.table': measure_memory(book_table),
+        'users.plain': measure_memory(users_with(PlainUser)),
+        'users.slots': measure_memory(users_with(User)),
+    }
+    return {name: round(total / count, 1) for name, total in results.items()}
+
+
+def format_benchmark(count, repeat=3):
+    """
+    Compare the on-disk formats on file size, save time and load time.
+
+    Parameters:
+        count (int): The number of books (and of users) written.
+        repeat (int): Saves and loads timed per format; the best is kept.
+
+    Returns:
+        dict: Maps each format to its total 'bytes' and best 'save_s' and
+        'load_s' for both files.
+    """
+
+    book_dicts = list(synthetic_books(count))
+    user_dicts = list(synthetic_users(count))
+    formats = {'json': '.json', 'records': '.rec', 'records.zlib': '.rec.zlib', 'records.lzma': '.rec.xz'}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull, \
+            configured_storage(workdir), contextlib.redirect_stdout(devnull):
+        for name, suffix in formats.items():
+            paths = [(book_dicts, os.path.join(workdir, 'books' + suffix)),
+                     (user_dicts, os.path.join(workdir, 'users' + suffix))]
+            save_s = min(time_each(lambda _: [Storage.save_data(data, path) for data, path in paths],
+                                   range(repeat)))
+            load_s = min(time_each(lambda _: [Storage.load_data(path) for _, path in paths], range(repeat)))
+            results[name] = {
+                'bytes': sum(os.path.getsize(path) for _, path in paths),
+                'save_s': round(save_s, 6),
+                'load_s': round(load_s, 6),
+            }
+    return results
+
+
+def summarize(latencies):
+    """
+    Summarize a list of per-operation latencies.
+
+    Parameters:
+        latencies (list): Seconds taken by each operation.
+
+    Returns:
+        dict: Count, throughput and latency percentiles in milliseconds.
+    """
+
+    ordered = sorted(latencies)
+    total = sum(ordered)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 4)
+
+    return {
+        'count': len(ordered),
+        'total_s': round(total, 6),
+        'ops_per_s': round(len(ordered) / total, 1) if total else None,
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 4),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': round(ordered[-1] * 1000, 4),
+    }
+
+
+def time_each(operation, arguments):
+    """
+    Call operation(argument) for every argument and time each call.
+
+    Returns:
+        list: Seconds taken by each call.
+    """
+
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        operation(argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+@contextlib.contextmanager
+def configured_storage(workdir, backend='json', mode='full', lazy=False, book_store='dict',
+                       durability='immediate'):
+    """
+    Point Storage at files in workdir with the given settings, restoring
+    the previous settings afterwards.
+    """
+
+    settings = {
+        'BOOKS_FILE': os.path.join(workdir, 'books.json'),
+        'USERS_FILE': os.path.join(workdir, 'users.json'),
+        'JOURNAL_FILE': os.path.join(workdir, 'library.journal'),
+        'DATABASE_FILE': os.path.join(workdir, 'library.db'),
+        'LOCK_FILE': os.path.join(workdir, 'library.lock'),
+        'HOLDS_FILE': os.path.join(workdir, 'holds.json'),
+        'HISTORY_DIR': os.path.join(workdir, 'history'),
+        'BACKEND': backend,
+        'STORAGE_MODE': mode,
+        'LAZY_LOAD': lazy,
+        'BOOK_STORE': book_store,
+        '_journal_length': None,
+        '_sqlite_stores': {},
+        'DURABILITY': durability,
+        '_dirty': {},
+        '_dirty_count': 0,
+        '_dirty_since': None,
+    }
+    previous = {name: getattr(Storage, name) for name in settings}
+    for name, value in settings.items():
+        setattr(Storage, name, value)
+    try:
+        yield
+    finally:
+        for store in Storage._sqlite_stores.values():
+            store.close()
+        for name, value in previous.items():
+            setattr(Storage, name, value)
+
+
+def write_dataset(workdir, size, backend):
+    """
+    Write a synthetic catalog of size books and size users to workdir.
+    """
+
+    Storage.save_data(list(synthetic_books(size)), Storage.BOOKS_FILE)
+    Storage.save_data(list(synthetic_users(size)), Storage.USERS_FILE)
+    if backend == 'sqlite':
+        store = SQLiteStore(Storage.DATABASE_FILE)
+        try:
+            store.import_json(Storage.BOOKS_FILE, Storage.USERS_FILE)
+        finally:
+            store.close()
+
+
+def run_suite(size, ops, backend='json', mode='full', lazy=False, book_store='dict', seed=0,
+              durability='immediate'):
+    """
+    Benchmark loading, lookups, mutations, checkouts, listing and saving on
+    a synthetic catalog.
+
+    Parameters:
+        size (int): The number of books and of users.
+        ops (int): The number of operations timed for each kind of operation.
+        backend (str): The storage backend, 'json' or 'sqlite'.
+        mode (str): The storage mode, 'full' or 'journal'.
+        lazy (bool): Whether to load the JSON files lazily.
+        book_store (str): 'dict' or 'table'.
+        seed (int): The random seed.
+        durability (str): 'immediate', 'coalesced' or 'on-exit'.
+
+    Returns:
+        dict: The settings, the load time, peak memory and a summary per operation.
+    """
+
+    rng = random.Random(seed)
+    ops = min(ops, size)
+    result = {'size': size, 'ops': ops, 'backend': backend, 'mode': mode, 'lazy': lazy,
+              'book_store': book_store, 'durability': durability, 'operations': {}}
+
+    # The managers print as they go; keep that out of the timings' way
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull, \
+            configured_storage(workdir, backend, mode, lazy, book_store, durability), \
+            contextlib.redirect_stdout(devnull):
+        write_dataset(workdir, size, backend)
+        result['file_bytes'] = os.path.getsize(Storage.BOOKS_FILE) + os.path.getsize(Storage.USERS_FILE)
+
+        start = time.perf_counter()
+        book_manager = BookManager()
+        user_manager = UserManager()
+        result['load_s'] = round(time.perf_counter() - start, 6)
+        result['load_peak_bytes'] = measure_memory(lambda: (BookManager(), UserManager()), peak=True)
+        check_manager = CheckManager(book_manager, user_manager)
+
+        isbns = [f"978{i:010d}" for i in range(size)]
+        user_ids = [f"U{i:08d}" for i in range(size)]
+        operations = result['operations']
+
+        operations['lookup'] = summarize(time_each(
+            book_manager.find_book_by_isbn, rng.sample(isbns, ops)))
+        operations['add'] = summarize(time_each(
+            book_manager.add_book, [Book(f"New {i}", "Bench Author", f"bench-{i}") for i in range(ops)]))
+        operations['update'] = summarize(time_each(
+            lambda isbn: book_manager.update_book(isbn, title="Updated"), rng.sample(isbns, ops)))
+        operations['remove'] = summarize(time_each(
+            book_manager.remove_book, [f"bench-{i}" for i in range(ops)]))
+
+        available = [isbn for isbn in rng.sample(isbns, min(size, ops * 2))
+                     if not book_manager.find_book_by_isbn(isbn)._is_checked_out][:ops]
+        loans = list(zip(rng.sample(user_ids, len(available)), available))
+        operations['checkout'] = summarize(time_each(lambda loan: check_manager.check_out_book(*loan), loans))
+        operations['return'] = summarize(time_each(lambda loan: check_manager.return_book(*loan), loans))
+
+        operations['list'] = summarize(time_each(lambda _: book_manager.list_books(), range(3)))
+        operations['save'] = summarize(time_each(
+            lambda _: Storage.save_books(book_manager._books.values()), range(3)))
+        # Whatever the durability level held back is written here
+        operations['flush'] = summarize(time_each(lambda _: Storage.flush(), range(1)))
+
+    result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """
+    Print how each operation's p50 latency and throughput changed between two result files.
+
+    Parameters:
+        baseline (dict): Results loaded from the older run.
+        current (dict): Results loaded from the newer run.
+    """
+
+    def key(run):
+        return (run['size'], run['backend'], run['mode'], run['lazy'], run['book_store'],
+                run.get('durability', 'immediate'))
+
+    older = {key(run): run for run in baseline['results']}
+    for run in current['results']:
+        before = older.get(key(run))
+        if not before:
+            continue
+        print(f"size={run['size']} backend={run['backend']} mode={run['mode']} "
+              f"lazy={run['lazy']} book_store={run['book_store']} durability={run.get('durability', 'immediate')}")
+        print(f"  {'load':10} {before['load_s']:10.4f}s -> {run['load_s']:10.4f}s")
+        for name, summary in run['operations'].items():
+            old = before['operations'].get(name)
+            if old:
+                change = summary['p50_ms'] / old['p50_ms'] if old['p50_ms'] else float('inf')
+                print(f"  {name:10} p50 {old['p50_ms']:10.4f}ms -> {summary['p50_ms']:10.4f}ms ({change:.2f}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the library managers and storage.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Time manager, checkout and storage operations on synthetic data.")
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help="Catalog sizes to benchmark (default: 1000 10000 100000).")
+    run_parser.add_argument('--ops', type=int, default=200, help="Operations timed per kind (default: 200).")
+    run_parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    run_parser.add_argument('--mode', choices=['full', 'journal'], default='full')
+    run_parser.add_argument('--lazy', action='store_true', help="Load the JSON files lazily.")
+    run_parser.add_argument('--book-store', choices=['dict', 'table'], default='dict')
+    run_parser.add_argument('--durability', choices=['immediate', 'coalesced', 'on-exit'], default='immediate')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help="Write the results to this JSON file.")
+
+    compare_parser = subparsers.add_parser('compare', help="Compare two result files from 'run'.")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+
+    memory_parser = subparsers.add_parser('memory', help="Compare per-record memory of the model representations.")
+    memory_parser.add_argument('--records', type=int, default=100000, help="Records per collection (default: 100000).")
+    memory_parser.add_argument('--output', help="Write the results to this JSON file.")
+
+    formats_parser = subparsers.add_parser('formats', help="Compare JSON with the binary record formats.")
+    formats_parser.add_argument('--records', type=int, default=100000, help="Records per collection (default: 100000).")
+    formats_parser.add_argument('--output', help="Write the results to this JSON file.")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        compare(baseline, current)
+        return
+
+    if args.command == 'run':
+        runs = []
+        for size in args.sizes:
+            run = run_suite(size, args.ops, backend=args.backend, mode=args.mode, lazy=args.lazy,
+                            book_store=args.book_store, seed=args.seed, durability=args.durability)
+            runs.append(run)
+            print(f"size={size} load={run['load_s']:.4f}s peak={run['load_peak_bytes'] / 2 ** 20:.1f}MiB")
+            for name, summary in run['operations'].items():
+                print(f"  {name:10} {summary['ops_per_s'] or 0:12.1f} ops/s  "
+                      f"p50={summary['p50_ms']:.4f}ms p99={summary['p99_ms']:.4f}ms")
+        results = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': runs,
+        }
+
+    if args.command == 'memory':
+        results = memory_benchmark(args.records)
+        baseline = results['books.plain']
+        for name, per_record in results.items():
+            print(f"{name:12} {per_record:8.1f} bytes/record")
+        print(f"BookTable saves {baseline - results['books.table']:.1f} bytes/record "
+              f"({1 - results['books.table'] / baseline:.0%}) over plain Book objects.")
+
+    if args.command == 'formats':
+        results = format_benchmark(args.records)
+        baseline = results['json']
+        for name, result in results.items():
+            print(f"{name:14} {result['bytes'] / 2 ** 20:8.2f}MiB ({result['bytes'] / baseline['bytes']:5.0%})  "
+                  f"save={result['save_s']:.4f}s load={result['load_s']:.4f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            if args.command in ('memory', 'formats'):
+                results = {'command': args.command, 'records': args.records, 'results': results}
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
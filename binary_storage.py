@@ -0,0 +1,221 @@
+import argparse
+import json
+import lzma
+import struct
+import zlib
+
+
+# File header: magic, format version, codec
+MAGIC = b'LBRC'
+VERSION = 1
+HEADER = struct.Struct('>4sBB')
+
+# Block header: length of the block's records before and after compression
+BLOCK = struct.Struct('>II')
+
+# Record header: length of the record's JSON body
+RECORD = struct.Struct('>I')
+
+# Uncompressed bytes collected before a block is written
+BLOCK_SIZE = 256 * 1024
+
+CODECS = {
+    'none': (0, lambda data: data, lambda data: data),
+    'zlib': (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+}
+
+# File name endings that select the record format, and the codec for each
+SUFFIXES = {'.rec': 'none', '.rec.zlib': 'zlib', '.rec.xz': 'lzma'}
+
+
+class FormatError(ValueError):
+    """
+    Raised when a record file is truncated or corrupt.
+    """
+
+
+def codec_for(filename):
+    """
+    Return the codec selected by a file name, or None for a JSON file.
+
+    Parameters:
+        filename (str): e.g. 'books.json', 'books.rec' or 'books.rec.xz'.
+
+    Returns:
+        str: 'none', 'zlib' or 'lzma', or None if the file is JSON.
+    """
+
+    for suffix, codec in SUFFIXES.items():
+        if filename.endswith(suffix):
+            return codec
+    return None
+
+
+def is_record_file(f):
+    """
+    Check whether an open binary file starts with the record file header,
+    leaving its position unchanged.
+    """
+
+    position = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(position)
+    return magic == MAGIC
+
+
+def write_records(f, records, codec='zlib'):
+    """
+    Write dictionaries to a binary file as length-prefixed records.
+
+    Each record is a compact JSON body behind a 4-byte length. Records are
+    grouped into blocks of about BLOCK_SIZE bytes, and each block is
+    compressed on its own, so a reader only ever holds one block.
+
+    Parameters:
+        f: A file opened for binary writing.
+        records (iterable): The dictionaries to write.
+        codec (str): 'none', 'zlib' or 'lzma'.
+
+    Returns:
+        int: The number of records written.
+    """
+
+    codec_id, compress, _ = CODECS[codec]
+    f.write(HEADER.pack(MAGIC, VERSION, codec_id))
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+
+    block = bytearray()
+    count = 0
+    for record in records:
+        body = encode(record).encode()
+        block += RECORD.pack(len(body))
+        block += body
+        count += 1
+        if len(block) >= BLOCK_SIZE:
+            _write_block(f, block, compress)
+            block = bytearray()
+    if block:
+        _write_block(f, block, compress)
+    return count
+
+
+def _write_block(f, block, compress):
+    stored = compress(bytes(block))
+    f.write(BLOCK.pack(len(block), len(stored)))
+    f.write(stored)
+
+
+def read_records(f):
+    """
+    Stream dictionaries from a binary file written by write_records.
+
+    Parameters:
+        f: A file opened for binary reading.
+
+    Only one block is held in memory at a time; its records are decoded
+    together and then yielded one by one.
+
+    Yields:
+        dict: One record at a time.
+
+    Raises:
+        FormatError: If the file is not a record file, or is truncated or corrupt.
+    """
+
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise FormatError("File is too short to be a record file.")
+    magic, version, codec_id = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise FormatError("Not a record file, or an unsupported version.")
+    decompress = next((codec[2] for codec in CODECS.values() if codec[0] == codec_id), None)
+    if decompress is None:
+        raise FormatError(f"Unknown codec {codec_id}.")
+
+    while True:
+        block_header = f.read(BLOCK.size)
+        if not block_header:
+            return
+        if len(block_header) < BLOCK.size:
+            raise FormatError("Truncated block header.")
+        raw_length, stored_length = BLOCK.unpack(block_header)
+        stored = f.read(stored_length)
+        if len(stored) < stored_length:
+            raise FormatError("Truncated block.")
+        try:
+            block = decompress(stored)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise FormatError(f"Corrupt block: {e}") from e
+        if len(block) != raw_length:
+            raise FormatError("Corrupt block: wrong length.")
+
+        bodies = []
+        offset = 0
+        while offset < raw_length:
+            (length,) = RECORD.unpack_from(block, offset)
+            offset += RECORD.size
+            if offset + length > raw_length:
+                raise FormatError("Record runs past the end of its block.")
+            bodies.append(block[offset:offset + length])
+            offset += length
+        # One decode call per block is much faster than one per record
+        yield from json.loads(b'[' + b','.join(bodies) + b']')
+
+
+def load(path):
+    """
+    Load a list of dictionaries from a JSON file or a record file.
+    """
+
+    with open(path, 'rb') as f:
+        if is_record_file(f):
+            return list(read_records(f))
+        return json.load(f)
+
+
+def save(path, records, codec=None):
+    """
+    Save dictionaries to path, as records if codec (or the file name) selects
+    one, or as indented JSON otherwise.
+
+    Returns:
+        int: The number of records written.
+    """
+
+    codec = codec or codec_for(path)
+    if codec is None:
+        records = list(records)
+        with open(path, 'w') as f:
+            json.dump(records, f, indent=4)
+        return len(records)
+    with open(path, 'wb') as f:
+        return write_records(f, records, codec)
+
+
+def main(argv=None):
+    """
+    Convert between the JSON files and the binary record format, either way.
+
+    The input format is detected from its contents; the output format comes
+    from --codec, or else from the output file name.
+
+    Examples:
+        python binary_storage.py books.json books.rec.zlib
+        python binary_storage.py books.rec.zlib books.json
+        python binary_storage.py users.json users.dat --codec lzma
+    """
+
+    parser = argparse.ArgumentParser(description="Convert library data files between JSON and binary records.")
+    parser.add_argument('source', help="The file to read, JSON or records.")
+    parser.add_argument('target', help="The file to write: records if it ends in "
+                                       f"{', '.join(SUFFIXES)}, JSON otherwise.")
+    parser.add_argument('--codec', choices=list(CODECS), help="Write records with this codec, whatever the name.")
+    args = parser.parse_args(argv)
+
+    count = save(args.target, load(args.source), codec=args.codec)
+    print(f"Converted {count} records from {args.source} to {args.target}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,60 @@
+import itertools
+import metrics
+from events import EventLogger
+from identifiers import is_valid_isbn, looks_like_isbn
+from lazy_storage import LazyCatalog
+from search import SearchIndex, SortedIndex
 from storage import Storage
 
+
+# The orders iter_books can list books in; ties are broken by ISBN
+SORT_KEYS = {
+    'title': lambda book: (book.title.casefold(), book.author.casefold()),
+    'author': lambda book: (book.author.casefold(), book.title.casefold()),
+    'isbn': lambda book: book.isbn,
+}
+
+log = EventLogger('book')
+
 class BookManager:
     """
     Manage books in the library.
 
     Attributes:
         books (list): A list of books in the library.
+        _books (dict): Primary index mapping ISBN to Book, in insertion order
+            (an SQLiteTable when the SQLite backend is selected).
+        _search_index (SearchIndex): Inverted index over titles and authors,
+            built on the first search and kept up to date afterwards.
+        _sorted (dict): Maps a SORT_KEYS order to its SortedIndex, built on
+            the first listing in that order and kept up to date afterwards.
+        stats (CirculationStats): Statistics kept up to date by every change,
+            once CheckManager has built them; None until then.
+        _identifiers (IdentifierIndex): Maps each normalized ISBN to the ISBN
+            a book is stored under (see Storage.open_isbn_index), opened
+            with the catalog, or for a lazy catalog on the first lookup
+            that misses.
+
+    ISBNs are stored as entered, but compared in their normalized form
+    (see identifiers.normalize_isbn): "978-0062315007", "9780062315007" and
+    the ISBN-10 "0062315005" all find the same book, and adding a book
+    under another form of an ISBN in the catalog is rejected instead of
+    creating a duplicate. Books already stored under two forms of one ISBN
+    are flagged with a 'book.duplicate_isbn' warning when the catalog is
+    opened (a lazy one on first use); lookups find the first of them.
 
     Methods:
         add_book: Add a new book to the library.
-        find_book_by_isbn: Find a book by its ISBN.
+        add_books: Add many books, persisting once per batch.
+        find_book_by_isbn: Find a book by its ISBN, in any of its forms.
+        resolve_isbn: Return the ISBN a book is stored under.
+        suggest_isbns: Suggest the ISBNs one typo away from one that was not found.
         remove_book: Remove a book from the library.
         update_book: Update the details of an existing book.
-        list_books: List all books in the
+        list_books: List all books in the library.
+        iter_books: Yield books one at a time, filtered, sorted and paged.
+        search_books: Search books by title and author.
+        commit: Persist changed books.
     
     Examples:
         book_manager = BookManager()
@@ -22,26 +64,101 @@ class BookManager:
         book_manager.remove_book("978-0061122415")
     """
     def __init__(self):
-        # Load books from storage during initialization
-        self.books = Storage.load_books()
+        # Open the books in storage, indexed by ISBN
+        self._books = Storage.open_books()
+        self._search_index = None
+        self._sorted = {}
+        self.stats = None
+        self._identifiers = None
+        # Opening a lazy catalog reads nothing, so it is checked on first use
+        if not isinstance(self._books, LazyCatalog):
+            self._identifier_index()
 
+    @property
+    def books(self):
+        """
+        The books in the library, in insertion order.
+        """
 
+        return list(self._books.values())
+
+
+    @metrics.timed
     def add_book(self, book):
         """
-        Add a new book to the library.
+        Add a new book to the library, warning if its ISBN fails its checksum.
 
         Parameters
             book: The book to be added.
+
+        Returns:
+            bool: True if the book is added, False if a book with the same
+            ISBN, in any form, already exists.
+        """
+
+        # Another form of an ISBN in the catalog names the same book
+        isbn = self.resolve_isbn(book.isbn)
+        if isbn in self._books:
+            log.warning('book.exists', "Book with ISBN {isbn} already exists.", isbn=book.isbn)
+            return False
+        self._check_isbn(isbn)
+        book.isbn = isbn
+        self._books[book.isbn] = book
+        self._index(book)
+        self.commit({book.isbn: book})
+        log.info('book.added', "Book '{title}' added successfully.", title=book.title, isbn=book.isbn)
+        return True
+
+
+    @metrics.timed
+    def add_books(self, books, batch_size=1000, progress=None):
+        """
+        Add many books, persisting once per batch instead of once per book.
+
+        Books whose ISBN, in any form, is already in the library or appeared
+        earlier in the input are skipped, and ISBNs that fail their checksum
+        are reported as by add_book.
+
+        Parameters:
+            books (iterable): The books to add; may be a generator.
+            batch_size (int): The number of new books persisted together.
+            progress (callable): Called as progress(added, skipped) after
+                each batch is persisted (optional).
+
+        Returns:
+            tuple: The number of books added and skipped.
         """
 
-        self.books.append(book)
-        Storage.save_books(self.books)
-        print(f"Book '{book.title}' added successfully.")
+        added = skipped = 0
+        changes = {}
+        identifiers = self._identifier_index()
+        for book in books:
+            if identifiers.resolve(book.isbn) is not None:
+                skipped += 1
+                continue
+            self._check_isbn(book.isbn)
+            self._books[book.isbn] = book
+            self._index(book)
+            changes[book.isbn] = book
+            added += 1
+            if len(changes) >= batch_size:
+                self.commit(changes)
+                changes = {}
+                if progress:
+                    progress(added, skipped)
 
+        if changes:
+            self.commit(changes)
+        if progress:
+            progress(added, skipped)
+        return added, skipped
 
+
+    @metrics.timed
     def find_book_by_isbn(self, isbn):
         """
-        Find a book by its ISBN.
+        Find a book by its ISBN, with or without hyphens, as an ISBN-10 or
+        as an ISBN-13.
 
         Parameters:
             isbn (str): The ISBN of the book to find.
@@ -50,13 +167,15 @@ class BookManager:
             Object: The book is returned if found, None otherwise.
         """
 
-        normalized_isbn = isbn.strip()
-        for b in self.books:
-            if b.isbn == normalized_isbn:
-                print("Book Found")
-                return b
-        return None
+        book = self._books.get(isbn.strip())
+        if book is None:
+            key = self._identifier_index().resolve(isbn)
+            book = self._books.get(key) if key is not None else None
+        if book:
+            log.debug('book.found', "Book found: {book}", book=book, isbn=book.isbn)
+        return book
 
+    @metrics.timed
     def remove_book(self, isbn):
         """
         Remove a book from the library.
@@ -69,18 +188,18 @@ class BookManager:
         """
         
         book = self.find_book_by_isbn(isbn)
-        print(book)
         if book:
-            print("Inside remove book")
-            self.books.remove(book)
-            Storage.save_books(self.books)
-            print(f"Book '{book.title}' removed successfully.")
+            del self._books[book.isbn]
+            self._unindex(book.isbn)
+            self.commit({book.isbn: None})
+            log.info('book.removed', "Book '{title}' removed successfully.", title=book.title, isbn=book.isbn)
             return True
-        print(f"Book with ISBN {isbn} not found.")
+        log.warning('book.not_found', "Book with ISBN {isbn} not found.", isbn=isbn)
         return False
     
 
-    def update_book(self, isbn, title=None, author=None, new_isbn=None):
+    @metrics.timed
+    def update_book(self, isbn, title=None, author=None, new_isbn=None, copies=None):
         """
         Update the details of an existing book.
         
@@ -89,34 +208,220 @@ class BookManager:
             title (str): New title of the book (optional).
             author (str): New author of the book (optional).
             new_isbn (str): New ISBN of the book (optional).
+            copies (int): New number of copies owned, at least one and no
+                fewer than are checked out (optional).
         
         Returns:
             True if the update is successful, False otherwise.
         """
         book = self.find_book_by_isbn(isbn)
         if book:
+            new_isbn = new_isbn.strip() if new_isbn else None
+            # Rewriting the book's own ISBN in another form is allowed
+            existing = self.resolve_isbn(new_isbn) if new_isbn else None
+            if existing and existing != book.isbn and existing in self._books:
+                log.warning('book.exists', "Book with ISBN {isbn} already exists.", isbn=new_isbn)
+                return False
+            if copies is not None and copies < max(1, book.checked_out):
+                log.warning('book.copies_on_loan', "Book '{title}' needs at least {needed} copies; "
+                            "{checked_out} are checked out.", title=book.title, isbn=book.isbn,
+                            needed=max(1, book.checked_out), checked_out=book.checked_out)
+                return False
             if title:
                 book.title = title
             if author:
                 book.author = author
+            if copies is not None:
+                book.copies = copies
+            self._unindex(book.isbn)
+            changes = {book.isbn: book}
             if new_isbn:
+                del self._books[book.isbn]
+                changes[book.isbn] = None
+                self._check_isbn(new_isbn)
                 book.isbn = new_isbn
+                self._books[new_isbn] = book
+                changes[new_isbn] = book
+            self._index(book)
 
-            # Save the updated list of books
-            Storage.save_books(self.books)
-            print(f"Book '{book.title}' updated successfully.")
+            # Save the updated books
+            self.commit(changes)
+            log.info('book.updated', "Book '{title}' updated successfully.", title=book.title, isbn=book.isbn)
             return True
         else:
-            print(f"Book with ISBN {isbn} not found.")
+            log.warning('book.not_found', "Book with ISBN {isbn} not found.", isbn=isbn)
             return False
 
 
-    def list_books(self):
+    @metrics.timed
+    def list_books(self, sort=None):
         """
         Print the list of books in the library.
+
+        Parameters:
+            sort (str): 'title', 'author' or 'isbn'; insertion order if omitted.
         """
-        if self.books:
-            for book in self.books:
+        if self._books:
+            for book in self.iter_books(sort=sort):
                 print(book)
         else:
-            print("No books available. Please add books to the library.")
\ No newline at end of file
+            print("No books available. Please add books to the library.")
+
+
+    def iter_books(self, filter=None, sort=None, offset=0, limit=None, after=None):
+        """
+        Yield books one at a time, so a listing can be shown page by page
+        without formatting, or even loading, the rest of the catalog.
+
+        Sorted orders come from an index kept up to date by every change, so
+        a page starts with a binary search instead of a sort. To page with a
+        cursor, pass the ISBN of the last book of one page as after to get
+        the next; unlike offset, it stays correct while books are added or
+        removed.
+
+        Parameters:
+            filter (callable): Only yield books for which filter(book) is true (optional).
+            sort (str): 'title', 'author' or 'isbn'; insertion order if omitted.
+            offset (int): The number of matching books to skip.
+            limit (int): The maximum number of books to yield (optional).
+            after (str): The cursor: continue right after the book with this ISBN (optional).
+
+        Returns:
+            iterator: The books.
+
+        Raises:
+            ValueError: If the sort order or the cursor is unknown.
+
+        Examples:
+            page = list(book_manager.iter_books(sort='title', limit=20))
+            page = list(book_manager.iter_books(sort='title', limit=20, after=page[-1].isbn))
+            available = book_manager.iter_books(filter=lambda book: book.available)
+        """
+
+        if sort is not None and sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort order {sort!r}; use one of {', '.join(SORT_KEYS)}.")
+        if after is not None and after not in self._books:
+            raise ValueError(f"Unknown cursor {after!r}.")
+
+        if sort is None:
+            books = iter(self._books.values())
+            if after is not None:
+                # Insertion order has no index to seek in; skip up to the cursor
+                for book in books:
+                    if book.isbn == after:
+                        break
+        else:
+            books = (self._books[isbn] for isbn in self._sorted_index(sort).keys(after))
+        if filter is not None:
+            books = (book for book in books if filter(book))
+        return itertools.islice(books, offset, None if limit is None else offset + limit)
+
+
+    def _sorted_index(self, sort):
+        index = self._sorted.get(sort)
+        if index is None:
+            index = self._sorted[sort] = SortedIndex(SORT_KEYS[sort], ((book.isbn, book) for book in self._books.values()))
+        return index
+
+
+    def resolve_isbn(self, isbn):
+        """
+        Return the ISBN a book is stored under, given its ISBN in any form.
+
+        Returns:
+            str: The stored ISBN, or the given one, stripped, if no book has it.
+        """
+
+        isbn = isbn.strip()
+        if isbn in self._books:
+            return isbn
+        key = self._identifier_index().resolve(isbn)
+        return isbn if key is None else key
+
+
+    @metrics.timed
+    def suggest_isbns(self, isbn, limit=5):
+        """
+        Suggest the ISBNs in the catalog one typo away from one that was not
+        found, e.g. with two neighbouring digits swapped.
+
+        Parameters:
+            isbn (str): The ISBN that was not found.
+            limit (int): The maximum number of suggestions.
+
+        Returns:
+            list: The suggested ISBNs.
+        """
+
+        return self._identifier_index().suggest(isbn, limit)
+
+
+    def _identifier_index(self):
+        # Flag books stored under two forms of one ISBN as the index is opened
+        if self._identifiers is None:
+            self._identifiers = Storage.open_isbn_index(self._books)
+            for isbn, existing in self._identifiers.duplicates():
+                log.warning('book.duplicate_isbn', "ISBN {isbn} is another form of {existing}; both are "
+                            "stored and lookups find {existing}.", isbn=isbn, existing=existing)
+        return self._identifiers
+
+
+    def _check_isbn(self, isbn):
+        # A bad check digit is kept, as entered, but reported
+        if looks_like_isbn(isbn) and not is_valid_isbn(isbn):
+            log.warning('book.invalid_isbn', "ISBN {isbn} has an invalid check digit.", isbn=isbn)
+
+
+    def _index(self, book):
+        # Keep the search and sort indexes and statistics that have been built up to date
+        if self._search_index is not None:
+            self._search_index.add(book)
+        for index in self._sorted.values():
+            index.add(book.isbn, book)
+        if self._identifiers is not None:
+            self._identifiers.add(book.isbn)
+        if self.stats is not None:
+            self.stats.track_book(book.isbn, book)
+
+
+    def _unindex(self, isbn):
+        if self._search_index is not None:
+            self._search_index.remove(isbn)
+        for index in self._sorted.values():
+            index.remove(isbn)
+        if self._identifiers is not None:
+            self._identifiers.remove(isbn)
+        if self.stats is not None:
+            self.stats.track_book(isbn, None)
+
+
+    @metrics.timed
+    def search_books(self, query, limit=None):
+        """
+        Search books by title and author.
+
+        Every term in the query must match a word, or the start of a word, in
+        the title or author. Case is ignored.
+
+        Parameters:
+            query (str): The search terms, e.g. "orwell 19".
+            limit (int): The maximum number of results (optional).
+
+        Returns:
+            list: The matching books, best match first.
+        """
+
+        if self._search_index is None:
+            self._search_index = SearchIndex(self._books.values())
+        return [self._books[isbn] for isbn in self._search_index.search(query, limit)]
+
+
+    def commit(self, changes):
+        """
+        Persist changed books.
+
+        Parameters:
+            changes (dict): Maps each changed ISBN to its Book, or to None if removed.
+        """
+
+        Storage.commit_books(self._books.values(), changes)
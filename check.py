@@ -1,3 +1,18 @@
+import contextlib
+import threading
+from datetime import datetime, timedelta
+from events import EventLogger
+from holds import HoldQueues
+from loans import LoanIndex
+import metrics
+from locking import KeyedLocks, LockTimeout
+from stats import CirculationStats
+from storage import Storage, StorageError
+
+
+log = EventLogger('check')
+
+
 class CheckManager:
     """
     Manages the checking out and returning of books for users.
@@ -9,6 +24,63 @@ class CheckManager:
     Methods:
         check_out_book: Check out a book for a user.
         return_book: Return a book that was checked out.
+        who_has: Find the users who have a book on loan.
+        loans_for: Find the books a user has on loan.
+        overdue: Find the loans due before a given time.
+        due_within: Find the loans due within a number of days.
+        place_hold: Join the queue for a book that is out.
+        cancel_hold: Leave the queue for a book.
+        holds_for: Find the books a user is waiting for.
+        hold_queue: Find the users waiting for a book.
+        rebuild_loans: Rebuild the loans index from the users and books.
+        stats: Circulation statistics for reports.
+        history: The log of past checkouts and returns.
+        loan_history: Stream past checkouts and returns.
+
+    Both operations change the Book and the User in place and persist them
+    together in a single storage transaction. If persisting fails, both
+    objects are rolled back.
+
+    With thread_safe=True, each operation holds a lock on its ISBN and one on
+    its user ID, always taken book first, so operations on different books
+    and users run in parallel while conflicting ones queue up and then fail
+    cleanly (e.g. the second checkout of the same book returns False). An
+    operation that cannot get its locks within lock_timeout seconds fails.
+    When every save rewrites the whole file (see Storage.full_rewrite), an
+    operation also holds the storage lock from its first change until it is
+    persisted or rolled back, so no save writes another operation's
+    unfinished changes.
+
+    A LoanIndex answers who_has() and loans_for() without scanning users. It
+    is built from the loaded users by the first such query, cross-checked
+    against the books, and then kept up to date by every checkout and
+    return. Checkouts and returns never build it themselves, so with a lazy
+    catalog they only load the records they touch. Books or users changed
+    directly through the other managers are not tracked; call
+    rebuild_loans() after such changes.
+
+    Every checkout records when the loan started and when it is due, loan_days
+    later unless a due date is given, in the user's loan_dates. The index
+    keeps loans ordered by due date for overdue() and due_within().
+
+    A book may have several copies; checking one out or returning it only
+    updates the book's counters, so availability is known without looking
+    at any other record.
+
+    Patrons can place a hold on a book when every copy is out. Copies on the
+    shelf are kept for the users in a book's queue: only the user at the
+    front can take one, unless there are more copies than users waiting, and
+    returning a copy checks it out to that user straight away. The queues are persisted
+    with Storage.commit_holds, in the same transaction as the checkout that
+    takes a user off a queue.
+
+    Every checkout and return that is persisted is also appended to the
+    loan history in Storage.HISTORY_DIR, which outlives the loans. A failure
+    to append is logged but does not undo the operation.
+
+    The circulation statistics are built from the loaded books and users on
+    first use and attached to both managers, which keep them up to date
+    along with every checkout and return from then on.
     
     Examples:
         book_manager = BookManager()
@@ -18,50 +90,372 @@ class CheckManager:
         check_manager.return_book("12345", "978-0061122415")
     """
 
-    def __init__(self, book_manager, user_manager):
+    def __init__(self, book_manager, user_manager, thread_safe=False, lock_timeout=5.0, loan_days=14):
         """
         Initialize the CheckManager with instances of BookManager and UserManager.
+
+        Parameters:
+            loan_days (float): How long a book may be kept by default.
+            thread_safe (bool): Lock each book and user while it is checked out or returned.
+            lock_timeout (float): Seconds to wait for the locks in thread-safe mode.
         """
 
         self.book_manager = book_manager
         self.user_manager = user_manager
+        self.lock_timeout = lock_timeout
+        self.loan_days = loan_days
+        self._locks = KeyedLocks() if thread_safe else None
+        self._loans = None
+        self._loans_lock = threading.Lock()
+        self._holds = None
+        self._stats = None
+        self._history = None
+
+    @contextlib.contextmanager
+    def _hold(self, user_id, isbn):
+        if self._locks is None:
+            yield
+            return
+        with self._locks.hold([('book', self.book_manager.resolve_isbn(isbn)), ('user', user_id)],
+                              timeout=self.lock_timeout):
+            # Per-record commits only write locked records; a full rewrite
+            # writes every record, so changes are made under the storage lock
+            with Storage.lock() if Storage.full_rewrite() else contextlib.nullcontext():
+                yield
+
+
+    @property
+    def loans(self):
+        """
+        The loans index, built from the loaded users on the first query that needs it.
+        """
+
+        if self._loans is None:
+            with self._loans_lock:
+                if self._loans is None:
+                    self.rebuild_loans()
+        return self._loans
+
+    @property
+    def holds(self):
+        """
+        The hold queues, loaded from storage on first use.
+        """
+
+        if self._holds is None:
+            with self._loans_lock:
+                if self._holds is None:
+                    self._holds = HoldQueues(Storage.load_holds())
+        return self._holds
+
+    @property
+    def stats(self):
+        """
+        The circulation statistics, built from the loaded books and users and
+        the checkouts in the loan history on first use, and kept up to date by
+        every change afterwards. Checkouts still queued by a deferred history
+        are not counted.
+        """
+
+        if self._stats is None:
+            history = self.history
+            with self._loans_lock:
+                if self._stats is None:
+                    stats = CirculationStats(self.book_manager.books, self.user_manager.users,
+                                             history.events(event='checkout'))
+                    self.book_manager.stats = self.user_manager.stats = stats
+                    self._stats = stats
+        return self._stats
+
+    @property
+    def history(self):
+        """
+        The loan history, opened on first use.
+        """
+
+        if self._history is None:
+            with self._loans_lock:
+                if self._history is None:
+                    self._history = Storage.open_history()
+        return self._history
+
+    @metrics.timed
+    def rebuild_loans(self):
+        """
+        Rebuild the loans index from the users' borrowed books, reporting any
+        that disagree with the books' checked-out flags.
+
+        Returns:
+            list: A description of every inconsistency found; empty if none.
+        """
 
+        loans = LoanIndex()
+        problems = loans.rebuild(self.user_manager.users, self.book_manager._books)
+        for problem in problems:
+            log.warning('loan.inconsistent', "Loan inconsistency: {problem}", problem=problem)
+        self._loans = loans
+        return problems
 
-    def check_out_book(self, user_id, isbn):
+    @metrics.timed
+    def who_has(self, isbn):
+        """
+        Find the users who have a copy of a book on loan.
+
+        Parameters:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            frozenset: The IDs of the borrowers; empty if no copy is on loan.
+        """
+
+        return self.loans.who_has(self.book_manager.resolve_isbn(isbn))
+
+    @metrics.timed
+    def loans_for(self, user_id):
+        """
+        Find the books a user has on loan.
+
+        Parameters:
+            user_id (str): The ID of the user.
+
+        Returns:
+            frozenset: The ISBNs the user has on loan.
+        """
+
+        return self.loans.loans_for(user_id)
+
+    @metrics.timed
+    def overdue(self, as_of=None):
+        """
+        Find the loans that were due before a given time.
+
+        Parameters:
+            as_of (datetime): The time to compare against (default: now).
+
+        Returns:
+            list: (ISBN, user ID, due date) tuples, the longest overdue first.
+        """
+
+        return self.loans.overdue(as_of)
+
+    @metrics.timed
+    def due_within(self, days, as_of=None):
+        """
+        Find the loans due within a number of days, including overdue ones.
+
+        Parameters:
+            days (float): How many days ahead to look.
+            as_of (datetime): The time to count from (default: now).
+
+        Returns:
+            list: (ISBN, user ID, due date) tuples, the earliest due first.
+        """
+
+        return self.loans.due_within(days, as_of)
+
+    def loan_history(self, user_id=None, isbn=None, start=None, end=None, event=None):
+        """
+        Stream past checkouts and returns, oldest first, without loading the
+        whole history.
+
+        Parameters:
+            user_id (str): Only events for this user (optional).
+            isbn (str): Only events for this book (optional).
+            start (datetime): Only events at or after this time (optional).
+            end (datetime): Only events before this time (optional).
+            event (str): Only 'checkout' or only 'return' events (optional).
+
+        Returns:
+            iterator: The events, as dicts with the time, event, ISBN and user ID.
+        """
+
+        return self.history.events(start=start, end=end, isbn=self.book_manager.resolve_isbn(isbn) if isbn else None,
+                                   user_id=user_id, event=event)
+
+    @metrics.timed
+    def place_hold(self, user_id, isbn):
+        """
+        Add a user to the queue for a book whose copies are all checked out.
+
+        Parameters:
+            user_id (str): The ID of the user placing the hold.
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            bool: True if the hold was placed, False otherwise.
+        """
+
+        try:
+            with self._hold(user_id, isbn):
+                return self._place_hold(user_id, isbn)
+        except LockTimeout:
+            log.warning('hold.timeout', "Timed out waiting to place a hold on ISBN {isbn} for user {user_id}.",
+                        isbn=isbn, user_id=user_id)
+            return False
+
+    def _place_hold(self, user_id, isbn):
+        user = self.user_manager.find_user_by_id(user_id)
+        if not user:
+            log.warning('user.not_found', "User with ID {user_id} not found.", user_id=user_id)
+            return False
+
+        book = self.book_manager.find_book_by_isbn(isbn)
+        if not book:
+            log.warning('book.not_found', "Book with ISBN {isbn} not found.", isbn=isbn)
+            return False
+
+        if book.isbn in user.borrowed_books:
+            log.warning('hold.on_loan', "{name} (ID: {user_id}) already has '{title}' (ISBN: {isbn}).",
+                        name=user.name, user_id=user_id, title=book.title, isbn=book.isbn)
+            return False
+        if book.available > self.holds.waiting(book.isbn):
+            log.warning('hold.available', "Book '{title}' (ISBN: {isbn}) is available; check it out instead.",
+                        title=book.title, isbn=book.isbn)
+            return False
+
+        position = self.holds.place(book.isbn, user.user_id)
+        if not position:
+            log.warning('hold.exists', "{name} (ID: {user_id}) is already waiting for '{title}' (ISBN: {isbn}).",
+                        name=user.name, user_id=user_id, title=book.title, isbn=book.isbn)
+            return False
+        if not self._persist_holds(book.isbn):
+            self.holds.cancel(book.isbn, user.user_id)
+            log.error('hold.failed', "Failed to save the hold on '{title}' (ISBN: {isbn}); changes rolled back.",
+                      title=book.title, isbn=book.isbn, user_id=user_id)
+            return False
+        log.info('hold.placed', "Hold placed on '{title}' (ISBN: {isbn}) for {name} (ID: {user_id}); "
+                 "position {position} in the queue.",
+                 title=book.title, isbn=book.isbn, name=user.name, user_id=user_id, position=position)
+        return True
+
+    @metrics.timed
+    def cancel_hold(self, user_id, isbn):
+        """
+        Remove a user from the queue for a book.
+
+        Parameters:
+            user_id (str): The ID of the user.
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            bool: True if the hold was cancelled, False if there was none.
+        """
+
+        try:
+            with self._hold(user_id, isbn):
+                isbn = self.book_manager.resolve_isbn(isbn)
+                position = self.holds.cancel(isbn, user_id)
+                if not position:
+                    log.warning('hold.not_found', "User {user_id} has no hold on ISBN {isbn}.", user_id=user_id, isbn=isbn)
+                    return False
+                if not self._persist_holds(isbn):
+                    self.holds.place(isbn, user_id, position)
+                    log.error('hold.cancel_failed', "Failed to save the cancelled hold on ISBN {isbn}; changes rolled back.",
+                              isbn=isbn, user_id=user_id)
+                    return False
+                log.info('hold.cancelled', "Hold on ISBN {isbn} cancelled for user {user_id}.", isbn=isbn, user_id=user_id)
+                return True
+        except LockTimeout:
+            log.warning('hold.timeout', "Timed out waiting to cancel the hold on ISBN {isbn} for user {user_id}.",
+                        isbn=isbn, user_id=user_id)
+            return False
+
+    @metrics.timed
+    def holds_for(self, user_id):
+        """
+        Find the books a user is waiting for.
+
+        Returns:
+            frozenset: The ISBNs the user has holds on.
+        """
+
+        return self.holds.holds_for(user_id)
+
+    @metrics.timed
+    def hold_queue(self, isbn):
+        """
+        Find the users waiting for a book.
+
+        Returns:
+            list: The IDs of the waiting users, next in line first.
+        """
+
+        return self.holds.queue(self.book_manager.resolve_isbn(isbn))
+
+    @metrics.timed
+    def check_out_book(self, user_id, isbn, due_date=None):
         """
         Check out a book for a user.
         
         Parameters:
             user_id: The ID of the user checking out the book.
             isbn: The ISBN of the book to be checked out.
+            due_date (datetime): When the book is due back (default: loan_days from now).
 
         Returns:
             bool: True if the checkout is successful, False otherwise.
         """
 
+        try:
+            with self._hold(user_id, isbn):
+                return self._check_out_book(user_id, isbn, due_date)
+        except LockTimeout:
+            log.warning('checkout.timeout', "Timed out waiting to check out ISBN {isbn} for user {user_id}.",
+                        isbn=isbn, user_id=user_id)
+            return False
+
+    def _check_out_book(self, user_id, isbn, due_date):
         user = self.user_manager.find_user_by_id(user_id)
         if not user:
-            print(f"User with ID {user_id} not found.")
+            log.warning('user.not_found', "User with ID {user_id} not found.", user_id=user_id)
             return False
         
         book = self.book_manager.find_book_by_isbn(isbn)
-        print(book)
         if not book:
-            print(f"Book with ISBN {isbn} not found.")
+            log.warning('book.not_found', "Book with ISBN {isbn} not found.", isbn=isbn)
             return False
         
+        holder = self.holds.next_holder(book.isbn)
+        if holder is not None and holder != user.user_id and 0 < book.available <= self.holds.waiting(book.isbn):
+            log.warning('checkout.on_hold', "Book '{title}' (ISBN: {isbn}) is on hold for another patron.",
+                        title=book.title, isbn=book.isbn, user_id=user_id)
+            return False
+
+        checked_out = datetime.now().replace(microsecond=0)
+        due = due_date or checked_out + timedelta(days=self.loan_days)
         if book.check_out():  # Use the Book's check_out method
-            if user.borrow_book(book):  # Call borrow_book on the user object
-                self.book_manager.remove_book(isbn)
-                self.book_manager.add_book(book)  # Update the book's status in storage
-                print(f"Book '{book.title}' (ISBN: {isbn}) checked out by {user.name} (ID: {user_id}).")
+            if user.borrow_book(book, checked_out=checked_out, due=due):  # Call borrow_book on the user object
+                # The user's hold is filled, wherever they were in the queue
+                position = self.holds.cancel(book.isbn, user.user_id)
+                if not self._persist(book, user, holds_changed=bool(position)):
+                    book.check_in()
+                    user.return_book(book)
+                    if position:
+                        self.holds.place(book.isbn, user.user_id, position=position)
+                    log.error('checkout.failed', "Failed to save checkout of '{title}' (ISBN: {isbn}); changes rolled back.",
+                              title=book.title, isbn=book.isbn, user_id=user_id)
+                    return False
+                with self._loans_lock:
+                    # An index built later reads the loan from the user instead
+                    if self._loans is not None:
+                        self._loans.add(book.isbn, user.user_id, due=due)
+                if self._stats is not None:
+                    self._stats.record_checkout(book, user)
+                self._record_history('checkout', book, user, time=checked_out, due=due)
+                log.info('checkout.done', "Book '{title}' (ISBN: {isbn}) checked out by {name} (ID: {user_id}), "
+                         "due {due:%Y-%m-%d}.",
+                         title=book.title, isbn=book.isbn, name=user.name, user_id=user_id, due=due)
                 return True
             else:
                 book.check_in()  # Revert the checkout if the user cannot borrow
-        print(f"Failed to check out book '{book.title}' (ISBN: {isbn}) for {user.name} (ID: {user_id}).")
+        log.warning('checkout.refused', "Failed to check out book '{title}' (ISBN: {isbn}) for {name} (ID: {user_id}).",
+                    title=book.title, isbn=book.isbn, name=user.name, user_id=user_id)
+        if not book.available and book.isbn not in user.borrowed_books:
+            log.info('checkout.all_out', "Every copy is out; place a hold to be next in line.", isbn=book.isbn)
         return False
 
 
+    @metrics.timed
     def return_book(self, user_id, isbn):
         """
         Return a book that was checked out.
@@ -73,24 +467,113 @@ class CheckManager:
         Returns:
             bool: True if the return is successful, False otherwise.
         """
-        
+
+        try:
+            with self._hold(user_id, isbn):
+                returned = self._return_book(user_id, isbn)
+        except LockTimeout:
+            log.warning('return.timeout', "Timed out waiting to return ISBN {isbn} for user {user_id}.",
+                        isbn=isbn, user_id=user_id)
+            return False
+        if returned:
+            # Outside the returning user's lock, so two returns never wait on each other
+            self._allocate(self.book_manager.resolve_isbn(isbn))
+        return returned
+
+    def _allocate(self, isbn):
+        """
+        Check a returned copy out to the first user waiting for the book.
+        """
+
+        while True:
+            holder = self.holds.next_holder(isbn)
+            if holder is None:
+                return
+            user = self.user_manager.find_user_by_id(holder)
+            if user is None or isbn in user.borrowed_books:
+                # The user was removed or already has a copy; skip their hold. If it
+                # cannot be dropped they stay first in line, so leave the copy on the shelf.
+                if not self.cancel_hold(holder, isbn):
+                    return
+                continue
+            if self.check_out_book(holder, isbn):
+                log.info('hold.filled', "ISBN {isbn} was on hold and is now checked out to user {user_id}.",
+                         isbn=isbn, user_id=holder)
+            return
+
+    def _return_book(self, user_id, isbn):
         user = self.user_manager.find_user_by_id(user_id)
         if not user:
-            print(f"User with ID {user_id} not found.")
+            log.warning('user.not_found', "User with ID {user_id} not found.", user_id=user_id)
             return False
         
         book = self.book_manager.find_book_by_isbn(isbn)
         if not book:
-            print(f"Book with ISBN {isbn} not found.")
+            log.warning('book.not_found', "Book with ISBN {isbn} not found.", isbn=isbn)
             return False
         
+        dates = user.loan_dates.get(book.isbn)
         if book.check_in():  # Use the Book's check_in method
             if user.return_book(book):  # Call return_book on the user object
-                self.book_manager.remove_book(isbn)
-                self.book_manager.add_book(book)  # Update the book's status in storage
-                print(f"Book '{book.title}' (ISBN: {isbn}) returned by {user.name} (ID: {user_id}).")
+                if not self._persist(book, user):
+                    book.check_out()
+                    user.borrow_book(book)
+                    if dates:
+                        user.loan_dates[book.isbn] = dates
+                    log.error('return.failed', "Failed to save return of '{title}' (ISBN: {isbn}); changes rolled back.",
+                              title=book.title, isbn=book.isbn, user_id=user_id)
+                    return False
+                with self._loans_lock:
+                    if self._loans is not None:
+                        self._loans.remove(book.isbn, user.user_id)
+                if self._stats is not None:
+                    self._stats.record_return(book, user)
+                self._record_history('return', book, user)
+                log.info('return.done', "Book '{title}' (ISBN: {isbn}) returned by {name} (ID: {user_id}).",
+                         title=book.title, isbn=book.isbn, name=user.name, user_id=user_id)
                 return True
             else:
                 book.check_out()  # Revert the check-in if the user cannot return
-        print(f"Failed to return book '{book.title}' (ISBN: {isbn}) for {user.name} (ID: {user_id}).")
-        return False
\ No newline at end of file
+        log.warning('return.refused', "Failed to return book '{title}' (ISBN: {isbn}) for {name} (ID: {user_id}).",
+                    title=book.title, isbn=book.isbn, name=user.name, user_id=user_id)
+        return False
+
+
+    def _persist(self, book, user, holds_changed=False):
+        """
+        Persist a book and a user together in one storage transaction, with
+        the book's hold queue if it changed.
+
+        Returns:
+            bool: True if both were persisted, False otherwise.
+        """
+
+        try:
+            with Storage.transaction():
+                self.book_manager.commit({book.isbn: book})
+                self.user_manager.commit({user.user_id: user})
+                if holds_changed:
+                    self._commit_holds(book.isbn)
+        except StorageError as e:
+            log.error('storage.failed', "{error}", error=e)
+            return False
+        return True
+
+    def _record_history(self, event, book, user, **fields):
+        try:
+            self.history.record(event, book.isbn, user.user_id, **fields)
+        except OSError as e:
+            log.error('history.failed', "Could not record the {event} of ISBN {isbn} in the loan history: {error}",
+                      event=event, isbn=book.isbn, user_id=user.user_id, error=e)
+
+    def _persist_holds(self, isbn):
+        try:
+            with Storage.transaction():
+                self._commit_holds(isbn)
+        except StorageError as e:
+            log.error('storage.failed', "{error}", error=e)
+            return False
+        return True
+
+    def _commit_holds(self, isbn):
+        Storage.commit_holds(self.holds.values(), {isbn: self.holds.get(isbn)})
@@ -0,0 +1,159 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+
+# The parent of every logger in the library; silent until configure() is called
+ROOT = 'library'
+logging.getLogger(ROOT).addHandler(logging.NullHandler())
+
+_listener = None
+_handler = None
+
+
+class Event:
+    """
+    One structured event: a name, the fields that describe it and a message
+    template, which is only formatted if the event is actually written.
+
+    Attributes:
+        name (str): What happened, e.g. 'book.added'.
+        template (str): The human-readable message, formatted with the fields.
+        fields (dict): The event's data, e.g. {'isbn': '978-0062315007'}.
+    """
+
+    __slots__ = ('name', 'template', 'fields')
+
+    def __init__(self, name, template, fields):
+        self.name = name
+        self.template = template
+        self.fields = fields
+
+    def __str__(self):
+        return self.template.format(**self.fields)
+
+
+class EventLogger:
+    """
+    Log structured events under 'library.<name>'.
+
+    Each method takes the event name, a message template and the event's
+    fields as keywords. Nothing is formatted for a level that is disabled.
+
+    Methods:
+        debug, info, warning, error: Log an event at that level.
+
+    Examples:
+        log = EventLogger('book')
+        log.info('book.added', "Book '{title}' added successfully.", title=book.title, isbn=book.isbn)
+    """
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(f"{ROOT}.{name}")
+
+    def _log(self, level, event, template, fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, Event(event, template, fields), extra={'event': event, 'fields': fields})
+
+    def debug(self, event, template, **fields):
+        self._log(logging.DEBUG, event, template, fields)
+
+    def info(self, event, template, **fields):
+        self._log(logging.INFO, event, template, fields)
+
+    def warning(self, event, template, **fields):
+        self._log(logging.WARNING, event, template, fields)
+
+    def error(self, event, template, **fields):
+        self._log(logging.ERROR, event, template, fields)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """
+    Format each record as one JSON object per line, with the time, level,
+    logger, event name, message and the event's fields.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure(level=None, fmt=None, path=None, stream=None, background=True):
+    """
+    Choose where the library's events go and how they look, replacing any
+    earlier configuration.
+
+    With background=True, callers only put records on a queue and a
+    listener thread formats and writes them, so no operation waits for the
+    terminal or the disk. Anything still queued is written at exit.
+
+    Parameters:
+        level (str): The lowest level written (default: LIBRARY_LOG_LEVEL or 'INFO').
+        fmt (str): 'text' for the bare messages, or 'json' for JSON lines
+            (default: LIBRARY_LOG_FORMAT or 'text').
+        path (str): Append to this file (default: LIBRARY_LOG_FILE, or else the stream).
+        stream: The stream to write to when there is no path (default: standard output).
+        background (bool): Write from a listener thread instead of the caller's.
+
+    Examples:
+        events.configure()  # The CLI's messages, as text on standard output
+        events.configure(fmt='json', path='library.log', level='DEBUG')
+    """
+
+    global _listener, _handler
+    shutdown()
+
+    level = (level or os.environ.get('LIBRARY_LOG_LEVEL') or 'INFO').upper()
+    fmt = fmt or os.environ.get('LIBRARY_LOG_FORMAT') or 'text'
+    path = path or os.environ.get('LIBRARY_LOG_FILE')
+
+    target = logging.FileHandler(path) if path else logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JSONLinesFormatter() if fmt == 'json' else logging.Formatter('%(message)s'))
+
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(level)
+    logger.propagate = False
+    if background:
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, target)
+        _listener.start()
+        _handler = logging.handlers.QueueHandler(records)
+    else:
+        _handler = target
+    logger.addHandler(_handler)
+
+
+def shutdown():
+    """
+    Write any queued events and detach the configured handler.
+    """
+
+    global _listener, _handler
+    logger = logging.getLogger(ROOT)
+    if _handler is not None:
+        logger.removeHandler(_handler)
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    elif _handler is not None:
+        _handler.close()
+    _listener = _handler = None
+
+
+atexit.register(shutdown)
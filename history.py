@@ -0,0 +1,315 @@
+import bisect
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+
+# Bytes written to a segment between two entries of its sparse index
+INDEX_INTERVAL = 4096
+
+# loans-YYYY-MM-DD.jsonl holds one day; loans-YYYY-MM.jsonl a compacted month
+SEGMENT_PATTERN = re.compile(r'^loans-(\d{4})-(\d{2})(?:-(\d{2}))?\.jsonl$')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _segment_range(name):
+    # The [start, end) time range a segment's name says it covers, or None
+    match = SEGMENT_PATTERN.match(name)
+    if not match:
+        return None
+    year, month, day = int(match[1]), int(match[2]), match[3]
+    if day is not None:
+        start = datetime(year, month, int(day))
+        return start, start + timedelta(days=1)
+    start = datetime(year, month, 1)
+    return start, datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def _month_start(time):
+    return time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+class LoanHistory:
+    """
+    An append-only log of checkouts and returns, kept after the loans end.
+
+    Events are appended as JSON lines to one segment file per day, named
+    after the day, so a time-range query only opens the segments that
+    overlap it. Next to each segment, a sparse index (.idx) records the
+    time and byte offset of the first event after every INDEX_INTERVAL
+    bytes; a query bisects it and seeks straight to its start time, then
+    streams events until its end time. Nothing is loaded beyond the index
+    and the line being read.
+
+    Events are appended in time order under the lock, so every segment is
+    sorted. compact() merges the day segments of past months into one
+    segment per month, and expire() deletes the segments that are older
+    than the retention period.
+
+    Each event is a dict with the time (as 'YYYY-MM-DDTHH:MM:SS'), the
+    event ('checkout' or 'return'), the ISBN and the user ID, plus the due
+    date of a checkout.
+
+    Attributes:
+        directory (str): Where the segments are kept.
+        lock (callable): Returns the context manager that serializes writers,
+            e.g. Storage.lock.
+        retention_days (int): How long events are kept by expire(); None keeps them forever.
+        deferred (bool): If set, record() only queues events and flush() writes them.
+        _pending (list): Events recorded but not yet written.
+        _last_time (str): The time of the latest event recorded, so times never go backwards.
+
+    Methods:
+        record: Append an event.
+        flush: Write the queued events.
+        events: Stream the events in a time range, optionally for one book or user.
+        segments: List the segments that overlap a time range.
+        compact: Merge the day segments of past months into month segments.
+        expire: Delete the segments older than the retention period.
+
+    Examples:
+        history = LoanHistory('history')
+        history.record('checkout', "978-0451524935", "U1001", due=due)
+        for event in history.events(user_id="U1001", start=datetime(2024, 1, 1)):
+            print(event['time'], event['event'], event['isbn'])
+    """
+
+    def __init__(self, directory, lock=None, retention_days=None, deferred=False):
+        self.directory = directory
+        if lock is None:
+            shared = threading.RLock()
+            lock = lambda: shared
+        self.lock = lock
+        self.retention_days = retention_days
+        self.deferred = deferred
+        self._pending = []
+        self._last_time = None
+        self._index_state = {}
+        self._record_lock = threading.Lock()
+
+    def record(self, event, isbn, user_id, time=None, **fields):
+        """
+        Append an event, or queue it if the history is deferred.
+
+        Parameters:
+            event (str): 'checkout' or 'return'.
+            isbn (str): The ISBN of the book.
+            user_id (str): The ID of the user.
+            time (datetime): When it happened (default: now); clamped so that
+                events are never recorded out of order.
+            fields: Extra data, e.g. due=datetime(...).
+        """
+
+        entry = {'time': None, 'event': event, 'isbn': isbn, 'user_id': user_id}
+        entry.update((key, value.strftime(TIME_FORMAT) if isinstance(value, datetime) else value)
+                     for key, value in fields.items())
+        with self._record_lock:
+            stamp = (time or datetime.now()).strftime(TIME_FORMAT)
+            if self._last_time is not None and stamp < self._last_time:
+                stamp = self._last_time
+            entry['time'] = self._last_time = stamp
+            self._pending.append(entry)
+        if not self.deferred:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the queued events to their segments. If writing fails, the
+        events of the days not yet written stay queued.
+        """
+
+        with self.lock():
+            with self._record_lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            days = [(day, list(entries)) for day, entries in itertools.groupby(pending, key=lambda entry: entry['time'][:10])]
+            for position, (day, entries) in enumerate(days):
+                try:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._append(os.path.join(self.directory, f"loans-{day}.jsonl"), entries)
+                except OSError:
+                    with self._record_lock:
+                        self._pending[:0] = [entry for _, entries in days[position:] for entry in entries]
+                    raise
+
+    def _append(self, path, entries):
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            last_indexed = self._last_indexed(path, offset)
+            index_entries = []
+            for entry in entries:
+                if last_indexed is None or offset - last_indexed >= INDEX_INTERVAL:
+                    index_entries.append([entry['time'], offset])
+                    last_indexed = offset
+                line = (json.dumps(entry) + '\n').encode()
+                f.write(line)
+                offset += len(line)
+        if index_entries:
+            with open(path + '.idx', 'a') as f:
+                f.writelines(json.dumps(index_entry) + '\n' for index_entry in index_entries)
+        self._index_state[path] = (offset, last_indexed)
+
+    def _last_indexed(self, path, size):
+        # The offset of the segment's last index entry, cached while only this
+        # process appends to it
+        state = self._index_state.get(path)
+        if state is not None and state[0] == size:
+            return state[1]
+        index = self._read_index(path)
+        return index[-1][1] if index else None
+
+    @staticmethod
+    def _read_index(path):
+        try:
+            with open(path + '.idx') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def segments(self, start=None, end=None):
+        """
+        List the segments that overlap a time range.
+
+        Returns:
+            list: (path, start, end) tuples, oldest first.
+        """
+
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        found = []
+        for name in names:
+            span = _segment_range(name)
+            if span and (start is None or span[1] > start) and (end is None or span[0] < end):
+                found.append((os.path.join(self.directory, name), *span))
+        return sorted(found, key=lambda segment: (segment[1], segment[2]))
+
+    def events(self, start=None, end=None, isbn=None, user_id=None, event=None):
+        """
+        Stream the events in a time range, oldest first.
+
+        Parameters:
+            start (datetime): Only events at or after this time (optional).
+            end (datetime): Only events before this time (optional).
+            isbn (str): Only events for this book (optional).
+            user_id (str): Only events for this user (optional).
+            event (str): Only 'checkout' or only 'return' events (optional).
+
+        Returns:
+            iterator: The events, as dicts.
+
+        Examples:
+            loans = history.events(user_id="U1001", event='checkout',
+                                   start=datetime(2024, 1, 1), end=datetime(2025, 1, 1))
+        """
+
+        first = start.strftime(TIME_FORMAT) if start else None
+        last = end.strftime(TIME_FORMAT) if end else None
+        for path, _, _ in self.segments(start, end):
+            for entry in self._read_segment(path, first, last):
+                if ((isbn is None or entry['isbn'] == isbn) and (user_id is None or entry['user_id'] == user_id)
+                        and (event is None or entry['event'] == event)):
+                    yield entry
+
+    def _read_segment(self, path, first=None, last=None):
+        offset = 0
+        if first is not None:
+            index = self._read_index(path)
+            # The last indexed event before the start; everything after it is in order
+            position = bisect.bisect_left([time for time, _ in index], first) - 1
+            if position >= 0:
+                offset = index[position][1]
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return  # Compacted since it was listed
+        with f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A torn final write
+                if first is not None and entry['time'] < first:
+                    continue
+                if last is not None and entry['time'] >= last:
+                    return
+                yield entry
+
+    def compact(self, as_of=None):
+        """
+        Merge the day segments of every month before the current one into a
+        single segment for the month, with a fresh sparse index.
+
+        Parameters:
+            as_of (datetime): The current time (default: now).
+
+        Returns:
+            int: The number of day segments merged.
+        """
+
+        current = _month_start(as_of or datetime.now())
+        merged = 0
+        with self.lock():
+            months = {}
+            for path, start, end in self.segments(end=current):
+                months.setdefault(_month_start(start), []).append((path, end - start))
+            for month, segments in sorted(months.items()):
+                days = [path for path, span in segments if span == timedelta(days=1)]
+                if not days:
+                    continue
+                target = os.path.join(self.directory, f"loans-{month:%Y-%m}.jsonl")
+                # Streams merged by time, so no segment is read into memory
+                streams = [self._read_segment(path) for path, _ in segments]
+                staged = target + '.tmp'
+                # Truncated rather than removed, so a month without events still gets an (empty) index
+                for stale in (staged, staged + '.idx'):
+                    open(stale, 'w').close()
+                self._index_state.pop(staged, None)
+                self._append(staged, heapq.merge(*streams, key=lambda entry: entry['time']))
+                os.replace(staged + '.idx', target + '.idx')
+                os.replace(staged, target)
+                self._index_state.pop(target, None)
+                for path in days:
+                    for stale in (path, path + '.idx'):
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(stale)
+                    self._index_state.pop(path, None)
+                merged += len(days)
+        return merged
+
+    def expire(self, as_of=None, retention_days=None):
+        """
+        Delete the segments whose events are all older than the retention
+        period. Events in a segment that is only partly expired are kept.
+
+        Parameters:
+            as_of (datetime): The current time (default: now).
+            retention_days (int): How many days to keep (default: the retention_days attribute).
+
+        Returns:
+            int: The number of segments deleted.
+        """
+
+        retention_days = retention_days if retention_days is not None else self.retention_days
+        if retention_days is None:
+            return 0
+        cutoff = (as_of or datetime.now()) - timedelta(days=retention_days)
+        deleted = 0
+        with self.lock():
+            for path, _, end in self.segments():
+                if end <= cutoff:
+                    for stale in (path, path + '.idx'):
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(stale)
+                    self._index_state.pop(path, None)
+                    deleted += 1
+        return deleted
@@ -0,0 +1,188 @@
+from collections import deque
+
+
+class HoldQueue:
+    """
+    The patrons waiting for one book, first come first served.
+
+    Attributes:
+        isbn (str): The ISBN of the book.
+        user_ids (deque): The IDs of the waiting users, next in line first.
+
+    Methods:
+        to_dict(): Convert the queue to a dictionary.
+        from_dict(data): Create a queue from a dictionary.
+    """
+
+    __slots__ = ('isbn', 'user_ids')
+
+    def __init__(self, isbn, user_ids=()):
+        self.isbn = isbn
+        self.user_ids = deque(user_ids)
+
+    def to_dict(self):
+        """
+        Convert the queue to a dictionary.
+        """
+
+        return {'isbn': self.isbn, 'user_ids': list(self.user_ids)}
+
+    @staticmethod
+    def from_dict(data):
+        """
+        Create a queue from a dictionary.
+        """
+
+        return HoldQueue(data['isbn'], data.get('user_ids', []))
+
+
+class HoldQueues:
+    """
+    Per-ISBN FIFO hold queues, with an index of the holds of each user.
+
+    Placing a hold and taking the next holder are O(1) deque operations.
+    Cancelling a hold removes it from the middle of its queue, which is
+    linear in the length of that one queue. Empty queues are dropped.
+
+    Attributes:
+        _queues (dict): Maps an ISBN to its HoldQueue.
+        _by_user (dict): Maps a user ID to the set of ISBNs they are waiting for.
+
+    Methods:
+        place: Add a user to the end of a book's queue.
+        cancel: Remove a user from a book's queue.
+        next_holder: Return the user at the front of a book's queue.
+        pop: Remove and return the user at the front of a book's queue.
+        queue: Return a book's queue.
+        waiting: Return the number of users waiting for a book.
+        holds_for: Return the ISBNs a user is waiting for.
+
+    Examples:
+        holds = HoldQueues()
+        holds.place("978-0062315007", "U1001")
+        holds.place("978-0062315007", "U1002")
+        holds.pop("978-0062315007") # 'U1001'
+    """
+
+    def __init__(self, queues=()):
+        self._queues = {}
+        self._by_user = {}
+        for queue in queues:
+            for user_id in queue.user_ids:
+                self.place(queue.isbn, user_id)
+
+    def place(self, isbn, user_id, position=None):
+        """
+        Add a user to a book's queue.
+
+        Parameters:
+            isbn (str): The ISBN of the book.
+            user_id (str): The ID of the user.
+            position (int): Where to insert the user, starting at 1, e.g. to
+                undo cancel() (default: the end of the queue).
+
+        Returns:
+            int: The user's position in the queue, starting at 1, or 0 if
+            they were already waiting for the book.
+        """
+
+        if isbn in self._by_user.get(user_id, ()):
+            return 0
+        queue = self._queues.get(isbn)
+        if queue is None:
+            queue = self._queues[isbn] = HoldQueue(isbn)
+        if position is None:
+            queue.user_ids.append(user_id)
+            position = len(queue.user_ids)
+        else:
+            queue.user_ids.insert(position - 1, user_id)
+        self._by_user.setdefault(user_id, set()).add(isbn)
+        return position
+
+    def cancel(self, isbn, user_id):
+        """
+        Remove a user from a book's queue.
+
+        Returns:
+            int: The position the user had, starting at 1, or 0 if they were
+            not waiting for the book.
+        """
+
+        if isbn not in self._by_user.get(user_id, ()):
+            return 0
+        queue = self._queues[isbn]
+        position = queue.user_ids.index(user_id) + 1
+        del queue.user_ids[position - 1]
+        self._forget(isbn, user_id)
+        return position
+
+    def next_holder(self, isbn):
+        """
+        Return the ID of the user at the front of a book's queue, or None.
+        """
+
+        queue = self._queues.get(isbn)
+        return queue.user_ids[0] if queue else None
+
+    def pop(self, isbn):
+        """
+        Remove and return the ID of the user at the front of a book's queue.
+
+        Returns:
+            str: The user ID, or None if nobody is waiting.
+        """
+
+        queue = self._queues.get(isbn)
+        if not queue:
+            return None
+        user_id = queue.user_ids.popleft()
+        self._forget(isbn, user_id)
+        return user_id
+
+    def _forget(self, isbn, user_id):
+        isbns = self._by_user[user_id]
+        isbns.discard(isbn)
+        if not isbns:
+            del self._by_user[user_id]
+        if not self._queues[isbn].user_ids:
+            del self._queues[isbn]
+
+    def queue(self, isbn):
+        """
+        Return the IDs of the users waiting for a book, next in line first.
+        """
+
+        queue = self._queues.get(isbn)
+        return list(queue.user_ids) if queue else []
+
+    def waiting(self, isbn):
+        """
+        Return the number of users waiting for a book.
+        """
+
+        queue = self._queues.get(isbn)
+        return len(queue.user_ids) if queue else 0
+
+    def get(self, isbn):
+        """
+        Return the HoldQueue for a book, or None if nobody is waiting.
+        """
+
+        return self._queues.get(isbn)
+
+    def holds_for(self, user_id):
+        """
+        Return the ISBNs a user is waiting for, as a frozenset.
+        """
+
+        return frozenset(self._by_user.get(user_id, ()))
+
+    def values(self):
+        """
+        Return every non-empty HoldQueue.
+        """
+
+        return self._queues.values()
+
+    def __len__(self):
+        return len(self._queues)
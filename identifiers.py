@@ -0,0 +1,237 @@
+import re
+
+
+# Ten or thirteen digits once hyphens and spaces are removed; an ISBN-10 may end in X
+ISBN_PATTERN = re.compile(r'^(?:\d{9}[\dX]|\d{13})$')
+
+SEPARATORS = re.compile(r'[\s-]+')
+
+
+def _isbn10_check_digit(digits):
+    check = (11 - sum((10 - i) * int(digit) for i, digit in enumerate(digits[:9]))) % 11
+    return 'X' if check == 10 else str(check)
+
+
+def _isbn13_check_digit(digits):
+    return str((10 - sum((3 if i % 2 else 1) * int(digit) for i, digit in enumerate(digits[:12]))) % 10)
+
+
+def looks_like_isbn(isbn):
+    """
+    Check whether a string has the length and digits of an ISBN-10 or
+    ISBN-13, ignoring hyphens, spaces and the check digit.
+    """
+
+    return bool(ISBN_PATTERN.match(SEPARATORS.sub('', isbn).upper()))
+
+
+def is_valid_isbn(isbn):
+    """
+    Check the length and check digit of an ISBN-10 or ISBN-13, ignoring
+    hyphens and spaces.
+
+    Examples:
+        is_valid_isbn("978-0062315007") # True
+        is_valid_isbn("0-06-231500-5") # True
+        is_valid_isbn("978-0062315008") # False
+    """
+
+    digits = SEPARATORS.sub('', isbn).upper()
+    if not ISBN_PATTERN.match(digits):
+        return False
+    if len(digits) == 10:
+        return digits[9] == _isbn10_check_digit(digits)
+    return digits[12] == _isbn13_check_digit(digits)
+
+
+def isbn10_to_13(isbn):
+    """
+    Convert a valid ISBN-10 to its ISBN-13, without hyphens.
+
+    Raises:
+        ValueError: If the ISBN-10 is not valid.
+
+    Examples:
+        isbn10_to_13("0-06-231500-5") # '9780062315007'
+    """
+
+    digits = SEPARATORS.sub('', isbn).upper()
+    if len(digits) != 10 or not is_valid_isbn(digits):
+        raise ValueError(f"{isbn!r} is not a valid ISBN-10.")
+    body = '978' + digits[:9]
+    return body + _isbn13_check_digit(body)
+
+
+def isbn13_to_10(isbn):
+    """
+    Convert a valid ISBN-13 with the 978 prefix to its ISBN-10, without hyphens.
+
+    Raises:
+        ValueError: If the ISBN-13 is not valid or has no ISBN-10 form.
+
+    Examples:
+        isbn13_to_10("978-0062315007") # '0062315005'
+    """
+
+    digits = SEPARATORS.sub('', isbn)
+    if len(digits) != 13 or not is_valid_isbn(digits) or not digits.startswith('978'):
+        raise ValueError(f"{isbn!r} is not a valid ISBN-13 with an ISBN-10 form.")
+    return digits[3:12] + _isbn10_check_digit(digits[3:12])
+
+
+def normalize_isbn(isbn):
+    """
+    Return the canonical form of an ISBN, under which every way of writing
+    the same book compares equal.
+
+    A valid ISBN-10 or ISBN-13 becomes the 13 digits of its ISBN-13. A
+    string that looks like an ISBN but fails its checksum only loses its
+    hyphens and spaces, and anything else (a local catalog number, say)
+    is only stripped, so that no identifier is rejected.
+
+    Examples:
+        normalize_isbn("978-0062315007") # '9780062315007'
+        normalize_isbn(" 0-06-231500-5") # '9780062315007'
+        normalize_isbn("LOCAL-42") # 'LOCAL-42'
+    """
+
+    digits = SEPARATORS.sub('', isbn).upper()
+    if not ISBN_PATTERN.match(digits):
+        return isbn.strip()
+    if len(digits) == 10 and is_valid_isbn(digits):
+        return isbn10_to_13(digits)
+    return digits
+
+
+def single_edits(word, alphabet):
+    """
+    Yield every string one deletion, adjacent transposition, substitution
+    or insertion away from a word, using the given characters for
+    substitutions and insertions. Some strings may be yielded twice.
+
+    Examples:
+        "9780062315007" in single_edits("9780062315070", "0123456789") # True
+    """
+
+    for i in range(len(word) + 1):
+        head, tail = word[:i], word[i:]
+        if tail:
+            yield head + tail[1:]
+            if len(tail) > 1:
+                yield head + tail[1] + tail[0] + tail[2:]
+            for char in alphabet:
+                if char != tail[0]:
+                    yield head + char + tail[1:]
+        for char in alphabet:
+            yield head + char + tail
+
+
+class IdentifierIndex:
+    """
+    Find records by a normalized form of their key, and suggest the keys
+    one typo away from one that matches nothing.
+
+    Keys are stored as given. The index maps each key's normalized form
+    back to it, so a lookup in any equivalent form is a dictionary access.
+    Suggestions are found the same way: every string one deletion,
+    transposition, substitution or insertion away from the identifier is
+    normalized and looked up, which costs a few hundred dictionary probes
+    for an ISBN however large the catalog is.
+
+    Attributes:
+        normalize (callable): Maps a key to its normalized form.
+        _keys (dict): Maps a normalized form to the stored key.
+        _shadowed (dict): Maps a normalized form to the further stored keys
+            that share it, which take over if the first is removed.
+        _alphabet (set): The characters of the normalized forms indexed so
+            far, used for substitutions and insertions.
+
+    Methods:
+        add: Index a stored key.
+        remove: Drop a stored key.
+        duplicates: Yield the stored keys shadowed by an equivalent one.
+        resolve: Return the stored key equivalent to an identifier.
+        suggest: Return the stored keys one edit away from an identifier.
+
+    Examples:
+        index = IdentifierIndex(normalize_isbn, ["978-0062315007"])
+        index.resolve("0062315005") # '978-0062315007'
+        index.suggest("978-0062315070") # ['978-0062315007']
+    """
+
+    def __init__(self, normalize, keys=()):
+        self.normalize = normalize
+        self._keys = {}
+        self._shadowed = {}
+        self._alphabet = set()
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        """
+        Index a stored key. An equivalent key indexed earlier keeps precedence.
+        """
+
+        normalized = self.normalize(key)
+        self._alphabet.update(normalized)
+        if self._keys.setdefault(normalized, key) != key:
+            self._shadowed.setdefault(normalized, []).append(key)
+
+    def remove(self, key):
+        """
+        Drop a stored key.
+        """
+
+        normalized = self.normalize(key)
+        shadowed = self._shadowed.get(normalized, [])
+        if key in shadowed:
+            shadowed.remove(key)
+        elif self._keys.get(normalized) == key:
+            if shadowed:
+                self._keys[normalized] = shadowed.pop(0)
+            else:
+                del self._keys[normalized]
+        if not shadowed:
+            self._shadowed.pop(normalized, None)
+
+    def duplicates(self):
+        """
+        Yield (key, existing) for every stored key that is equivalent to
+        another one indexed earlier, which lookups find instead.
+        """
+
+        for normalized, keys in self._shadowed.items():
+            for key in keys:
+                yield key, self._keys[normalized]
+
+    def resolve(self, identifier):
+        """
+        Return the stored key equivalent to an identifier, or None.
+        """
+
+        return self._keys.get(self.normalize(identifier))
+
+    def suggest(self, identifier, limit=5):
+        """
+        Return the stored keys one typo away from an identifier: a character
+        dropped, doubled, changed or two neighbours swapped.
+
+        Parameters:
+            identifier (str): The identifier that was not found.
+            limit (int): The maximum number of suggestions.
+
+        Returns:
+            list: The suggested stored keys, in order.
+        """
+
+        normalized = self.normalize(identifier)
+        found = set()
+        for candidate in single_edits(normalized, self._alphabet):
+            key = self._keys.get(self.normalize(candidate))
+            if key is not None:
+                found.add(key)
+        found.discard(self._keys.get(normalized))
+        return sorted(found)[:limit]
@@ -0,0 +1,103 @@
+import csv
+import json
+import os
+from events import EventLogger
+from models import Book
+
+
+REQUIRED_FIELDS = ('title', 'author', 'isbn')
+
+log = EventLogger('importer')
+
+
+def _records(path, fmt):
+    # Yield (line number, dict) pairs without reading the whole file
+    with open(path, 'r', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_number, ValueError(f"invalid JSON ({e})")
+
+
+def read_books(path, fmt=None):
+    """
+    Stream books from a CSV or JSON Lines acquisitions feed.
+
+    Each record needs a title, an author and an ISBN, and may give the
+    number of copies (default: 1). Values are stripped of
+    surrounding whitespace, as Book does for ISBNs. Invalid records are
+    reported and skipped.
+
+    Parameters:
+        path (str): The path of the feed.
+        fmt (str): Either 'csv' or 'jsonl'; guessed from the extension if omitted.
+
+    Yields:
+        Book: One book per valid record.
+
+    Examples:
+        for book in read_books('acquisitions.csv'):
+            print(book)
+    """
+
+    fmt = fmt or ('csv' if os.path.splitext(path)[1].lower() == '.csv' else 'jsonl')
+    for line_number, record in _records(path, fmt):
+        if isinstance(record, Exception):
+            log.warning('import.skipped', "Skipping line {line} of {path}: {reason}",
+                        line=line_number, path=path, reason=str(record))
+            continue
+        if not isinstance(record, dict):
+            log.warning('import.skipped', "Skipping line {line} of {path}: {reason}",
+                        line=line_number, path=path, reason='expected an object')
+            continue
+
+        values = {field: str(record.get(field) or '').strip() for field in REQUIRED_FIELDS}
+        missing = [field for field in REQUIRED_FIELDS if not values[field]]
+        if missing:
+            log.warning('import.skipped', "Skipping line {line} of {path}: {reason}",
+                        line=line_number, path=path, reason=f"missing {', '.join(missing)}")
+            continue
+
+        copies = str(record.get('copies') or 1).strip()
+        if not copies.isdigit() or int(copies) < 1:
+            log.warning('import.skipped', "Skipping line {line} of {path}: {reason}",
+                        line=line_number, path=path, reason=f"invalid number of copies {copies!r}")
+            continue
+
+        checked_out = record.get('is_checked_out', False)
+        if isinstance(checked_out, str):
+            checked_out = checked_out.strip().lower() in ('1', 'true', 'yes')
+        yield Book(title=values['title'], author=values['author'], isbn=values['isbn'],
+                   is_checked_out=bool(checked_out), copies=int(copies))
+
+
+def import_books(book_manager, path, fmt=None, batch_size=1000):
+    """
+    Import an acquisitions feed into the library, reporting progress per batch.
+
+    Parameters:
+        book_manager (BookManager): The manager to add the books to.
+        path (str): The path of the CSV or JSON Lines feed.
+        fmt (str): Either 'csv' or 'jsonl'; guessed from the extension if omitted.
+        batch_size (int): The number of books persisted together.
+
+    Returns:
+        tuple: The number of books added and skipped as duplicates.
+    """
+
+    def report(added, skipped):
+        log.info('import.progress', "Imported {added} book(s), skipped {skipped} duplicate(s)...",
+                 path=path, added=added, skipped=skipped)
+
+    added, skipped = book_manager.add_books(read_books(path, fmt), batch_size=batch_size, progress=report)
+    log.info('import.finished', "Import of {path} finished: {added} added, {skipped} duplicate(s) skipped.",
+             path=path, added=added, skipped=skipped)
+    return added, skipped
@@ -0,0 +1,203 @@
+import json
+import mmap
+import os
+import re
+from collections.abc import MutableMapping
+from events import EventLogger
+
+
+# Whole JSON strings (so brackets inside titles are skipped) or structural brackets
+TOKEN_PATTERN = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+log = EventLogger('lazy_storage')
+
+
+def scan_records(buffer, key):
+    """
+    Find the byte span and key of every object in a top-level JSON array.
+
+    Parameters:
+        buffer: The file contents, e.g. an mmap.
+        key (str): The field that identifies a record, e.g. 'isbn'.
+
+    Yields:
+        tuple: (key value, start offset, end offset) for each record.
+    """
+
+    key_pattern = re.compile(rb'"' + re.escape(key.encode()) + rb'"\s*:\s*("(?:[^"\\]|\\.)*")')
+    depth = 0
+    start = None
+    for match in TOKEN_PATTERN.finditer(buffer):
+        token = match.group()
+        if token in (b'[', b'{'):
+            depth += 1
+            if depth == 2:
+                start = match.start()
+        elif token in (b']', b'}'):
+            depth -= 1
+            if depth == 1 and start is not None:
+                key_match = key_pattern.search(buffer, start, match.end())
+                if key_match:
+                    yield json.loads(key_match.group(1)).strip(), start, match.end()
+                start = None
+
+
+class LazyCatalog(MutableMapping):
+    """
+    A mapping over a JSON snapshot that only parses the records it is asked for.
+
+    Opening a catalog does no I/O. On first access the snapshot is memory
+    mapped and an index of each record's byte offsets is built, or read from
+    the cache file next to the snapshot if that still matches. Records are
+    parsed into objects on lookup. Added, changed and removed records are
+    kept in memory on top of the snapshot until the next full save.
+
+    Attributes:
+        path (str): The path of the JSON snapshot.
+        key (str): The field that identifies a record, e.g. 'isbn'.
+        from_dict (callable): Builds a model object from a record dictionary.
+        overlay (callable): Returns {key: dict or None} changes to apply on
+            top of the snapshot, e.g. from the journal (optional).
+        merge (callable): Combines the records of a key that appears more
+            than once into one record; the merged record is kept in memory
+            until the next full save. Without it, the last record wins (optional).
+
+    Examples:
+        books = LazyCatalog('books.json', 'isbn', Book.from_dict)
+        book = books.get('978-0062315007')
+    """
+
+    def __init__(self, path, key, from_dict, overlay=None, merge=None):
+        self.path = path
+        self.key = key
+        self.from_dict = from_dict
+        self.overlay = overlay
+        self.merge = merge
+        self._mmap = None
+        self._index = None
+        self._loaded = {}
+        self._removed = set()
+        self._extra = {}
+
+    @property
+    def index_path(self):
+        return self.path + '.idx'
+
+    def _ensure_index(self):
+        if self._index is not None:
+            return
+
+        self._index = {}
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.stat(self.path)
+            entries = self._read_cached_index(stat)
+            if entries is None:
+                entries = list(scan_records(self._mmap, self.key))
+                self._write_cached_index(stat, entries)
+            duplicates = {}
+            for key, start, end in entries:
+                if key in self._index:
+                    duplicates.setdefault(key, [self._index[key]]).append((start, end))
+                self._index[key] = (start, end)
+            if self.merge:
+                for key, spans in duplicates.items():
+                    self._loaded[key] = self.from_dict(self.merge([json.loads(self._mmap[start:end])
+                                                                   for start, end in spans]))
+
+        if self.overlay:
+            for key, data in self.overlay().items():
+                if data is None:
+                    self._discard(key)
+                else:
+                    self._put(key, self.from_dict(data))
+
+    def _read_cached_index(self, stat):
+        try:
+            with open(self.index_path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('size') != stat.st_size or cached.get('mtime_ns') != stat.st_mtime_ns:
+            return None
+        return cached['entries']
+
+    def _write_cached_index(self, stat, entries):
+        try:
+            with open(self.index_path, 'w') as f:
+                json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'entries': entries}, f)
+        except OSError as e:
+            log.warning('lazy_storage.cache_failed', "Could not cache the index of {file}: {error}",
+                        file=self.path, error=e)
+
+    def _parse(self, key):
+        start, end = self._index[key]
+        return self.from_dict(json.loads(self._mmap[start:end]))
+
+    def _put(self, key, obj):
+        self._loaded[key] = obj
+        self._removed.discard(key)
+        if key not in self._index:
+            self._extra[key] = None
+
+    def _discard(self, key):
+        self._loaded.pop(key, None)
+        if key in self._index:
+            self._removed.add(key)
+        else:
+            self._extra.pop(key, None)
+
+    @property
+    def materialized(self):
+        """
+        The number of records currently parsed into objects.
+        """
+
+        return len(self._loaded)
+
+    def __getitem__(self, key):
+        self._ensure_index()
+        obj = self._loaded.get(key)
+        if obj is not None:
+            return obj
+        if key in self._removed or key not in self._index:
+            raise KeyError(key)
+        obj = self._loaded[key] = self._parse(key)
+        return obj
+
+    def __setitem__(self, key, obj):
+        self._ensure_index()
+        self._put(key, obj)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._discard(key)
+
+    def __contains__(self, key):
+        self._ensure_index()
+        return key in self._loaded or (key in self._index and key not in self._removed)
+
+    def __len__(self):
+        self._ensure_index()
+        return len(self._index) - len(self._removed) + len(self._extra)
+
+    def __iter__(self):
+        self._ensure_index()
+        for key in self._index:
+            if key not in self._removed:
+                yield key
+        yield from list(self._extra)
+
+    def values(self):
+        """
+        Yield every object in snapshot order, then the added ones.
+
+        Records that have not been looked up are parsed for the iteration
+        only and not kept, so listing a large catalog does not load it all.
+        """
+
+        for key in self:
+            obj = self._loaded.get(key)
+            yield obj if obj is not None else self._parse(key)
@@ -0,0 +1,186 @@
+import heapq
+import threading
+from datetime import datetime, timedelta
+
+
+class LoanIndex:
+    """
+    An index of the books currently on loan, by ISBN and by user.
+
+    Both directions are plain dictionaries, so finding who has a book or
+    what a user has borrowed takes constant time instead of a scan over
+    every user's borrowed books. A book with several copies can be on loan
+    to several users at once.
+
+    Loans with a due date are also kept in a min-heap ordered by due date,
+    so overdue() and due_within() only visit the k loans they return, at
+    O(log n) each. Returned loans are not removed from the heap right away;
+    they are dropped when they reach the top.
+
+    Attributes:
+        _borrowers (dict): Maps an ISBN on loan to the set of IDs of its borrowers.
+        _loans (dict): Maps a user ID to the set of ISBNs they have on loan.
+        _due (dict): Maps an (ISBN, user ID) loan to its due date, if it has one.
+        _heap (list): (due date, ISBN, user ID) entries, some of them stale.
+
+    Methods:
+        add: Record that a user has borrowed a book.
+        remove: Record that a book has been returned.
+        who_has: Find the users who have a book on loan.
+        loans_for: Find the books a user has on loan.
+        overdue: Find the loans due before a given time.
+        due_within: Find the loans due within a number of days.
+        rebuild: Rebuild the index from the users and cross-check the books.
+
+    Examples:
+        index = LoanIndex()
+        index.add("978-0062315007", "U1001")
+        index.who_has("978-0062315007") # frozenset({'U1001'})
+        index.loans_for("U1001") # frozenset({'978-0062315007'})
+    """
+
+    def __init__(self):
+        self._borrowers = {}
+        self._loans = {}
+        self._due = {}
+        self._heap = []
+        # Callers lock per book and per user; the heap is shared by all of them
+        self._heap_lock = threading.Lock()
+
+    def add(self, isbn, user_id, due=None):
+        """
+        Record that a user has borrowed a copy of a book, replacing any
+        earlier loan of the same book to the same user.
+
+        Parameters:
+            isbn (str): The ISBN of the book.
+            user_id (str): The ID of the borrower.
+            due (datetime): When the book is due back (optional).
+        """
+
+        self.remove(isbn, user_id)
+        self._borrowers.setdefault(isbn, set()).add(user_id)
+        self._loans.setdefault(user_id, set()).add(isbn)
+        if due is not None:
+            self._due[isbn, user_id] = due
+            with self._heap_lock:
+                heapq.heappush(self._heap, (due, isbn, user_id))
+                if len(self._heap) > 2 * len(self._due) + 64:
+                    # Mostly stale entries from returned loans; start afresh
+                    self._heap = [(due, isbn, user_id) for (isbn, user_id), due in list(self._due.items())]
+                    heapq.heapify(self._heap)
+
+    def remove(self, isbn, user_id):
+        """
+        Record that a user has returned their copy of a book.
+
+        Returns:
+            bool: True if the user had the book on loan, False otherwise.
+        """
+
+        self._due.pop((isbn, user_id), None)
+        users = self._borrowers.get(isbn)
+        if users is None or user_id not in users:
+            return False
+        users.discard(user_id)
+        if not users:
+            del self._borrowers[isbn]
+        isbns = self._loans[user_id]
+        isbns.discard(isbn)
+        if not isbns:
+            del self._loans[user_id]
+        return True
+
+    def who_has(self, isbn):
+        """
+        Return the IDs of the users who have a book on loan, as a frozenset.
+        """
+
+        return frozenset(self._borrowers.get(isbn, ()))
+
+    def loans_for(self, user_id):
+        """
+        Return the ISBNs a user has on loan, as a frozenset.
+        """
+
+        return frozenset(self._loans.get(user_id, ()))
+
+    def overdue(self, as_of=None):
+        """
+        Find the loans that were due before a given time.
+
+        Parameters:
+            as_of (datetime): The time to compare against (default: now).
+
+        Returns:
+            list: (ISBN, user ID, due date) tuples, the longest overdue first.
+        """
+
+        return self._due_before(as_of or datetime.now(), inclusive=False)
+
+    def due_within(self, days, as_of=None):
+        """
+        Find the loans due within a number of days, including overdue ones.
+
+        Parameters:
+            days (float): How many days ahead to look.
+            as_of (datetime): The time to count from (default: now).
+
+        Returns:
+            list: (ISBN, user ID, due date) tuples, the earliest due first.
+        """
+
+        return self._due_before((as_of or datetime.now()) + timedelta(days=days), inclusive=True)
+
+    def _due_before(self, cutoff, inclusive):
+        found = []
+        with self._heap_lock:
+            heap = self._heap
+            while heap and (heap[0][0] <= cutoff if inclusive else heap[0][0] < cutoff):
+                due, isbn, user_id = heapq.heappop(heap)
+                # Skip entries for loans that were returned or renewed since
+                if self._due.get((isbn, user_id)) == due:
+                    found.append((isbn, user_id, due))
+            # The loans found are still out; put them back for the next query
+            for isbn, user_id, due in found:
+                heapq.heappush(heap, (due, isbn, user_id))
+        return found
+
+    def rebuild(self, users, books):
+        """
+        Rebuild the index from the users' borrowed books and cross-check it
+        against the books' copy counts.
+
+        Parameters:
+            users (iterable): Every User in the library.
+            books (Mapping): Maps an ISBN to its Book.
+
+        Returns:
+            list: A description of every inconsistency found; empty if none.
+        """
+
+        self._borrowers = {}
+        self._loans = {}
+        self._due = {}
+        self._heap = []
+        problems = []
+        for user in users:
+            for isbn in user.borrowed_books:
+                if isbn not in books:
+                    problems.append(f"User {user.user_id} has borrowed ISBN {isbn}, which is not in the catalog.")
+                dates = user.loan_dates.get(isbn)
+                self.add(isbn, user.user_id, due=datetime.fromisoformat(dates['due']) if dates else None)
+
+        for book in books.values():
+            borrowers = len(self._borrowers.get(book.isbn, ()))
+            if borrowers > book.checked_out:
+                for user_id in sorted(self._borrowers[book.isbn]):
+                    problems.append(f"User {user_id} has borrowed ISBN {book.isbn}, which has "
+                                    f"{book.checked_out} of {book.copies} copies checked out.")
+            elif borrowers < book.checked_out:
+                problems.append(f"ISBN {book.isbn} has {book.checked_out - borrowers} copies checked out "
+                                f"but nobody has borrowed them.")
+        return problems
+
+    def __len__(self):
+        return len(self._borrowers)
@@ -0,0 +1,128 @@
+import contextlib
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+
+class LockTimeout(Exception):
+    """
+    Raised when a lock cannot be acquired in time.
+    """
+
+
+class KeyedLocks:
+    """
+    One lock per key, created on demand and dropped when no longer used.
+
+    Keys are always acquired in sorted order, so two callers that need
+    overlapping sets of keys can never deadlock.
+
+    Methods:
+        hold: Hold the locks for several keys.
+
+    Examples:
+        locks = KeyedLocks()
+        with locks.hold([('book', isbn), ('user', user_id)], timeout=5):
+            ...
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks = {}
+
+    def _checkout(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, key):
+        with self._mutex:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    @contextlib.contextmanager
+    def hold(self, keys, timeout=None):
+        """
+        Hold the locks for several keys, taken in sorted order.
+
+        Parameters:
+            keys (iterable): The keys to lock; they must be mutually comparable.
+            timeout (float): Seconds to wait for each lock (optional).
+
+        Raises:
+            LockTimeout: If a lock could not be acquired in time.
+        """
+
+        held = []
+        try:
+            for key in sorted(set(keys)):
+                lock = self._checkout(key)
+                if not lock.acquire(timeout=-1 if timeout is None else timeout):
+                    self._checkin(key)
+                    raise LockTimeout(f"Timed out waiting for {key}.")
+                held.append((key, lock))
+            yield
+        finally:
+            for key, lock in reversed(held):
+                lock.release()
+                self._checkin(key)
+
+    def __len__(self):
+        with self._mutex:
+            return len(self._locks)
+
+
+class FileLock:
+    """
+    A lock shared by threads in this process and by other processes.
+
+    Threads are serialized with a re-entrant lock. Processes are serialized
+    with an exclusive flock on the lock file, taken by the outermost holder
+    only. On platforms without fcntl, only threads are serialized.
+
+    Attributes:
+        path (str): The path of the lock file.
+
+    Examples:
+        with FileLock('library.lock'):
+            ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            if self._depth == 0 and fcntl is not None:
+                self._file = open(self.path, 'a')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self._close()
+            self._thread_lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            self._close()
+        self._thread_lock.release()
+
+    def _close(self):
+        if self._file is not None:
+            # Closing the file releases the flock
+            self._file.close()
+            self._file = None
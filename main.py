@@ -1,7 +1,54 @@
+import argparse
+import cProfile
+from datetime import datetime
+import os
+import pstats
+import sys
+import batch
+import events
+import metrics
 from book import BookManager
 from user import UserManager
 from check import CheckManager
 from models import Book, User, output_decorator
+from importer import import_books
+from storage import Storage
+
+
+# Records shown before a listing asks whether to go on
+PAGE_SIZE = 20
+
+# Entries in each most-borrowed report
+REPORT_SIZE = 10
+
+
+def show_pages(records, empty_message, page_size=PAGE_SIZE):
+    """
+    Print records a page at a time, asking before each further page.
+
+    Records are drawn from the iterator only as they are printed, so the
+    first page of a large listing appears at once and stopping early never
+    formats the rest.
+
+    Parameters:
+        records (iterable): The records to print, e.g. from iter_books().
+        empty_message (str): Printed if there are no records.
+        page_size (int): The number of records per page.
+
+    Returns:
+        int: The number of records printed.
+    """
+
+    shown = 0
+    for record in records:
+        if shown and shown % page_size == 0:
+            if input(f"-- {shown} shown; press Enter for more or q to stop -- ").strip().lower() == 'q':
+                break
+        print(record)
+        shown += 1
+    if not shown:
+        print(empty_message)
+    return shown
 
 
 @output_decorator
@@ -12,7 +59,8 @@ def book_menu():
     print("2. List Books")
     print("3. Update Book")
     print("4. Delete Book")
-    print("5. Exit")
+    print("5. Search Books")
+    print("6. Exit")
 
 
 @output_decorator
@@ -31,7 +79,67 @@ def check_menu():
     print("\nCheck In/Out Management Menu\n")
     print("1. Check In Book")
     print("2. Check Out Book")
-    print("3. Exit")
+    print("3. Find Borrower")
+    print("4. Overdue Books")
+    print("5. Place Hold")
+    print("6. Loan History")
+    print("7. Exit")
+
+
+@output_decorator
+def report_menu():
+    print("\nReports Menu\n")
+    print("1. Circulation Summary")
+    print("2. Most Borrowed Titles")
+    print("3. Most Borrowed Authors")
+    print("4. Most Active Borrowers")
+    print("5. Exit")
+
+
+def show_ranking(ranking, label):
+    """
+    Print (name, checkouts) pairs as a numbered list.
+    """
+
+    if not ranking:
+        print("\nNo checkouts recorded yet.")
+        return
+    print()
+    for rank, (key, count) in enumerate(ranking, 1):
+        print(f"{rank:>3}. {label(key)} - {count} checkout(s)")
+
+
+def show_history(events):
+    """
+    Print loan history events, one per line, as they are read.
+
+    Returns:
+        int: The number of events shown.
+    """
+
+    shown = 0
+    for event in events:
+        print(f"{event['time'].replace('T', ' ')}  {event['event']:<8}  ISBN {event['isbn']}  user {event['user_id']}")
+        shown += 1
+    if not shown:
+        print("No loan history found.")
+    return shown
+
+
+def show_suggestions(book_manager, user_manager, isbn=None, user_id=None):
+    """
+    After an operation fails, print the ISBNs or user IDs one typo away from
+    any given one that matches nothing in the library.
+    """
+
+    if user_id is not None and user_manager.find_user_by_id(user_id) is None:
+        suggestions = user_manager.suggest_user_ids(user_id)
+        if suggestions:
+            print(f"No user has ID {user_id}. Did you mean {' or '.join(suggestions)}?")
+    if isbn is not None and book_manager.find_book_by_isbn(isbn) is None:
+        suggestions = book_manager.suggest_isbns(isbn)
+        if suggestions:
+            print(f"No book has ISBN {isbn}. Did you mean {' or '.join(suggestions)}?")
 
 
 def main_menu():
@@ -40,6 +148,7 @@ def main_menu():
         print("1. Book Management")
         print("2. User Management")
         print("3. Check Out Management")
+        print("4. Reports")
         choice1 = input("Enter choice: ")
         if choice1 == '1': # Book Management
             book_menu()
@@ -47,6 +156,8 @@ def main_menu():
             user_menu()
         elif choice1 == '3': # Check Out Management
             check_menu()
+        elif choice1 == '4': # Reports
+            report_menu()
         else:
             print("\nIt seems you have entered an invalid option. Please enter an option from the list.\n")
             continue
@@ -54,10 +165,111 @@ def main_menu():
         return (choice1, choice2)
 
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="New World Library Management System.")
+    parser.add_argument('--batch', metavar='OPS_FILE',
+                        help="Run operations from a JSON Lines command file ('-' for stdin) instead of the menus.")
+    parser.add_argument('--output', help="Write batch results to this file (default: stdout).")
+    parser.add_argument('--flush-every', type=int, metavar='N',
+                        help="Persist every N batch operations (default: once at the end).")
+    parser.add_argument('--profile', action='store_true',
+                        help="Time every operation and print the statistics and a cProfile report to standard error on exit.")
+    parser.add_argument('--profile-output', metavar='PATH',
+                        help="With --profile, save the raw cProfile data here for pstats or other viewers.")
+    parser.add_argument('--log-level', default=os.environ.get('LIBRARY_LOG_LEVEL', 'INFO'),
+                        help="The lowest level of event to show: DEBUG, INFO, WARNING or ERROR (default: INFO).")
+    parser.add_argument('--log-format', choices=('text', 'json'), default=os.environ.get('LIBRARY_LOG_FORMAT', 'text'),
+                        help="Show events as plain messages or as JSON lines (default: text).")
+    parser.add_argument('--log-file', default=os.environ.get('LIBRARY_LOG_FILE'),
+                        help="Append events to this file instead of the terminal.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    import_parser = subparsers.add_parser('import', help="Bulk import books from a CSV or JSON Lines feed.")
+    import_parser.add_argument('path', help="Path of the feed to import.")
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], help="Feed format (default: guessed from the extension).")
+    import_parser.add_argument('--batch-size', type=int, default=1000, help="Books persisted per batch (default: 1000).")
+
+    subparsers.add_parser('migrate', help="Merge books listed once per copy into one record per ISBN with copy counts.")
+
+    history_parser = subparsers.add_parser('history', help="Show past checkouts and returns, or maintain the loan history.")
+    history_parser.add_argument('--user', help="Only events for this user ID.")
+    history_parser.add_argument('--isbn', help="Only events for this ISBN.")
+    history_parser.add_argument('--since', type=datetime.fromisoformat, metavar='DATE',
+                                help="Only events at or after this date, e.g. 2024-01-01.")
+    history_parser.add_argument('--until', type=datetime.fromisoformat, metavar='DATE',
+                                help="Only events before this date.")
+    history_parser.add_argument('--compact', action='store_true',
+                                help="Merge the daily segments of past months into monthly ones, then expire old ones.")
+    history_parser.add_argument('--retain-days', type=int, metavar='N',
+                                help="With --compact, delete segments older than N days "
+                                     "(default: LIBRARY_HISTORY_RETENTION_DAYS, or keep everything).")
+
+    return parser.parse_args(argv)
+
+
+def configure_logging(args):
+    """
+    Send the library's events where this run needs them.
+
+    The menus show them on standard output as they happen, between the
+    prompts. A batch run keeps standard output for its results, so events
+    go to standard error, and they are written from a background thread,
+    as they are to a log file.
+    """
+
+    events.configure(level=args.log_level, fmt=args.log_format, path=args.log_file,
+                     stream=sys.stderr if args.batch else sys.stdout,
+                     background=bool(args.batch or args.log_file))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args)
+    if not args.profile:
+        return run(args)
+
+    metrics.enable()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return run(args)
+    finally:
+        profile.disable()
+        print("\nOperation statistics (p50/p99 over each operation's latest calls, see 'window'):", file=sys.stderr)
+        metrics.report(stream=sys.stderr)
+        if args.profile_output:
+            profile.dump_stats(args.profile_output)
+            print(f"\nProfile saved to {args.profile_output}.", file=sys.stderr)
+        else:
+            print("\nProfile, by cumulative time:", file=sys.stderr)
+            pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+
+
+def run(args):
+    if args.command == 'migrate':
+        return 0 if Storage.migrate_copies() else 1
+    if args.command == 'history':
+        history = Storage.open_history()
+        if args.compact:
+            merged = history.compact()
+            expired = history.expire(retention_days=args.retain_days)
+            print(f"Merged {merged} daily segment(s); deleted {expired} expired segment(s).")
+            return
+        show_history(history.events(start=args.since, end=args.until, isbn=args.isbn, user_id=args.user))
+        return
+
     book_manager = BookManager()
+    if args.command == 'import':
+        import_books(book_manager, args.path, fmt=args.format, batch_size=args.batch_size)
+        return
+
     user_manager = UserManager()
     check_manager = CheckManager(book_manager, user_manager)
+    if args.batch:
+        ok = batch.main(book_manager, user_manager, check_manager, args.batch,
+                        output=args.output, flush_every=args.flush_every)
+        return 0 if ok else 1
+
     while True:
         choice1, choice2 = main_menu() # choice1 => Management Menu choice, choice2 => Sub Menu choice
         
@@ -70,23 +282,39 @@ def main():
                 book_manager.add_book(new_book)
         
             elif choice2 == '2': # List Books
+                sort = input("Sort by title, author or isbn (Press Enter for the order added): ").strip().lower()
                 print("\nList of Books:")
-                book_manager.list_books()
+                try:
+                    show_pages(book_manager.iter_books(sort=sort or None),
+                               "No books available. Please add books to the library.")
+                except ValueError as e:
+                    print(e)
             
             elif choice2 == '3': # Update Book
                 isbn = input("Enter ISBN of the book to update: ").strip()
                 title = input("Enter new title (Press Enter to skip): ")
                 author = input("Enter new author (Press Enter to skip): ")
                 new_isbn = input("Enter new ISBN (Press Enter to skip): ").strip()
+                copies = input("Enter number of copies (Press Enter to skip): ").strip()
                 print("\nUpdating the details of the book...")
-                book_manager.update_book(isbn=isbn, title=title, author=author, new_isbn=new_isbn)
+                if not book_manager.update_book(isbn=isbn, title=title, author=author, new_isbn=new_isbn,
+                                                copies=int(copies) if copies.isdigit() else None):
+                    show_suggestions(book_manager, user_manager, isbn=isbn)
             
             elif choice2 == '4': # Delete Book
                 isbn = input("Enter ISBN of the book to delete: ").strip()
                 print("\nDeleting the book...")
-                book_manager.remove_book(isbn)
+                if not book_manager.remove_book(isbn):
+                    show_suggestions(book_manager, user_manager, isbn=isbn)
 
-            elif choice2 == '5':
+            elif choice2 == '5': # Search Books
+                query = input("Enter title or author keywords: ")
+                results = book_manager.search_books(query)
+                print(f"\nFound {len(results)} matching book(s):")
+                for book in results:
+                    print(book)
+
+            elif choice2 == '6':
                 print("\nThank you for visiting the New World Library. Goodbye, Have a nice day!\n")
                 break
 
@@ -100,20 +328,27 @@ def main():
                 user_manager.add_user(new_user)
             
             elif choice2 == '2': # List Users
+                sort = input("Sort by name or user_id (Press Enter for the order added): ").strip().lower()
                 print("\nList of Users:\n")
-                user_manager.list_users()
+                try:
+                    show_pages(user_manager.iter_users(sort=sort or None),
+                               "No users found. Add users to the library.")
+                except ValueError as e:
+                    print(e)
             
             elif choice2 == '3': # Update User
                 user_id = input("Enter user ID of the user to update: ")
                 name = input("Enter new name (Press Enter to skip): ")
                 new_user_id = input("Enter new user ID (Press Enter to skip): ")
                 print("\nUpdating the details of the user...\n")
-                user_manager.update_user(user_id=user_id, name=name, new_user_id=new_user_id)
+                if not user_manager.update_user(user_id=user_id, name=name, new_user_id=new_user_id):
+                    show_suggestions(book_manager, user_manager, user_id=user_id)
             
             elif choice2 == '4': # Delete User
                 user_id = input("Enter user ID of the user to delete: ")
                 print("\nDeleting the user...\n")
-                user_manager.remove_user(user_id)
+                if not user_manager.remove_user(user_id):
+                    show_suggestions(book_manager, user_manager, user_id=user_id)
             
             elif choice2 == '5':
                 print("\nThank you for visiting the New World Library. Goodbye, Have a nice day!\n")
@@ -124,15 +359,72 @@ def main():
                 user_id = input("Enter user ID: ")
                 isbn = input("Enter ISBN of the book to checkout: ").strip()
                 print("\nChecking in a book...")
-                check_manager.return_book(user_id=user_id, isbn=isbn)
+                if not check_manager.return_book(user_id=user_id, isbn=isbn):
+                    show_suggestions(book_manager, user_manager, isbn=isbn, user_id=user_id)
 
             elif choice2 == '2': # Check Out Book
                 user_id = input("Enter user ID: ")
                 isbn = input("Enter ISBN of the book to checkout: ").strip()
                 print("\nChecking out a book...")
-                check_manager.check_out_book(user_id=user_id, isbn=isbn)
+                if not check_manager.check_out_book(user_id=user_id, isbn=isbn):
+                    show_suggestions(book_manager, user_manager, isbn=isbn, user_id=user_id)
         
-            elif choice2 == '3': # Exit
+            elif choice2 == '3': # Find Borrower
+                isbn = input("Enter ISBN of the book: ").strip()
+                user_ids = check_manager.who_has(isbn)
+                if user_ids:
+                    print(f"\nISBN {isbn} is on loan to user(s) {', '.join(sorted(user_ids))}.")
+                else:
+                    print(f"\nISBN {isbn} is not on loan.")
+
+            elif choice2 == '4': # Overdue Books
+                overdue = check_manager.overdue()
+                print(f"\n{len(overdue)} overdue book(s):")
+                for isbn, user_id, due in overdue:
+                    print(f"ISBN {isbn} borrowed by {user_id}, due {due:%Y-%m-%d}")
+
+            elif choice2 == '5': # Place Hold
+                user_id = input("Enter user ID: ")
+                isbn = input("Enter ISBN of the book to hold: ").strip()
+                if not check_manager.place_hold(user_id=user_id, isbn=isbn):
+                    show_suggestions(book_manager, user_manager, isbn=isbn, user_id=user_id)
+
+            elif choice2 == '6': # Loan History
+                user_id = input("Enter user ID (Press Enter for any user): ").strip()
+                isbn = input("Enter ISBN (Press Enter for any book): ").strip()
+                print()
+                show_history(check_manager.loan_history(user_id=user_id or None, isbn=isbn or None))
+
+            elif choice2 == '7': # Exit
+                print("\nThank you for visiting the New World Library. Goodbye, Have a nice day!\n")
+                break
+
+        elif choice1 == '4': # Reports
+            stats = check_manager.stats
+            if choice2 == '1': # Circulation Summary
+                summary = stats.summary()
+                print(f"\nTitles: {summary['titles']}")
+                print(f"Copies: {summary['copies']} ({summary['checked_out']} checked out, "
+                      f"{summary['available']} available)")
+                print(f"Users: {summary['users']} ({summary['borrowers']} with books on loan)")
+                print(f"Open loans: {summary['loans']}")
+
+            elif choice2 == '2': # Most Borrowed Titles
+                def title(isbn):
+                    book = book_manager.find_book_by_isbn(isbn)
+                    return f"{book.title} (ISBN: {isbn})" if book else f"ISBN {isbn} (removed)"
+                show_ranking(stats.top_titles(REPORT_SIZE), title)
+
+            elif choice2 == '3': # Most Borrowed Authors
+                show_ranking(stats.top_authors(REPORT_SIZE), str)
+
+            elif choice2 == '4': # Most Active Borrowers
+                def name(user_id):
+                    user = user_manager.find_user_by_id(user_id)
+                    return f"{user.name} (ID: {user_id})" if user else f"ID {user_id} (removed)"
+                show_ranking(stats.top_borrowers(REPORT_SIZE), name)
+
+            elif choice2 == '5': # Exit
                 print("\nThank you for visiting the New World Library. Goodbye, Have a nice day!\n")
                 break
 
@@ -140,4 +432,4 @@ def main():
             print("\nIt seems you have entered an invalid option. Please enter an option from the list.\n")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
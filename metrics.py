@@ -0,0 +1,153 @@
+import functools
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+
+# Instrumentation is off unless LIBRARY_METRICS=1 or enable() is called
+ENABLED = os.environ.get('LIBRARY_METRICS') == '1'
+
+# Latencies kept per timer for the percentiles; counts, totals and maxima are exact
+SAMPLES = 4096
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+
+
+def enable(on=True):
+    """
+    Turn recording on or off. Data recorded so far is kept.
+    """
+
+    global ENABLED
+    ENABLED = on
+
+
+def reset():
+    """
+    Forget everything recorded so far.
+    """
+
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def add(name, amount=1):
+    """
+    Add to a counter, e.g. the bytes written by a save.
+
+    Parameters:
+        name (str): The counter, e.g. 'storage.bytes_written'.
+        amount (int): How much to add (default: 1).
+    """
+
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + amount
+
+
+def record(name, seconds):
+    """
+    Record one timed call.
+
+    Parameters:
+        name (str): The timer, e.g. 'Storage.save_data'.
+        seconds (float): How long the call took.
+    """
+
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = [0, 0.0, 0.0, deque(maxlen=SAMPLES)]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+        timer[3].append(seconds)
+
+
+def timed(func):
+    """
+    Decorate a function or method so that each call is counted and timed
+    under its qualified name, e.g. 'BookManager.find_book_by_isbn'.
+
+    While instrumentation is disabled the wrapper only checks a flag and
+    calls through.
+    """
+
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def snapshot():
+    """
+    Return the statistics recorded so far.
+
+    The count, total, mean and max cover every call; p50 and p99 are taken
+    over the latest 'window' calls of each timer (at most SAMPLES).
+
+    Returns:
+        dict: {'timers': {name: {'count', 'total', 'mean', 'max', 'window', 'p50', 'p99'}},
+        'counters': {name: value}}, with times in seconds.
+    """
+
+    with _lock:
+        timers = {name: (count, total, longest, sorted(samples))
+                  for name, (count, total, longest, samples) in _timers.items()}
+        counters = dict(_counters)
+    return {
+        'timers': {
+            name: {
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'max': longest,
+                'window': len(ordered),
+                'p50': _percentile(ordered, 0.50),
+                'p99': _percentile(ordered, 0.99),
+            }
+            for name, (count, total, longest, ordered) in sorted(timers.items())
+        },
+        'counters': dict(sorted(counters.items())),
+    }
+
+
+def report(stats=None, stream=None):
+    """
+    Print a snapshot as a table, slowest total first.
+
+    The p50 and p99 columns cover only the latest calls of each timer, as
+    counted in the 'window' column; the other columns cover every call.
+
+    Parameters:
+        stats (dict): A snapshot (default: take one now).
+        stream (file): Where to print (default: standard output).
+    """
+
+    stats = stats or snapshot()
+    stream = stream or sys.stdout
+    print(f"{'operation':<36} {'count':>8} {'total ms':>10} {'max ms':>9} {'window':>8} {'p50 ms':>9} {'p99 ms':>9}",
+          file=stream)
+    for name, timer in sorted(stats['timers'].items(), key=lambda item: -item[1]['total']):
+        print(f"{name:<36} {timer['count']:>8} {timer['total'] * 1000:>10.2f} {timer['max'] * 1000:>9.3f} "
+              f"{timer['window']:>8} {timer['p50'] * 1000:>9.3f} {timer['p99'] * 1000:>9.3f}", file=stream)
+    for name, value in stats['counters'].items():
+        print(f"{name:<36} {value:>8}", file=stream)
@@ -1,19 +1,81 @@
 import functools
 import io
 import sys
+from array import array
+from collections.abc import MutableMapping
+
+
+def copy_counts(data):
+    """
+    Read the copy counts from a book dictionary, in either schema.
+
+    Records written before books had copies carry a single is_checked_out
+    flag; they are read as one copy, checked out or not.
+
+    Parameters:
+        data (dict): A book dictionary.
+
+    Returns:
+        tuple: The number of copies and the number checked out.
+    """
+
+    copies = data.get('copies', 1)
+    checked_out = data.get('checked_out')
+    if checked_out is None:
+        checked_out = copies if data.get('is_checked_out') else 0
+    return copies, checked_out
+
+
+def merge_copies(book_dicts):
+    """
+    Migrate book dictionaries from the flat schema, with one record per copy,
+    to one record per title with copy counts.
+
+    Records sharing an ISBN are merged into the first of them: their copies
+    and checked-out counts are added up, and the first title and author are
+    kept.
+
+    Parameters:
+        book_dicts (iterable): Book dictionaries in either schema.
+
+    Returns:
+        list: One dictionary per ISBN, in order of first appearance.
+    """
+
+    merged = {}
+    for data in book_dicts:
+        isbn = data['isbn'].strip()
+        copies, checked_out = copy_counts(data)
+        title = merged.get(isbn)
+        if title is None:
+            merged[isbn] = {'title': data['title'], 'author': data['author'], 'isbn': isbn,
+                            'copies': copies, 'checked_out': checked_out}
+        else:
+            title['copies'] += copies
+            title['checked_out'] += checked_out
+    return list(merged.values())
+
 
 class Book:
     """
     A class to represent a book in the library.
 
+    A Book is a title record: every copy of a title shares one ISBN, and
+    the book counts how many copies the library owns and how many are
+    checked out, so checking out or returning a copy is a counter update.
+
     Attributes:
         title (str): The title of the book.
         author (str): The author of the book.
         isbn (str): The ISBN of the book.
-        is_checked_out (bool): The status of the book (checked out or not).
+        copies (int): The number of copies the library owns.
+        checked_out (int): The number of copies checked out.
+        available (int): The number of copies on the shelf.
     
     Methods:
         __str__(): Return a string representation of the book.
+        check_out(): Check out one copy.
+        check_in(): Check in one copy.
         to_dict(): Convert the Book object to a dictionary.
         from_dict(data): Create a Book object from a dictionary.
     
@@ -22,40 +84,65 @@ class Book:
         print(new_book)
         # Output: Book: The Alchemist by Paulo Coelho (ISBN: 978-0062315007) - Available
     """
-    def __init__(self, title, author, isbn, is_checked_out=False):
+
+    # No per-instance __dict__; __weakref__ keeps books usable in weak caches
+    __slots__ = ('title', 'author', 'isbn', 'copies', 'checked_out', '__weakref__')
+
+    def __init__(self, title, author, isbn, is_checked_out=False, copies=1, checked_out=None):
         self.title = title
         self.author = author
         self.isbn = isbn.strip()
-        self._is_checked_out = is_checked_out
+        self.copies = copies
+        self.checked_out = checked_out if checked_out is not None else (copies if is_checked_out else 0)
 
     def __str__(self):
-        status = "Checked Out" if self._is_checked_out else "Available"
+        if self.copies == 1:
+            status = "Checked Out" if self._is_checked_out else "Available"
+        else:
+            status = f"{self.available} of {self.copies} copies available"
         return f"Book: {self.title} by {self.author} (ISBN: {self.isbn}) - {status}" 
+
+    @property
+    def available(self):
+        """
+        The number of copies on the shelf.
+        """
+
+        return self.copies - self.checked_out
+
+    @property
+    def _is_checked_out(self):
+        # True once no copy is left on the shelf
+        return self.checked_out >= self.copies
+
+    @_is_checked_out.setter
+    def _is_checked_out(self, value):
+        self.checked_out = self.copies if value else 0
     
     def check_out(self):
         """
-        Mark the book as checked out if it is not already checked out.
+        Check out one copy of the book, if any is on the shelf.
         
         Returns:
-            bool: True if the book was successfully checked out, False otherwise.
+            bool: True if a copy was successfully checked out, False otherwise.
         """
 
-        if not self._is_checked_out:
-            self._is_checked_out = True
+        if self.checked_out < self.copies:
+            self.checked_out += 1
             return True
         return False
     
 
     def check_in(self):
         """
-        Mark the book as checked in if it is currently checked out.
+        Check in one copy of the book, if any is checked out.
         
         Returns:
-            bool: True if the book was successfully checked in, False otherwise.
+            bool: True if a copy was successfully checked in, False otherwise.
         """
         
-        if self._is_checked_out:
-            self._is_checked_out = False
+        if self.checked_out > 0:
+            self.checked_out -= 1
             return True
         return False
     
@@ -72,7 +159,8 @@ class Book:
             'title': self.title,
             'author': self.author,
             'isbn': self.isbn.strip(),
-            'is_checked_out': self._is_checked_out
+            'copies': self.copies,
+            'checked_out': self.checked_out
         }
 
     @staticmethod
@@ -81,17 +169,20 @@ class Book:
         Create a Book object from a dictionary.
 
         Parameters:
-            data (dict): A dictionary containing the book details.
+            data (dict): A dictionary containing the book details, with copy
+                counts or, in the old schema, an is_checked_out flag.
         
         Returns:
             Book: A Book object created from the dictionary
         """
 
+        copies, checked_out = copy_counts(data)
         return Book(
             title=data['title'],
             author=data['author'],
             isbn=data['isbn'].strip(),
-            is_checked_out=data.get('is_checked_out', False)
+            copies=copies,
+            checked_out=checked_out
         )
 
 
@@ -103,6 +194,8 @@ class User:
         name (str): The name of the user.
         user_id (str): The ID of the user.
         borrowed_books (list): A list of books borrowed by the user.
+        loan_dates (dict): Maps the ISBN of a borrowed book to its
+            'checked_out' and 'due' dates, as ISO 8601 strings.
     
     Methods:
         __str__(): Return a string representation of the user.
@@ -116,24 +209,35 @@ class User:
         print(new_user)
         # Output: User: Alice (ID: 12345)
     """
-    def __init__(self, name, user_id, borrowed_books=None):
+
+    __slots__ = ('name', 'user_id', 'borrowed_books', 'loan_dates', '__weakref__')
+
+    def __init__(self, name, user_id, borrowed_books=None, loan_dates=None):
         self.name = name
         self.user_id = user_id
         self.borrowed_books = borrowed_books if borrowed_books is not None else []
+        self.loan_dates = loan_dates if loan_dates is not None else {}
 
     def __str__(self):
         borrowed_books_str = ', '.join(self.borrowed_books) if self.borrowed_books else "No books borrowed"
         return f"User: {self.name} (ID: {self.user_id}) - Borrowed Books: {borrowed_books_str}"
 
-    def borrow_book(self, book):
+    def borrow_book(self, book, checked_out=None, due=None):
         """
         Add the book's ISBN to the user's borrowed books list.
         
         :param book: Book object to be borrowed.
+        :param checked_out: When the loan started, as a datetime (optional).
+        :param due: When the book is due back, as a datetime (optional).
         :return: True if the book is successfully borrowed, False otherwise.
         """
         if book.isbn not in self.borrowed_books:
             self.borrowed_books.append(book.isbn)
+            if due is not None:
+                self.loan_dates[book.isbn] = {
+                    'checked_out': checked_out.isoformat() if checked_out else None,
+                    'due': due.isoformat(),
+                }
             return True
         return False
     
@@ -149,6 +253,7 @@ class User:
         """
         if book.isbn in self.borrowed_books:
             self.borrowed_books.remove(book.isbn)
+            self.loan_dates.pop(book.isbn, None)
             return True
         return False
 
@@ -163,7 +268,8 @@ class User:
         return {
             'name': self.name,
             'user_id': self.user_id,
-            'borrowed_books': self.borrowed_books
+            'borrowed_books': self.borrowed_books,
+            'loan_dates': self.loan_dates,
         }
 
     @staticmethod
@@ -181,10 +287,199 @@ class User:
         return User(
             name=data['name'],
             user_id=data['user_id'],
-            borrowed_books=data.get('borrowed_books', [])
+            borrowed_books=data.get('borrowed_books', []),
+            loan_dates=data.get('loan_dates', {})
         )
 
 
+class BookView(Book):
+    """
+    A Book backed by one row of a BookTable.
+
+    Reading or assigning title, author, isbn or the copy counts goes
+    straight to the table's columns, so a view behaves like a Book without
+    holding any data of its own.
+
+    Attributes:
+        _table (BookTable): The table holding the data.
+        _row (int): The row of the book in the table.
+    """
+
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    @property
+    def title(self):
+        return self._table._titles[self._row]
+
+    @title.setter
+    def title(self, value):
+        self._table._titles[self._row] = value
+
+    @property
+    def author(self):
+        return self._table._authors[self._row]
+
+    @author.setter
+    def author(self, value):
+        self._table._authors[self._row] = sys.intern(value)
+
+    @property
+    def isbn(self):
+        return self._table._isbns[self._row]
+
+    @isbn.setter
+    def isbn(self, value):
+        self._table._rename(self._row, value.strip())
+
+    @property
+    def copies(self):
+        return self._table._copies[self._row]
+
+    @copies.setter
+    def copies(self, value):
+        self._table._copies[self._row] = value
+
+    @property
+    def checked_out(self):
+        return self._table._checked_out[self._row]
+
+    @checked_out.setter
+    def checked_out(self, value):
+        self._table._checked_out[self._row] = value
+
+
+class BookTable(MutableMapping):
+    """
+    A columnar store of books, mapping ISBN to a Book-compatible view.
+
+    Titles, authors and ISBNs are kept in parallel lists, with authors
+    interned since many books share one. The copy counts are packed into
+    two arrays of 16-bit integers. Removing a book leaves a hole in the columns, so views
+    already handed out stay valid; call compact() to reclaim the holes once
+    no views are in use.
+
+    Attributes:
+        _titles (list): The title of each row.
+        _authors (list): The interned author of each row.
+        _isbns (list): The ISBN of each row.
+        _copies (array): The number of copies of each row.
+        _checked_out (array): The number of copies of each row checked out.
+        _rows (dict): Maps the ISBN of each live book to its row.
+
+    Methods:
+        from_dicts: Build a table from book dictionaries.
+        compact: Drop the rows of removed books.
+
+    Examples:
+        table = BookTable([Book("The Alchemist", "Paulo Coelho", "978-0062315007")])
+        book = table["978-0062315007"]
+        book.check_out()
+    """
+
+    def __init__(self, books=()):
+        self._titles = []
+        self._authors = []
+        self._isbns = []
+        self._copies = array('H')
+        self._checked_out = array('H')
+        self._rows = {}
+        for book in books:
+            self[book.isbn] = book
+
+    @staticmethod
+    def from_dicts(book_dicts):
+        """
+        Build a table from book dictionaries without creating Book objects.
+
+        Parameters:
+            book_dicts (iterable): Dictionaries as produced by Book.to_dict().
+
+        Returns:
+            BookTable: The new table.
+        """
+
+        table = BookTable()
+        for data in book_dicts:
+            table._append(data['title'], data['author'], data['isbn'].strip(), *copy_counts(data))
+        return table
+
+    def _append(self, title, author, isbn, copies, checked_out):
+        self._titles.append(title)
+        self._authors.append(sys.intern(author))
+        self._isbns.append(isbn)
+        self._copies.append(copies)
+        self._checked_out.append(checked_out)
+        self._rows[isbn] = len(self._isbns) - 1
+
+    def _is_live(self, row):
+        return self._rows.get(self._isbns[row]) == row
+
+    def _rename(self, row, isbn):
+        # A live row is re-keyed; a removed row keeps its hole until re-added
+        if self._is_live(row):
+            del self._rows[self._isbns[row]]
+            self._rows[isbn] = row
+        self._isbns[row] = isbn
+
+    def __getitem__(self, isbn):
+        return BookView(self, self._rows[isbn])
+
+    def __setitem__(self, isbn, book):
+        if isinstance(book, BookView) and book._table is self:
+            # Re-adding one of our own views, e.g. after an ISBN change
+            self._isbns[book._row] = isbn
+            self._rows[isbn] = book._row
+            return
+
+        row = self._rows.get(isbn)
+        if row is None:
+            self._append(book.title, book.author, isbn, book.copies, book.checked_out)
+        else:
+            self._titles[row] = book.title
+            self._authors[row] = sys.intern(book.author)
+            self._copies[row] = book.copies
+            self._checked_out[row] = book.checked_out
+
+    def __delitem__(self, isbn):
+        del self._rows[isbn]
+
+    def __contains__(self, isbn):
+        return isbn in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        for row, isbn in enumerate(self._isbns):
+            if self._rows.get(isbn) == row:
+                yield isbn
+
+    def values(self):
+        """
+        Yield a view of every book in insertion order.
+        """
+
+        for row, isbn in enumerate(self._isbns):
+            if self._rows.get(isbn) == row:
+                yield BookView(self, row)
+
+    def compact(self):
+        """
+        Drop the rows of removed books. Views handed out earlier become invalid.
+        """
+
+        live = [row for row in range(len(self._isbns)) if self._is_live(row)]
+        columns = [(self._titles[row], self._authors[row], self._isbns[row], self._copies[row], self._checked_out[row])
+                   for row in live]
+        self.__init__()
+        for column in columns:
+            self._append(*column)
+
+
 def output_decorator(func):
     """
     A decorator that adds a border around the output of a function.
@@ -0,0 +1,230 @@
+import bisect
+import re
+from collections import defaultdict
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# A title match is a stronger signal than an author match
+FIELD_WEIGHTS = {'title': 2.0, 'author': 1.0}
+
+# Matching a whole word counts for more than matching its prefix
+EXACT_MATCH_BONUS = 2.0
+
+
+def tokenize(text):
+    """
+    Split text into case-folded word tokens.
+
+    Parameters:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: The tokens in order of appearance.
+
+    Examples:
+        tokenize("The Alchemist") # ['the', 'alchemist']
+    """
+
+    return TOKEN_PATTERN.findall(text.casefold()) if text else []
+
+
+class SearchIndex:
+    """
+    An inverted index over book titles and authors.
+
+    Every token maps to the ISBNs whose title or author contains it, and the
+    distinct tokens are kept sorted so that a query term can also match as a
+    prefix. The index is updated one book at a time.
+
+    Attributes:
+        _postings (dict): Maps a token to {isbn: score contribution}.
+        _tokens (list): The distinct tokens, sorted for prefix lookups.
+        _documents (dict): Maps an ISBN to the tokens indexed for it.
+
+    Methods:
+        add: Index a book, replacing any earlier entry for its ISBN.
+        remove: Drop a book from the index.
+        search: Find ISBNs matching every term of a query, best first.
+
+    Examples:
+        index = SearchIndex()
+        index.add(Book("The Alchemist", "Paulo Coelho", "978-0062315007"))
+        index.search("alch coelho") # ['978-0062315007']
+    """
+
+    def __init__(self, books=()):
+        self._postings = defaultdict(dict)
+        self._tokens = []
+        self._documents = {}
+        for book in books:
+            self.add(book)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, book):
+        """
+        Index a book, replacing any earlier entry for its ISBN.
+
+        Parameters:
+            book (Book): The book to index.
+        """
+
+        self.remove(book.isbn)
+
+        weights = defaultdict(float)
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(getattr(book, field)):
+                weights[token] += weight
+
+        for token, weight in weights.items():
+            postings = self._postings[token]
+            if not postings:
+                bisect.insort(self._tokens, token)
+            postings[book.isbn] = weight
+        self._documents[book.isbn] = tuple(weights)
+
+    def remove(self, isbn):
+        """
+        Drop a book from the index.
+
+        Parameters:
+            isbn (str): The ISBN of the book to drop.
+
+        Returns:
+            bool: True if the book was indexed, False otherwise.
+        """
+
+        tokens = self._documents.pop(isbn, None)
+        if tokens is None:
+            return False
+
+        for token in tokens:
+            postings = self._postings[token]
+            postings.pop(isbn, None)
+            if not postings:
+                del self._postings[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+        return True
+
+    def _matches(self, term):
+        # Scores for every ISBN with a token equal to, or starting with, the term
+        scores = defaultdict(float)
+        position = bisect.bisect_left(self._tokens, term)
+        while position < len(self._tokens) and self._tokens[position].startswith(term):
+            token = self._tokens[position]
+            bonus = EXACT_MATCH_BONUS if token == term else 1.0
+            for isbn, weight in self._postings[token].items():
+                scores[isbn] = max(scores[isbn], weight * bonus)
+            position += 1
+        return scores
+
+    def search(self, query, limit=None):
+        """
+        Find ISBNs matching every term of a query, best first.
+
+        Each term matches whole words and word prefixes in the title and
+        author. Results are ranked by the summed score of their terms.
+
+        Parameters:
+            query (str): The search terms.
+            limit (int): The maximum number of results (optional).
+
+        Returns:
+            list: The matching ISBNs, best match first.
+        """
+
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+
+        # Intersect starting from the rarest term to keep the candidate set small
+        matches = sorted((self._matches(term) for term in terms), key=len)
+        scores = dict(matches[0])
+        for term_scores in matches[1:]:
+            scores = {isbn: score + term_scores[isbn] for isbn, score in scores.items() if isbn in term_scores}
+            if not scores:
+                return []
+
+        ranked = sorted(scores, key=lambda isbn: (-scores[isbn], isbn))
+        return ranked[:limit] if limit is not None else ranked
+
+
+class SortedIndex:
+    """
+    Record keys kept in the order of a sort key, for sorted listings.
+
+    Entries are (sort key, record key) pairs in a sorted list, so adding or
+    removing a record is a binary search plus one list insertion, and a
+    listing can start right after any record without sorting or scanning.
+
+    Attributes:
+        sort_key (callable): Maps a record to its sort key.
+        _entries (list): The sorted (sort key, record key) pairs.
+        _sort_keys (dict): Maps each record key to its sort key.
+
+    Methods:
+        add: Index a record, replacing any earlier entry for its key.
+        remove: Drop a record from the index.
+        keys: Yield the record keys in order.
+
+    Examples:
+        index = SortedIndex(lambda book: book.title.casefold())
+        index.add("978-0062315007", Book("The Alchemist", "Paulo Coelho", "978-0062315007"))
+        list(index.keys()) # ['978-0062315007']
+    """
+
+    def __init__(self, sort_key, records=()):
+        self.sort_key = sort_key
+        self._sort_keys = {key: sort_key(record) for key, record in records}
+        self._entries = sorted((sort_key, key) for key, sort_key in self._sort_keys.items())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, record):
+        """
+        Index a record, replacing any earlier entry for its key.
+        """
+
+        self.remove(key)
+        sort_key = self._sort_keys[key] = self.sort_key(record)
+        bisect.insort(self._entries, (sort_key, key))
+
+    def remove(self, key):
+        """
+        Drop a record from the index.
+
+        Returns:
+            bool: True if the record was indexed, False otherwise.
+        """
+
+        sort_key = self._sort_keys.pop(key, None)
+        if sort_key is None:
+            return False
+        del self._entries[bisect.bisect_left(self._entries, (sort_key, key))]
+        return True
+
+    def keys(self, after=None):
+        """
+        Yield the record keys in order.
+
+        Each step looks up the entry after the last one yielded, so records
+        added or removed while a listing is paused are neither repeated nor
+        skipped.
+
+        Parameters:
+            after: Start right after the record with this key (optional).
+
+        Raises:
+            KeyError: If after is given but not indexed.
+        """
+
+        entry = (self._sort_keys[after], after) if after is not None else None
+        while True:
+            position = bisect.bisect_right(self._entries, entry) if entry is not None else 0
+            if position >= len(self._entries):
+                return
+            entry = self._entries[position]
+            yield entry[1]
@@ -0,0 +1,431 @@
+import argparse
+import asyncio
+import events
+import json
+import metrics
+import os
+import sys
+from urllib.parse import parse_qs, unquote, urlsplit
+from book import BookManager
+from check import CheckManager
+from models import Book, User
+from storage import Storage, StorageError
+from user import UserManager
+
+
+log = events.EventLogger('server')
+
+STATUS_TEXT = {
+    200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 409: 'Conflict', 500: 'Internal Server Error',
+}
+
+
+class HTTPError(Exception):
+    """
+    An error to report to the client with the given status code, and any
+    details to add to the response, e.g. suggestions.
+    """
+
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+class LibraryServer:
+    """
+    An asyncio HTTP/JSON front-end over the library managers.
+
+    Requests are handled one at a time on the event loop, and every handler
+    runs to completion without awaiting, so mutations never interleave.
+    Handlers do no disk I/O and never wait for the write lock: commits are
+    held back with Storage.deferred(), and a background writer serializes
+    them between requests and writes them on a worker thread, followed by
+    the loan history events. Requests therefore never wait for a save.
+
+    The SQLite backend is not supported: its tables are changed by the
+    handlers on the event loop while the writer commits or rolls back the
+    same connection on the worker thread, so a failed write could discard
+    changes that were already acknowledged.
+
+    Routes:
+        GET    /books[?q=terms]      List books, or search titles and authors.
+               /books?sort=title&limit=50&after={isbn}
+                                     List a page of books, sorted by title, author or
+                                     isbn, starting after a cursor (or an offset).
+        GET    /books/{isbn}         Get one book.
+        POST   /books                Add a book: {"title", "author", "isbn", "copies"}.
+        PATCH  /books/{isbn}         Update a book: {"title", "author", "new_isbn", "copies"}.
+        DELETE /books/{isbn}         Remove a book.
+        GET    /users                List users; takes sort (name or user_id), limit,
+                                     offset and after like /books.
+        GET    /users/{user_id}      Get one user.
+        POST   /users                Add a user: {"name", "user_id"}.
+        PATCH  /users/{user_id}      Update a user: {"name", "new_user_id"}.
+        DELETE /users/{user_id}      Remove a user.
+        POST   /checkouts            Check out a book: {"user_id", "isbn"}.
+        POST   /returns              Return a book: {"user_id", "isbn"}.
+        POST   /holds                Place a hold on a book: {"user_id", "isbn"}.
+        GET    /stats                The operation statistics, if metrics are enabled.
+        GET    /reports[?k=10]       Circulation totals and the k most borrowed titles,
+                                     authors and borrowers.
+
+    Attributes:
+        book_manager (BookManager): The book manager.
+        user_manager (UserManager): The user manager.
+        check_manager (CheckManager): The check manager.
+        flush_interval (float): Seconds the writer waits to batch up commits.
+
+    Examples:
+        server = LibraryServer(BookManager(), UserManager(), CheckManager(...))
+        asyncio.run(server.serve('127.0.0.1', 8080))
+    """
+
+    def __init__(self, book_manager, user_manager, check_manager, flush_interval=0.05):
+        self.book_manager = book_manager
+        self.user_manager = user_manager
+        self.check_manager = check_manager
+        self.flush_interval = flush_interval
+        self._server = None
+        self._writer_task = None
+        self._dirty = None
+        self._deferral = None
+        self._unwritten = []
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """
+        Start listening and start the background writer.
+
+        Returns:
+            asyncio.Server: The listening server; port 0 picks a free port.
+
+        Raises:
+            StorageError: If the SQLite backend is selected.
+        """
+
+        if Storage.BACKEND == 'sqlite':
+            raise StorageError("The HTTP service does not support the SQLite backend; use LIBRARY_BACKEND=json.")
+        # Built while every checkout is still in the history files, before events are queued
+        self.check_manager.stats
+        self._deferral = Storage.deferred()
+        self._deferral.__enter__()
+        self.check_manager.history.deferred = True
+        self._dirty = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._write_behind())
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def close(self):
+        """
+        Stop accepting requests and persist everything still pending.
+        """
+
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._writer_task:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+        await self._write_pending()
+        self._deferral.__exit__(None, None, None)
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        """
+        Serve until cancelled, then persist everything still pending.
+        """
+
+        server = await self.start(host, port)
+        print(f"Serving the library on http://{host}:{server.sockets[0].getsockname()[1]}")
+        try:
+            await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def _write_behind(self):
+        while True:
+            await self._dirty.wait()
+            # Let a burst of requests accumulate into one write
+            await asyncio.sleep(self.flush_interval)
+            self._dirty.clear()
+            await self._write_pending()
+
+    async def _write_pending(self):
+        prepared = Storage.take_deferred()
+        if prepared:
+            self._unwritten.append(prepared)
+        while self._unwritten:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, Storage.write_prepared, self._unwritten[0])
+            except StorageError as e:
+                # Keep the batch, in order, and retry on the next round
+                log.error('server.write_failed', "Background write failed: {error}", error=e)
+                self._dirty.set()
+                return
+            self._unwritten.pop(0)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.check_manager.history.flush)
+        except OSError as e:
+            # The events stay queued; retry on the next round
+            log.error('server.write_failed', "Background write failed: {error}", error=e)
+            self._dirty.set()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, HTTPError):
+                    # The rest of the request cannot be framed, so the connection is closed
+                    self._write_response(writer, request.status, {'error': str(request)}, False)
+                    await writer.drain()
+                    break
+                method, target, headers, body = request
+                status, payload = self.dispatch(method, target, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            return HTTPError(400, "Malformed request line.")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get('content-length') or '0'
+        if not length.isdigit():
+            return HTTPError(400, "Content-Length must be a non-negative integer.")
+        length = int(length)
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    def _write_response(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        head = (f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+
+    def dispatch(self, method, target, body):
+        """
+        Handle one request.
+
+        Parameters:
+            method (str): The HTTP method.
+            target (str): The request target, e.g. '/books/978-0451524935'.
+            body (bytes): The request body.
+
+        Returns:
+            tuple: The status code and the JSON-serializable response.
+        """
+
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        try:
+            data = json.loads(body) if body else {}
+            if not isinstance(data, dict):
+                raise HTTPError(400, "Request body must be a JSON object.")
+            status, payload = self._route(method, parts, parse_qs(url.query), data)
+        except HTTPError as e:
+            return e.status, {'error': str(e), **e.details}
+        except json.JSONDecodeError:
+            return 400, {'error': "Request body is not valid JSON."}
+        except KeyError as e:
+            return 400, {'error': f"Missing field {e}."}
+        except Exception as e:
+            log.error('server.request_failed', "Error handling {method} {target}: {error}",
+                      method=method, target=target, error=e)
+            return 500, {'error': "Internal server error."}
+
+        # Only a mutation that succeeded has anything for the writer to save
+        if method != 'GET' and status < 300:
+            self._dirty.set()
+        return status, payload
+
+    def _route(self, method, parts, query, data):
+        if not parts or parts[0] not in ('books', 'users', 'checkouts', 'returns', 'holds', 'stats', 'reports'):
+            raise HTTPError(404, "Not found.")
+        resource = parts[0]
+        key = parts[1] if len(parts) == 2 else None
+        if len(parts) > 2:
+            raise HTTPError(404, "Not found.")
+
+        if resource == 'books':
+            return self._books(method, key, query, data)
+        if resource == 'users':
+            return self._users(method, key, query, data)
+        if resource == 'stats':
+            if method != 'GET' or key:
+                raise HTTPError(405, "Use GET.")
+            return 200, metrics.snapshot()
+        if resource == 'reports':
+            if method != 'GET' or key:
+                raise HTTPError(405, "Use GET.")
+            return 200, self._reports(query)
+        if method != 'POST' or key:
+            raise HTTPError(405, "Use POST.")
+        self._validate(data, strings=('user_id', 'isbn'))
+        if resource == 'checkouts':
+            ok = self.check_manager.check_out_book(user_id=data['user_id'], isbn=data['isbn'])
+        elif resource == 'holds':
+            ok = self.check_manager.place_hold(user_id=data['user_id'], isbn=data['isbn'])
+        else:
+            ok = self.check_manager.return_book(user_id=data['user_id'], isbn=data['isbn'])
+        return self._result(ok, 200)
+
+    def _books(self, method, isbn, query, data):
+        manager = self.book_manager
+        if isbn is None:
+            if method == 'GET':
+                if 'q' in query:
+                    return 200, [book.to_dict() for book in manager.search_books(query['q'][0])]
+                try:
+                    return 200, [book.to_dict() for book in manager.iter_books(**self._paging(query))]
+                except ValueError as e:
+                    raise HTTPError(400, str(e))
+            if method == 'POST':
+                self._validate(data, strings=('title', 'author', 'isbn'), counts=('copies',))
+                book = Book(title=data['title'], author=data['author'], isbn=data['isbn'],
+                            copies=data.get('copies', 1))
+                if not manager.add_book(book):
+                    raise HTTPError(409, f"Book with ISBN {data['isbn']} already exists.")
+                return 201, book.to_dict()
+            raise HTTPError(405, "Use GET or POST.")
+
+        book = manager.find_book_by_isbn(isbn)
+        if method in ('GET', 'PATCH', 'DELETE') and not book:
+            raise HTTPError(404, f"Book with ISBN {isbn} not found.", suggestions=manager.suggest_isbns(isbn))
+        if method == 'GET':
+            return 200, book.to_dict()
+        if method == 'PATCH':
+            self._validate(data, strings=('title', 'author', 'new_isbn'), counts=('copies',))
+            ok = manager.update_book(isbn, title=data.get('title'), author=data.get('author'),
+                                     new_isbn=data.get('new_isbn'), copies=data.get('copies'))
+            return self._result(ok, 200)
+        if method == 'DELETE':
+            return self._result(manager.remove_book(isbn), 200)
+        raise HTTPError(405, "Use GET, PATCH or DELETE.")
+
+    def _users(self, method, user_id, query, data):
+        manager = self.user_manager
+        if user_id is None:
+            if method == 'GET':
+                try:
+                    return 200, [user.to_dict() for user in manager.iter_users(**self._paging(query))]
+                except ValueError as e:
+                    raise HTTPError(400, str(e))
+            if method == 'POST':
+                self._validate(data, strings=('name', 'user_id'))
+                user = User(name=data['name'], user_id=data['user_id'])
+                if not manager.add_user(user):
+                    raise HTTPError(409, f"User with ID {user.user_id} already exists.")
+                return 201, user.to_dict()
+            raise HTTPError(405, "Use GET or POST.")
+
+        user = manager.find_user_by_id(user_id)
+        if method in ('GET', 'PATCH', 'DELETE') and not user:
+            raise HTTPError(404, f"User with ID {user_id} not found.", suggestions=manager.suggest_user_ids(user_id))
+        if method == 'GET':
+            return 200, user.to_dict()
+        if method == 'PATCH':
+            self._validate(data, strings=('name', 'new_user_id'))
+            return self._result(manager.update_user(user_id, name=data.get('name'),
+                                                    new_user_id=data.get('new_user_id')), 200)
+        if method == 'DELETE':
+            return self._result(manager.remove_user(user_id), 200)
+        raise HTTPError(405, "Use GET, PATCH or DELETE.")
+
+    def _reports(self, query):
+        try:
+            k = int(query.get('k', ['10'])[0])
+        except ValueError:
+            raise HTTPError(400, "k must be an integer.")
+        stats = self.check_manager.stats
+        return {
+            'summary': stats.summary(),
+            'top_titles': [{'isbn': isbn, 'checkouts': count} for isbn, count in stats.top_titles(k)],
+            'top_authors': [{'author': author, 'checkouts': count} for author, count in stats.top_authors(k)],
+            'top_borrowers': [{'user_id': user_id, 'checkouts': count} for user_id, count in stats.top_borrowers(k)],
+        }
+
+    def _paging(self, query):
+        # The listing parameters shared by GET /books and GET /users
+        try:
+            limit = int(query['limit'][0]) if 'limit' in query else None
+            offset = int(query['offset'][0]) if 'offset' in query else 0
+        except ValueError:
+            raise HTTPError(400, "limit and offset must be integers.")
+        return {'sort': query.get('sort', [None])[0], 'offset': offset, 'limit': limit,
+                'after': query.get('after', [None])[0]}
+
+    @staticmethod
+    def _validate(data, strings=(), counts=()):
+        # The fields given must have the right types before they reach the
+        # managers; missing required fields are reported by the handlers
+        for field in strings:
+            if field in data and not (isinstance(data[field], str) and data[field].strip()):
+                raise HTTPError(400, f"{field} must be a non-empty string.")
+        for field in counts:
+            if field in data and not (type(data[field]) is int and data[field] >= 1):
+                raise HTTPError(400, f"{field} must be a positive integer.")
+
+    def _result(self, ok, status):
+        if not ok:
+            raise HTTPError(409, "The operation could not be completed.")
+        return status, {'ok': True}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the library over HTTP/JSON.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--flush-interval', type=float, default=0.05,
+                        help="Seconds to batch commits before writing them (default: 0.05).")
+    parser.add_argument('--metrics', action='store_true', help="Time every operation; see GET /stats.")
+    parser.add_argument('--log-level', default=os.environ.get('LIBRARY_LOG_LEVEL', 'WARNING'),
+                        help="The lowest level of event to log (default: WARNING).")
+    parser.add_argument('--log-format', choices=('text', 'json'), default=os.environ.get('LIBRARY_LOG_FORMAT', 'json'),
+                        help="Log events as text or as JSON lines (default: json).")
+    parser.add_argument('--log-file', help="Append events to this file instead of standard error.")
+    args = parser.parse_args(argv)
+    if Storage.BACKEND == 'sqlite':
+        parser.error("the HTTP service does not support LIBRARY_BACKEND=sqlite; use the JSON backend.")
+    if args.metrics:
+        metrics.enable()
+    # Events are written by a listener thread, never by the event loop
+    events.configure(level=args.log_level, fmt=args.log_format, path=args.log_file, stream=sys.stderr)
+
+    book_manager = BookManager()
+    user_manager = UserManager()
+    server = LibraryServer(book_manager, user_manager, CheckManager(book_manager, user_manager),
+                           flush_interval=args.flush_interval)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
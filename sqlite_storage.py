@@ -0,0 +1,460 @@
+import argparse
+import json
+import os
+import sqlite3
+import weakref
+from collections.abc import MutableMapping
+from holds import HoldQueue
+from identifiers import normalize_isbn, single_edits
+from models import Book, User, merge_copies
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    isbn TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    copies INTEGER NOT NULL DEFAULT 1,
+    checked_out INTEGER NOT NULL DEFAULT 0,
+    isbn_key TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_books_title ON books (title);
+CREATE INDEX IF NOT EXISTS idx_books_author ON books (author);
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS loans (
+    isbn TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    checked_out_at TEXT,
+    due_date TEXT,
+    PRIMARY KEY (isbn, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_loans_user_id ON loans (user_id);
+
+CREATE TABLE IF NOT EXISTS holds (
+    isbn TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (isbn, user_id)
+);
+"""
+
+# Columns added to existing tables since the first release, applied on open.
+# Databases from before copy counts have a single is_checked_out flag per book.
+MIGRATIONS = {
+    'books': [
+        ('copies', "ALTER TABLE books ADD COLUMN copies INTEGER NOT NULL DEFAULT 1"),
+        ('checked_out', "ALTER TABLE books ADD COLUMN checked_out INTEGER NOT NULL DEFAULT 0;"
+                        "UPDATE books SET checked_out = is_checked_out"),
+        ('isbn_key', "ALTER TABLE books ADD COLUMN isbn_key TEXT"),
+    ],
+    'loans': [
+        ('checked_out_at', "ALTER TABLE loans ADD COLUMN checked_out_at TEXT"),
+        ('due_date', "ALTER TABLE loans ADD COLUMN due_date TEXT"),
+    ],
+}
+
+# Before copy counts, a book could only be on loan to one user at a time
+REKEY_LOANS = """
+ALTER TABLE loans RENAME TO loans_single_copy;
+CREATE TABLE loans (
+    isbn TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    checked_out_at TEXT,
+    due_date TEXT,
+    PRIMARY KEY (isbn, user_id)
+);
+INSERT INTO loans (isbn, user_id, checked_out_at, due_date)
+    SELECT isbn, user_id, checked_out_at, due_date FROM loans_single_copy ORDER BY rowid;
+DROP TABLE loans_single_copy;
+CREATE INDEX IF NOT EXISTS idx_loans_user_id ON loans (user_id);
+"""
+
+# Created after the migrations, since they may index migrated columns
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_loans_due_date ON loans (due_date);
+CREATE INDEX IF NOT EXISTS idx_books_isbn_key ON books (isbn_key);
+"""
+
+# Candidate ISBNs looked up per query when suggesting; below SQLite's oldest variable limit
+PROBE_BATCH = 500
+
+
+class SQLiteTable(MutableMapping):
+    """
+    A mapping from primary key to model object, backed by one SQLite table.
+
+    Lookups, membership tests and listings are indexed queries; nothing is
+    loaded up front. Objects that are currently in use are kept in a weak
+    identity map, so looking the same key up twice returns the same object.
+    Writes go straight to the database and become durable when the store
+    commits.
+
+    Attributes:
+        store (SQLiteStore): The store that owns the connection.
+        table (str): The name of the table, either 'books' or 'users'.
+        key (str): The primary key column.
+    """
+
+    def __init__(self, store, table, key):
+        self.store = store
+        self.table = table
+        self.key = key
+        self._cache = weakref.WeakValueDictionary()
+
+    def _materialize(self, row):
+        obj = self._cache.get(row[0])
+        if obj is None:
+            obj = self.store.row_to_object(self.table, row)
+            self._cache[row[0]] = obj
+        return obj
+
+    def _select(self, where='', params=()):
+        columns = self.store.COLUMNS[self.table]
+        return self.store.conn.execute(
+            f"SELECT {', '.join(columns)} FROM {self.table} {where}", params)
+
+    def __getitem__(self, key):
+        obj = self._cache.get(key)
+        if obj is not None:
+            return obj
+        row = self._select(f"WHERE {self.key} = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._materialize(row)
+
+    def __setitem__(self, key, obj):
+        self.store.write(self.table, {key: obj})
+        self._cache[key] = obj
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.store.write(self.table, {key: None})
+        self._cache.pop(key, None)
+
+    def __contains__(self, key):
+        return self.store.conn.execute(
+            f"SELECT 1 FROM {self.table} WHERE {self.key} = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        for (key,) in self.store.conn.execute(f"SELECT {self.key} FROM {self.table} ORDER BY rowid"):
+            yield key
+
+    def __len__(self):
+        return self.store.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def __bool__(self):
+        return self.store.conn.execute(f"SELECT 1 FROM {self.table} LIMIT 1").fetchone() is not None
+
+    def values(self):
+        """
+        Yield every object in insertion order, streaming rows from the database.
+        """
+
+        for row in self._select("ORDER BY rowid"):
+            yield self._materialize(row)
+
+
+class SQLiteISBNIndex:
+    """
+    The IdentifierIndex of the books table: each book's normalized ISBN is
+    kept in an indexed column, so resolving another form of an ISBN or
+    suggesting near-misses is a query, and no ISBN is loaded up front.
+
+    The column is written with the row, so add() and remove() do nothing.
+    Substitutions and insertions for suggestions use the digits, X and
+    the characters of the identifier itself.
+
+    Attributes:
+        store (SQLiteStore): The store that owns the connection.
+    """
+
+    ALPHABET = frozenset('0123456789X')
+
+    def __init__(self, store):
+        self.store = store
+
+    def add(self, key):
+        pass
+
+    def remove(self, key):
+        pass
+
+    def duplicates(self):
+        """
+        Yield (isbn, existing) for every book whose ISBN is another form of
+        one stored earlier, which lookups find instead.
+        """
+
+        conn = self.store.conn
+        for (isbn_key,) in conn.execute(
+                "SELECT isbn_key FROM books GROUP BY isbn_key HAVING COUNT(*) > 1").fetchall():
+            existing, *others = [row[0] for row in conn.execute(
+                "SELECT isbn FROM books WHERE isbn_key = ? ORDER BY rowid", (isbn_key,))]
+            for isbn in others:
+                yield isbn, existing
+
+    def resolve(self, identifier):
+        """
+        Return the ISBN a book with an equivalent ISBN is stored under, or None.
+        """
+
+        row = self.store.conn.execute("SELECT isbn FROM books WHERE isbn_key = ? ORDER BY rowid LIMIT 1",
+                                      (normalize_isbn(identifier),)).fetchone()
+        return row[0] if row else None
+
+    def suggest(self, identifier, limit=5):
+        """
+        Return the stored ISBNs one typo away from an identifier.
+        """
+
+        normalized = normalize_isbn(identifier)
+        candidates = list({normalize_isbn(candidate)
+                           for candidate in single_edits(normalized, self.ALPHABET | set(normalized))} - {normalized})
+        found = {}
+        for start in range(0, len(candidates), PROBE_BATCH):
+            batch = candidates[start:start + PROBE_BATCH]
+            for isbn_key, isbn in self.store.conn.execute(
+                    f"SELECT isbn_key, isbn FROM books WHERE isbn_key IN ({', '.join('?' * len(batch))}) "
+                    "ORDER BY rowid", batch):
+                found.setdefault(isbn_key, isbn)
+        return sorted(found.values())[:limit]
+
+
+class SQLiteStore:
+    """
+    Keep books, users and loans in a local SQLite database.
+
+    Attributes:
+        path (str): The path of the database file.
+        conn (sqlite3.Connection): The open database connection.
+        books (SQLiteTable): Books keyed by ISBN.
+        users (SQLiteTable): Users keyed by user ID.
+        isbn_index (SQLiteISBNIndex): Finds books by their normalized ISBN.
+
+    Methods:
+        write: Insert, update or delete changed objects.
+        commit: Make pending writes durable.
+        rollback: Discard pending writes.
+        borrowers_of: Find the users who have a book on loan.
+        hold_queues: Load every hold queue.
+        import_json: Load books and users from the JSON files.
+
+    Examples:
+        store = SQLiteStore('library.db')
+        book = store.books.get('978-0062315007')
+        store.write('books', {book.isbn: book})
+        store.commit()
+    """
+
+    COLUMNS = {
+        'books': ('isbn', 'title', 'author', 'copies', 'checked_out'),
+        'users': ('user_id', 'name'),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+        self.books = SQLiteTable(self, 'books', 'isbn')
+        self.users = SQLiteTable(self, 'users', 'user_id')
+        self.isbn_index = SQLiteISBNIndex(self)
+
+    def _migrate(self):
+        for table, columns in MIGRATIONS.items():
+            existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            for column, statement in columns:
+                if column not in existing:
+                    self.conn.executescript(statement)
+        loan_key = {row[1] for row in self.conn.execute("PRAGMA table_info(loans)") if row[5]}
+        if loan_key == {'isbn'}:
+            self.conn.executescript(REKEY_LOANS)
+        self.conn.executescript(INDEXES)
+        # Rows written before the normalized ISBN column, or by an older version
+        self.conn.executemany("UPDATE books SET isbn_key = ? WHERE isbn = ?",
+                              [(normalize_isbn(isbn), isbn) for (isbn,) in
+                               self.conn.execute("SELECT isbn FROM books WHERE isbn_key IS NULL").fetchall()])
+        self.conn.commit()
+
+    def row_to_object(self, table, row):
+        """
+        Build a Book or User from a table row.
+        """
+
+        if table == 'books':
+            isbn, title, author, copies, checked_out = row
+            return Book(title=title, author=author, isbn=isbn, copies=copies, checked_out=checked_out)
+
+        user_id, name = row
+        borrowed_books = []
+        loan_dates = {}
+        for isbn, checked_out, due in self.conn.execute(
+                "SELECT isbn, checked_out_at, due_date FROM loans WHERE user_id = ? ORDER BY rowid", (user_id,)):
+            borrowed_books.append(isbn)
+            if due is not None:
+                loan_dates[isbn] = {'checked_out': checked_out, 'due': due}
+        return User(name=name, user_id=user_id, borrowed_books=borrowed_books, loan_dates=loan_dates)
+
+    def write(self, table, changes):
+        """
+        Insert, update or delete changed objects. Rows that already exist
+        are updated in place, so listings keep their insertion order.
+
+        Parameters:
+            table (str): 'books', 'users' or 'holds'.
+            changes (dict): Maps each changed key to its object, or to None if removed.
+        """
+
+        for key, obj in changes.items():
+            if table == 'holds':
+                # Rows are inserted in queue order, so rowid keeps the order
+                self.conn.execute("DELETE FROM holds WHERE isbn = ?", (key,))
+                if obj is not None:
+                    self.conn.executemany("INSERT INTO holds (isbn, user_id) VALUES (?, ?)",
+                                          [(key, user_id) for user_id in obj.user_ids])
+            elif table == 'books':
+                if obj is None:
+                    self.conn.execute("DELETE FROM books WHERE isbn = ?", (key,))
+                else:
+                    # An upsert keeps the rowid, and so the book's place in listings
+                    self.conn.execute(
+                        "INSERT INTO books (isbn, title, author, copies, checked_out, isbn_key) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(isbn) DO UPDATE SET title = excluded.title, author = excluded.author, "
+                        "copies = excluded.copies, checked_out = excluded.checked_out",
+                        (obj.isbn, obj.title, obj.author, obj.copies, obj.checked_out, normalize_isbn(obj.isbn)))
+            elif obj is None:
+                self.conn.execute("DELETE FROM loans WHERE user_id = ?", (key,))
+                self.conn.execute("DELETE FROM users WHERE user_id = ?", (key,))
+            else:
+                self.conn.execute(
+                    "INSERT INTO users (user_id, name) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET name = excluded.name", (obj.user_id, obj.name))
+                self._write_loans(obj)
+
+    def _write_loans(self, user):
+        # Only the loans that changed are written, so the others keep their
+        # rowid and the order they were borrowed in
+        stored = {isbn: (checked_out, due) for isbn, checked_out, due in self.conn.execute(
+            "SELECT isbn, checked_out_at, due_date FROM loans WHERE user_id = ?", (user.user_id,))}
+        current = {isbn: self._loan_dates(user, isbn) for isbn in user.borrowed_books}
+        self.conn.executemany("DELETE FROM loans WHERE isbn = ? AND user_id = ?",
+                              [(isbn, user.user_id) for isbn in stored if isbn not in current])
+        self.conn.executemany("UPDATE loans SET checked_out_at = ?, due_date = ? WHERE isbn = ? AND user_id = ?",
+                              [(*dates, isbn, user.user_id) for isbn, dates in current.items()
+                               if isbn in stored and stored[isbn] != dates])
+        self.conn.executemany("INSERT INTO loans (isbn, user_id, checked_out_at, due_date) VALUES (?, ?, ?, ?)",
+                              [(isbn, user.user_id, *dates) for isbn, dates in current.items() if isbn not in stored])
+
+    @staticmethod
+    def _loan_dates(user, isbn):
+        dates = user.loan_dates.get(isbn) or {}
+        return dates.get('checked_out'), dates.get('due')
+
+    def commit(self):
+        """
+        Make pending writes durable.
+        """
+
+        self.conn.commit()
+
+    def rollback(self):
+        """
+        Discard pending writes.
+        """
+
+        self.conn.rollback()
+
+    def borrowers_of(self, isbn):
+        """
+        Find the users who have a copy of a book on loan.
+
+        Parameters:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            list: The IDs of the borrowers, in the order they borrowed it.
+        """
+
+        return [row[0] for row in self.conn.execute("SELECT user_id FROM loans WHERE isbn = ? ORDER BY rowid", (isbn,))]
+
+    def hold_queues(self):
+        """
+        Load every hold queue.
+
+        Returns:
+            list: A HoldQueue for every book that has holds.
+        """
+
+        queues = {}
+        for isbn, user_id in self.conn.execute("SELECT isbn, user_id FROM holds ORDER BY rowid"):
+            queues.setdefault(isbn, HoldQueue(isbn)).user_ids.append(user_id)
+        return list(queues.values())
+
+    def import_json(self, books_file, users_file):
+        """
+        Load books and users from the JSON files in one transaction.
+
+        Books listed once per copy, as in the flat schema, are merged into
+        one row per ISBN with copy counts.
+
+        Parameters:
+            books_file (str): The path of the books JSON file.
+            users_file (str): The path of the users JSON file.
+
+        Returns:
+            tuple: The number of books and users imported.
+        """
+
+        book_dicts = _read_json_list(books_file)
+        user_dicts = _read_json_list(users_file)
+        with self.conn:
+            self.write('books', {d['isbn']: Book.from_dict(d) for d in merge_copies(book_dicts)})
+            self.write('users', {d['user_id']: User.from_dict(d) for d in user_dicts})
+        return len(book_dicts), len(user_dicts)
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+
+        self.conn.close()
+
+
+def _read_json_list(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    # An empty file written as {} holds no records
+    return data if isinstance(data, list) else []
+
+
+def main(argv=None):
+    """
+    One-shot migration from books.json/users.json to a SQLite database.
+
+    Examples:
+        python sqlite_storage.py --books books.json --users users.json --database library.db
+    """
+
+    parser = argparse.ArgumentParser(description="Migrate the JSON library files to SQLite.")
+    parser.add_argument('--books', default='books.json', help="Path of the books JSON file.")
+    parser.add_argument('--users', default='users.json', help="Path of the users JSON file.")
+    parser.add_argument('--database', default='library.db', help="Path of the SQLite database to create.")
+    args = parser.parse_args(argv)
+
+    store = SQLiteStore(args.database)
+    try:
+        book_count, user_count = store.import_json(args.books, args.users)
+    finally:
+        store.close()
+    print(f"Migrated {book_count} books and {user_count} users to {args.database}.")
+
+
+if __name__ == "__main__":
+    main()
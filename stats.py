@@ -0,0 +1,272 @@
+import itertools
+from collections import Counter
+import threading
+from search import SortedIndex
+
+
+class Leaderboard:
+    """
+    Counts per key, kept in descending order so the top k are read without
+    sorting or scanning the rest.
+
+    Counts live in a dictionary and the order in a SortedIndex, so an
+    increment is a binary search plus one list insertion and top(k) visits
+    k entries. Ties are broken by key.
+
+    Attributes:
+        _counts (dict): Maps each key to its count.
+        _order (SortedIndex): The keys, highest count first.
+
+    Methods:
+        add: Add to a key's count.
+        count: Return a key's count.
+        top: Return the k keys with the highest counts.
+
+    Examples:
+        board = Leaderboard()
+        board.add("978-0062315007")
+        board.add("978-0451524935", 2)
+        board.top(1) # [('978-0451524935', 2)]
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._order = SortedIndex(lambda count: -count)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, key, amount=1):
+        """
+        Add to a key's count.
+        """
+
+        count = self._counts[key] = self._counts.get(key, 0) + amount
+        self._order.add(key, count)
+
+    def count(self, key):
+        """
+        Return a key's count; 0 if it was never counted.
+        """
+
+        return self._counts.get(key, 0)
+
+    def top(self, k):
+        """
+        Return the k keys with the highest counts.
+
+        Returns:
+            list: (key, count) pairs, highest count first.
+        """
+
+        return [(key, self._counts[key]) for key in itertools.islice(self._order.keys(), k)]
+
+
+class CirculationStats:
+    """
+    Circulation statistics kept up to date by every change, so that reports
+    never scan the catalog or the users.
+
+    Totals are adjusted from a small snapshot of each book and user: when a
+    record changes, its old contribution is taken away and its new one
+    added. The managers call track_book() and track_user() from the same
+    paths that keep their indexes up to date, and CheckManager calls
+    record_checkout() and record_return().
+
+    Popularity counts every checkout in the loan history given to it, so
+    that the rankings survive a restart, and every checkout recorded after
+    that; without a history, it starts from the loans open at the time. It
+    is counted per ISBN, per author and per user, and is kept when a book or
+    user is removed. Authors are looked up in the catalog, so the history
+    of a book removed before the statistics were built only counts for its
+    ISBN and its borrowers.
+
+    Attributes:
+        titles (int): The number of books (ISBNs) in the catalog.
+        copies (int): The number of copies owned.
+        checked_out (int): The number of copies on loan.
+        users (int): The number of users.
+        borrowers (int): The number of users with at least one loan.
+        loans (int): The number of open loans.
+        popular_titles (Leaderboard): Checkouts per ISBN.
+        popular_authors (Leaderboard): Checkouts per author.
+        active_borrowers (Leaderboard): Checkouts per user ID.
+        _books (dict): Maps an ISBN to the (author, copies, checked_out) counted for it.
+        _loans (dict): Maps a user ID to the number of loans counted for them.
+
+    Methods:
+        track_book: Count a book's current state, replacing its earlier one.
+        track_user: Count a user's current loans, replacing their earlier ones.
+        record_checkout: Count a checkout, for popularity as well as the totals.
+        record_return: Count a return.
+        summary: Return the totals.
+        loans_for: Return the number of open loans of a user.
+        top_titles, top_authors, top_borrowers: Return the k most borrowed.
+
+    Examples:
+        stats = CirculationStats(book_manager.books, user_manager.users, history.events(event='checkout'))
+        stats.summary() # {'titles': 2, 'copies': 3, 'checked_out': 1, ...}
+        stats.top_titles(10) # [('978-0451524935', 4), ...]
+    """
+
+    def __init__(self, books=(), users=(), checkouts=None):
+        """
+        Parameters:
+            books (iterable): The Book objects in the catalog.
+            users (iterable): The User objects.
+            checkouts (iterable): Past checkout events, as read from LoanHistory
+                (optional; the open loans are counted instead if omitted).
+        """
+
+        self.titles = self.copies = self.checked_out = 0
+        self.users = self.borrowers = self.loans = 0
+        self.popular_titles = Leaderboard()
+        self.popular_authors = Leaderboard()
+        self.active_borrowers = Leaderboard()
+        self._books = {}
+        self._loans = {}
+        # Callers lock per book and per user; the totals are shared by all of them
+        self._lock = threading.Lock()
+
+        for book in books:
+            self.track_book(book.isbn, book)
+            if checkouts is None and book.checked_out:
+                self.popular_titles.add(book.isbn, book.checked_out)
+                self.popular_authors.add(book.author, book.checked_out)
+        for user in users:
+            self.track_user(user.user_id, user)
+            if checkouts is None and user.borrowed_books:
+                self.active_borrowers.add(user.user_id, len(user.borrowed_books))
+        if checkouts is not None:
+            self._count_checkouts(checkouts)
+
+    def _count_checkouts(self, checkouts):
+        # Tallied first, so each leaderboard is updated once per key rather than once per event
+        titles = Counter()
+        borrowers = Counter()
+        for event in checkouts:
+            titles[event['isbn']] += 1
+            borrowers[event['user_id']] += 1
+        authors = Counter()
+        for isbn, count in titles.items():
+            self.popular_titles.add(isbn, count)
+            book = self._books.get(isbn)
+            if book is not None:
+                authors[book[0]] += count
+        for author, count in authors.items():
+            self.popular_authors.add(author, count)
+        for user_id, count in borrowers.items():
+            self.active_borrowers.add(user_id, count)
+
+    def track_book(self, isbn, book):
+        """
+        Count a book's current state, replacing what was counted for its ISBN.
+
+        Parameters:
+            isbn (str): The ISBN the book is, or was, stored under.
+            book (Book): The book, or None if it was removed.
+        """
+
+        with self._lock:
+            old = self._books.pop(isbn, None)
+            if old is not None:
+                self.titles -= 1
+                self.copies -= old[1]
+                self.checked_out -= old[2]
+            if book is not None:
+                self._books[isbn] = (book.author, book.copies, book.checked_out)
+                self.titles += 1
+                self.copies += book.copies
+                self.checked_out += book.checked_out
+
+    def track_user(self, user_id, user):
+        """
+        Count a user's current loans, replacing what was counted for their ID.
+
+        Parameters:
+            user_id (str): The ID the user is, or was, stored under.
+            user (User): The user, or None if they were removed.
+        """
+
+        with self._lock:
+            old = self._loans.pop(user_id, None)
+            if old is not None:
+                self.users -= 1
+                self.loans -= old
+                self.borrowers -= old > 0
+            if user is not None:
+                count = self._loans[user_id] = len(user.borrowed_books)
+                self.users += 1
+                self.loans += count
+                self.borrowers += count > 0
+
+    def record_checkout(self, book, user):
+        """
+        Count a checkout that was persisted.
+        """
+
+        self.track_book(book.isbn, book)
+        self.track_user(user.user_id, user)
+        with self._lock:
+            self.popular_titles.add(book.isbn)
+            self.popular_authors.add(book.author)
+            self.active_borrowers.add(user.user_id)
+
+    def record_return(self, book, user):
+        """
+        Count a return that was persisted.
+        """
+
+        self.track_book(book.isbn, book)
+        self.track_user(user.user_id, user)
+
+    def summary(self):
+        """
+        Return the totals.
+
+        Returns:
+            dict: The titles, copies, checked_out and available copies, and
+            the users, borrowers and open loans.
+        """
+
+        with self._lock:
+            return {
+                'titles': self.titles,
+                'copies': self.copies,
+                'checked_out': self.checked_out,
+                'available': self.copies - self.checked_out,
+                'users': self.users,
+                'borrowers': self.borrowers,
+                'loans': self.loans,
+            }
+
+    def loans_for(self, user_id):
+        """
+        Return the number of open loans of a user; 0 if unknown.
+        """
+
+        return self._loans.get(user_id, 0)
+
+    def top_titles(self, k=10):
+        """
+        Return the k most borrowed books as (ISBN, checkouts) pairs.
+        """
+
+        with self._lock:
+            return self.popular_titles.top(k)
+
+    def top_authors(self, k=10):
+        """
+        Return the k most borrowed authors as (author, checkouts) pairs.
+        """
+
+        with self._lock:
+            return self.popular_authors.top(k)
+
+    def top_borrowers(self, k=10):
+        """
+        Return the k users with the most checkouts as (user ID, checkouts) pairs.
+        """
+
+        with self._lock:
+            return self.active_borrowers.top(k)
@@ -1,14 +1,93 @@
+import atexit
+import contextlib
 import json
 import os
-from models import Book, User
+import shutil
+import threading
+import time
+import binary_storage
+import metrics
+from events import EventLogger
+from history import LoanHistory
+from identifiers import IdentifierIndex, normalize_isbn
+from holds import HoldQueue
+from models import Book, BookTable, User, merge_copies
+from lazy_storage import LazyCatalog
+from locking import FileLock
+from sqlite_storage import SQLiteStore
+
+
+log = EventLogger('storage')
+
+
+class StorageError(Exception):
+    """
+    Raised when a storage transaction cannot be persisted.
+    """
+
 
 class Storage:
     """
     Manage saving and loading data to and from JSON files.
 
+    A data file whose name ends in .rec, .rec.zlib or .rec.xz is saved in
+    the compact binary record format of binary_storage instead, with no,
+    zlib or lzma compression. Files are loaded in whichever format they are
+    in. Point BOOKS_FILE or USERS_FILE (LIBRARY_BOOKS_FILE,
+    LIBRARY_USERS_FILE) at such a name to use it.
+
+    Two storage modes are supported, selected with the LIBRARY_STORAGE_MODE
+    environment variable:
+
+        full (default): every mutation rewrites the whole JSON file.
+        journal: every mutation appends one compact record to JOURNAL_FILE,
+            and the journal is folded into the JSON snapshots once it holds
+            COMPACT_THRESHOLD records.
+
+    The backend is selected with the LIBRARY_BACKEND environment variable:
+
+        json (default): books and users are held in memory and persisted to
+            the JSON files above.
+        sqlite: books, users and loans live in the SQLite database at
+            DATABASE_FILE (LIBRARY_DATABASE) and are queried on demand. Use
+            `python sqlite_storage.py` to migrate the JSON files once.
+
+    When commits are written is selected with the LIBRARY_DURABILITY
+    environment variable:
+
+        immediate (default): every commit is written before it returns.
+        coalesced: commits only mark the collection dirty; the pending
+            changes are written together once FLUSH_EVERY commits are
+            pending or the oldest is FLUSH_INTERVAL seconds old.
+        on-exit: pending changes are only written by flush() and when the
+            interpreter exits cleanly.
+
     Attributes:
-        BOOKS_FILE (str): The filename for the books JSON file.
-        USERS_FILE (str): The filename for the users JSON file.
+        BOOKS_FILE (str): The filename for the books data file.
+        USERS_FILE (str): The filename for the users data file.
+        HOLDS_FILE (str): The filename for the hold queues data file.
+        HISTORY_DIR (str): The directory of the loan history segments
+            (LIBRARY_HISTORY_DIR).
+        HISTORY_RETENTION_DAYS (int): How long loan history is kept; None keeps
+            it forever (LIBRARY_HISTORY_RETENTION_DAYS).
+        JOURNAL_FILE (str): The filename for the append-only journal.
+        STORAGE_MODE (str): Either 'full' or 'journal'.
+        COMPACT_THRESHOLD (int): Journal records kept before compaction.
+        BACKEND (str): Either 'json' or 'sqlite'.
+        DATABASE_FILE (str): The filename for the SQLite database.
+        BOOK_STORE (str): How the JSON backend holds books in memory, either
+            'dict' (Book objects) or 'table' (a columnar BookTable).
+        LOCK_FILE (str): The file locked while writing, so that threads and
+            processes sharing the data files never interleave their writes.
+        LAZY_LOAD (bool): If set (LIBRARY_LAZY_LOAD=1), the JSON backend
+            memory-maps the snapshots and only parses the records in use.
+        DURABILITY (str): Either 'immediate', 'coalesced' or 'on-exit'.
+        FLUSH_INTERVAL (float): Seconds a coalesced change may stay unwritten
+            (LIBRARY_FLUSH_INTERVAL).
+        FLUSH_EVERY (int): Pending commits that trigger a coalesced write
+            (LIBRARY_FLUSH_EVERY).
+        BACKUP_SUFFIX (str): Appended to a data file's name for the copy of
+            its last good version, which load_data falls back to.
     
     Methods:
         save_data: Save data to a JSON file.
@@ -17,66 +96,236 @@ class Storage:
         load_books: Load a list of Book objects from a JSON file.
         save_users: Save a list of User objects to a JSON file.
         load_users: Load a list of User objects from a JSON file.
+        open_books: Return the mapping from ISBN to Book for BookManager.
+        open_users: Return the mapping from user ID to User for UserManager.
+        open_isbn_index: Return the index from normalized ISBN to stored ISBN for BookManager.
+        open_history: Return the loan history in HISTORY_DIR.
+        load_holds: Load the hold queues.
+        sqlite_store: Return the open SQLite store.
+        commit_books: Persist changed books according to the storage mode.
+        commit_users: Persist changed users according to the storage mode.
+        commit_holds: Persist changed hold queues according to the storage mode.
+        transaction: Group several commits into one durable write.
+        full_rewrite: Check whether saves rewrite every record of a file.
+        lock: Return the lock that serializes writes.
+        deferred: Hold back commits and persist them together.
+        flush: Persist the commits held back by deferred() or the durability level.
+        take_deferred: Serialize the commits held back by deferred().
+        write_prepared: Persist commits serialized by take_deferred().
+        migrate_copies: Merge books listed once per copy into copy counts.
+        append_journal: Append one record to the journal.
+        replay_journal: Apply the journal on top of a snapshot.
+        journal_changes: Fold the journal for one section into one set of changes.
+        compact: Fold the journal into the JSON snapshots.
     
     Examples:
         Storage.save_books(books)
         books = Storage.load_books()
+        Storage.commit_books(books, {book.isbn: book})
     """
 
-    BOOKS_FILE = 'books.json'
-    USERS_FILE = 'users.json'
+    BOOKS_FILE = os.environ.get('LIBRARY_BOOKS_FILE', 'books.json')
+    USERS_FILE = os.environ.get('LIBRARY_USERS_FILE', 'users.json')
+    HOLDS_FILE = os.environ.get('LIBRARY_HOLDS_FILE', 'holds.json')
+    HISTORY_DIR = os.environ.get('LIBRARY_HISTORY_DIR', 'history')
+    HISTORY_RETENTION_DAYS = int(os.environ['LIBRARY_HISTORY_RETENTION_DAYS']) \
+        if os.environ.get('LIBRARY_HISTORY_RETENTION_DAYS') else None
+    JOURNAL_FILE = 'library.journal'
+    STORAGE_MODE = os.environ.get('LIBRARY_STORAGE_MODE', 'full')
+    COMPACT_THRESHOLD = 1000
+    BACKEND = os.environ.get('LIBRARY_BACKEND', 'json')
+    DATABASE_FILE = os.environ.get('LIBRARY_DATABASE', 'library.db')
+    BOOK_STORE = os.environ.get('LIBRARY_BOOK_STORE', 'dict')
+    LOCK_FILE = os.environ.get('LIBRARY_LOCK_FILE', 'library.lock')
+    LAZY_LOAD = os.environ.get('LIBRARY_LAZY_LOAD') == '1'
+    DURABILITY = os.environ.get('LIBRARY_DURABILITY', 'immediate')
+    FLUSH_INTERVAL = float(os.environ.get('LIBRARY_FLUSH_INTERVAL', '1.0'))
+    FLUSH_EVERY = int(os.environ.get('LIBRARY_FLUSH_EVERY', '100'))
+    BACKUP_SUFFIX = '.bak'
+
+    # Open SQLite stores, keyed by database path
+    _sqlite_stores = {}
+
+    # Number of records in the journal, counted lazily on first append
+    _journal_length = None
+
+    # Writes staged by each thread's open transaction, if any
+    _local = threading.local()
+
+    # Write locks, keyed by lock file path
+    _file_locks = {}
+
+    # Commits held back by deferred(), keyed by section
+    _deferred = None
+
+    # Commits not yet written under the coalesced and on-exit durability
+    # levels, keyed by section, with their count and the time of the oldest
+    _dirty = {}
+    _dirty_count = 0
+    _dirty_since = None
+    _dirty_lock = threading.RLock()
 
     @staticmethod
+    @metrics.timed
     def save_data(data, filename):
         """
         Save data to a JSON file.
 
+        The data is written to a temporary file and fsynced, the current file
+        is kept as the last good backup, and the temporary file is then moved
+        over it. A crash at any point leaves either the old or the new file
+        in place, never a partial one.
+
         Parameters:
             data: The data to be saved.
             filename: The name of the file to save the data to.
+
+        Returns:
+            bool: True if the data was saved, False otherwise.
           
         Examples:
             Storage.save_data(books, 'books.json')
             Storage.save_data(users, 'users.json')
         """
 
+        transaction = Storage._current_transaction()
+        if transaction is not None:
+            # Stage the write; the transaction moves it into place on commit
+            staged = Storage._write_staged(data, filename)
+            transaction['files'].append((staged, filename))
+            return True
+
         try:
-            with open(filename, 'w') as f:
-                json.dump(data, f, indent=4)
-            print(f"Successfully saved data to {filename}.")
+            # Replace rather than truncate, so a lazily mapped snapshot stays readable
+            with Storage.lock():
+                staged = Storage._write_staged(data, filename)
+                Storage._install(staged, filename)
+            log.debug('storage.saved', "Successfully saved data to {file}.", file=filename)
+            return True
         except Exception as e:
-            print(f"Error saving data to {filename}: {e}")
+            log.error('storage.save_failed', "Error saving data to {file}: {error}", file=filename, error=e)
+            return False
+
+    @staticmethod
+    def _write_staged(data, filename):
+        staged = filename + '.tmp'
+        codec = binary_storage.codec_for(filename)
+        with open(staged, 'w' if codec is None else 'wb') as f:
+            if codec is None:
+                json.dump(data, f, indent=4)
+            else:
+                binary_storage.write_records(f, data, codec)
+            f.flush()
+            os.fsync(f.fileno())
+            metrics.add('storage.bytes_written', os.fstat(f.fileno()).st_size)
+        return staged
 
+    @staticmethod
+    def _install(staged, filename):
+        # The current file was itself installed whole, so it is the last good version
+        if os.path.exists(filename):
+            Storage._link_or_copy(filename, filename + Storage.BACKUP_SUFFIX)
+        os.replace(staged, filename)
+        Storage._fsync_directory(filename)
+
+    @staticmethod
+    def _link_or_copy(source, target):
+        # Files are only ever replaced, never rewritten in place, so a hard link
+        # is as good as a copy and costs no I/O
+        staged = target + '.tmp'
+        if os.path.exists(staged):
+            os.remove(staged)
+        try:
+            os.link(source, staged)
+        except OSError:
+            shutil.copyfile(source, staged)
+        os.replace(staged, target)
 
     @staticmethod
-    def load_data(filename):
+    def _fsync_directory(filename):
+        # Make the rename itself durable; not possible (or needed) on Windows
+        if os.name != 'posix':
+            return
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    @metrics.timed
+    def load_data(filename, consume=list):
         """
-        Load data from a JSON file.
+        Load data from a JSON file, or from a binary record file, whose
+        records are streamed one at a time.
+
+        The records are handed to consume as an iterator, so that e.g.
+        merge_copies builds its result straight from a record file without
+        a list of every record first.
+
+        If the file is corrupt, even partway through, it is moved aside to
+        filename + '.corrupt' and the last good backup is restored, and
+        consume is called again on the backup's records.
 
         Parameters:
             filename: The name of the file to load the data from.
+            consume (callable): Builds the result from an iterator of
+                dictionaries (default: list).
         
         Returns:
-            list: The data loaded from the file.
+            list: The data loaded from the file, or an empty list if neither
+            the file nor its backup can be read; whatever consume returns
+            if it is given.
         
         Examples:
             books = Storage.load_data('books.json')
-            users = Storage.load_data('users.json')
+            titles = Storage.load_data('books.rec.zlib', merge_copies)
         """
 
         if not os.path.exists(filename):
-            print(f"{filename} does not exist. Returning an empty list.")
-            return []
+            log.debug('storage.missing', "{file} does not exist. Returning an empty list.", file=filename)
+            return consume(iter(()))
         
         try:
-            with open(filename, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON from {filename}. Returning an empty list.")
-            return []
+            with open(filename, 'rb') as f:
+                metrics.add('storage.bytes_read', os.fstat(f.fileno()).st_size)
+                if binary_storage.is_record_file(f):
+                    return consume(binary_storage.read_records(f))
+                return consume(iter(json.load(f)))
+        except ValueError as e:
+            log.error('storage.corrupt', "Error decoding {file}: {error}", file=filename, error=e)
+            return consume(iter(Storage._recover(filename)))
         except Exception as e:
-            print(f"Error loading data from {filename}: {e}")
+            log.error('storage.load_failed', "Error loading data from {file}: {error}", file=filename, error=e)
+            return consume(iter(()))
+
+    @staticmethod
+    def _recover(filename):
+        backup = filename + Storage.BACKUP_SUFFIX
+        try:
+            data = binary_storage.load(backup)
+        except (OSError, ValueError):
+            data = None
+
+        # Keep the corrupt file for inspection, out of the way of the next
+        # save, which would otherwise back it up over the good copy
+        corrupt = filename + '.corrupt'
+        try:
+            with Storage.lock():
+                os.replace(filename, corrupt)
+                if data is not None:
+                    Storage._link_or_copy(backup, filename)
+        except OSError as e:
+            log.error('storage.restore_failed', "Could not restore {file} from {backup}: {error}",
+                      file=filename, backup=backup, error=e)
+
+        if data is None:
+            log.error('storage.lost', "No usable backup of {file}; moved it to {corrupt}. Returning an empty list.",
+                      file=filename, corrupt=corrupt)
             return []
+        log.warning('storage.restored', "Restored {file} from its last good backup {backup}; "
+                    "the corrupt file is kept as {corrupt}.", file=filename, backup=backup, corrupt=corrupt)
+        return data
 
     @staticmethod
     def save_books(books):
@@ -93,7 +342,9 @@ class Storage:
         Load a list of Book objects from a JSON file.
         """
 
-        book_dicts = Storage.load_data(Storage.BOOKS_FILE)
+        if Storage.BACKEND == 'sqlite':
+            return list(Storage.sqlite_store().books.values())
+        book_dicts = Storage._load_section('books', Storage.BOOKS_FILE, 'isbn')
         return [Book.from_dict(book_dict) for book_dict in book_dicts]
 
     @staticmethod
@@ -111,5 +362,621 @@ class Storage:
         Load a list of User objects from a JSON file.
         """
         
-        user_dicts = Storage.load_data(Storage.USERS_FILE)
+        if Storage.BACKEND == 'sqlite':
+            return list(Storage.sqlite_store().users.values())
+        user_dicts = Storage._load_section('users', Storage.USERS_FILE, 'user_id')
         return [User.from_dict(user_dict) for user_dict in user_dicts]
+
+    @staticmethod
+    def load_holds():
+        """
+        Load the hold queues from HOLDS_FILE, or from the database for the
+        SQLite backend.
+
+        Returns:
+            list: A HoldQueue for every book that has holds.
+        """
+
+        if Storage.BACKEND == 'sqlite':
+            return Storage.sqlite_store().hold_queues()
+        return [HoldQueue.from_dict(data) for data in Storage._load_section('holds', Storage.HOLDS_FILE, 'isbn')]
+
+    @staticmethod
+    def open_books():
+        """
+        Return the mapping from ISBN to Book that BookManager keeps its books in.
+
+        Returns:
+            dict: An in-memory dict for the JSON backend (a BookTable when
+            BOOK_STORE is 'table', a LazyCatalog when LAZY_LOAD is set and
+            BOOKS_FILE is JSON), or
+            an SQLiteTable that queries the database for the SQLite backend.
+        """
+
+        if Storage.BACKEND == 'sqlite':
+            return Storage.sqlite_store().books
+        if Storage.LAZY_LOAD and binary_storage.codec_for(Storage.BOOKS_FILE) is None:
+            return Storage._open_lazy('books', Storage.BOOKS_FILE, 'isbn', Book.from_dict)
+        if Storage.BOOK_STORE == 'table':
+            return BookTable.from_dicts(Storage._load_section('books', Storage.BOOKS_FILE, 'isbn'))
+        return {book.isbn: book for book in Storage.load_books()}
+
+    @staticmethod
+    def open_users():
+        """
+        Return the mapping from user ID to User that UserManager keeps its users in.
+
+        Returns:
+            dict: An in-memory dict for the JSON backend (a LazyCatalog when
+            LAZY_LOAD is set and USERS_FILE is JSON), or an SQLiteTable that
+            queries the database for the SQLite backend.
+        """
+
+        if Storage.BACKEND == 'sqlite':
+            return Storage.sqlite_store().users
+        if Storage.LAZY_LOAD and binary_storage.codec_for(Storage.USERS_FILE) is None:
+            return Storage._open_lazy('users', Storage.USERS_FILE, 'user_id', User.from_dict)
+        return {user.user_id: user for user in Storage.load_users()}
+
+    @staticmethod
+    def open_isbn_index(books):
+        """
+        Return the index that finds a book by any form of its ISBN.
+
+        Parameters:
+            books: The mapping returned by open_books().
+
+        Returns:
+            IdentifierIndex: An index built over the ISBNs of books for the
+            JSON backend, or the books table's indexed column of normalized
+            ISBNs (an SQLiteISBNIndex), which loads nothing, for SQLite.
+        """
+
+        if Storage.BACKEND == 'sqlite':
+            return Storage.sqlite_store().isbn_index
+        return IdentifierIndex(normalize_isbn, books.keys())
+
+    @staticmethod
+    def open_history():
+        """
+        Return the loan history in HISTORY_DIR, whose writers take the same
+        lock as every other write.
+
+        Returns:
+            LoanHistory: The history, keeping events for HISTORY_RETENTION_DAYS.
+        """
+
+        return LoanHistory(Storage.HISTORY_DIR, lock=Storage.lock, retention_days=Storage.HISTORY_RETENTION_DAYS)
+
+    @staticmethod
+    def sqlite_store():
+        """
+        Return the SQLite store for DATABASE_FILE, opening it on first use.
+        """
+
+        store = Storage._sqlite_stores.get(Storage.DATABASE_FILE)
+        if store is None:
+            store = Storage._sqlite_stores[Storage.DATABASE_FILE] = SQLiteStore(Storage.DATABASE_FILE)
+        return store
+
+    @staticmethod
+    def _commit_sqlite(table, changes):
+        store = Storage.sqlite_store()
+        store.write(table, changes)
+        transaction = Storage._current_transaction()
+        if transaction is not None:
+            transaction['sqlite'] = True
+        else:
+            store.commit()
+
+    @staticmethod
+    def _fold_stale_journal():
+        # A journal left behind by journal mode must be folded in before full
+        # rewrites start, otherwise replaying it later would resurrect stale records.
+        if Storage.STORAGE_MODE != 'journal' and os.path.exists(Storage.JOURNAL_FILE) \
+                and os.path.getsize(Storage.JOURNAL_FILE) > 0:
+            Storage.compact()
+
+    @staticmethod
+    def _load_section(section, filename, key):
+        Storage._fold_stale_journal()
+        return Storage.replay_journal(section, Storage._load_snapshot(section, filename), key)
+
+    @staticmethod
+    def _load_snapshot(section, filename):
+        # Books listed once per copy, as in the flat schema, would otherwise
+        # shadow each other and the next save would drop the other copies
+        return Storage.load_data(filename, merge_copies if section == 'books' else list)
+
+    @staticmethod
+    def _open_lazy(section, filename, key, from_dict):
+        Storage._fold_stale_journal()
+        merge = (lambda records: merge_copies(records)[0]) if section == 'books' else None
+        return LazyCatalog(filename, key, from_dict, overlay=lambda: Storage.journal_changes(section), merge=merge)
+
+    @staticmethod
+    def commit_books(books, changes):
+        """
+        Persist changed books according to the storage mode.
+
+        Parameters:
+            books: All books in the library, used for a full rewrite.
+            changes (dict): Maps each changed ISBN to its Book, or to None if removed.
+        """
+
+        if Storage._deferred is not None:
+            Storage._defer('books', books, changes)
+        elif Storage.DURABILITY != 'immediate':
+            Storage._mark_dirty('books', books, changes)
+        elif Storage.BACKEND == 'sqlite':
+            Storage._commit_sqlite('books', changes)
+        elif Storage.STORAGE_MODE == 'journal':
+            Storage.append_journal({'books': Storage._serialize_changes(changes)})
+        else:
+            Storage.save_books(books)
+
+    @staticmethod
+    def commit_users(users, changes):
+        """
+        Persist changed users according to the storage mode.
+
+        Parameters:
+            users: All users in the library, used for a full rewrite.
+            changes (dict): Maps each changed user ID to its User, or to None if removed.
+        """
+
+        if Storage._deferred is not None:
+            Storage._defer('users', users, changes)
+        elif Storage.DURABILITY != 'immediate':
+            Storage._mark_dirty('users', users, changes)
+        elif Storage.BACKEND == 'sqlite':
+            Storage._commit_sqlite('users', changes)
+        elif Storage.STORAGE_MODE == 'journal':
+            Storage.append_journal({'users': Storage._serialize_changes(changes)})
+        else:
+            Storage.save_users(users)
+
+    @staticmethod
+    def _merge_pending(pending, section, collection, changes):
+        entry = pending.setdefault(section, [collection, {}])
+        entry[0] = collection
+        entry[1].update(changes)
+
+    @staticmethod
+    def commit_holds(queues, changes):
+        """
+        Persist changed hold queues according to the storage mode.
+
+        Parameters:
+            queues: Every HoldQueue, used for a full rewrite.
+            changes (dict): Maps each changed ISBN to its HoldQueue, or to None if emptied.
+        """
+
+        if Storage._deferred is not None:
+            Storage._defer('holds', queues, changes)
+        elif Storage.DURABILITY != 'immediate':
+            Storage._mark_dirty('holds', queues, changes)
+        elif Storage.BACKEND == 'sqlite':
+            Storage._commit_sqlite('holds', changes)
+        elif Storage.STORAGE_MODE == 'journal':
+            Storage.append_journal({'holds': Storage._serialize_changes(changes)})
+        else:
+            Storage.save_data([queue.to_dict() for queue in queues], Storage.HOLDS_FILE)
+
+    @staticmethod
+    def _sections():
+        # Every persisted collection: section name, file, key field and model
+        return (('books', Storage.BOOKS_FILE, 'isbn', Book),
+                ('users', Storage.USERS_FILE, 'user_id', User),
+                ('holds', Storage.HOLDS_FILE, 'isbn', HoldQueue))
+
+    @staticmethod
+    def _defer(section, collection, changes):
+        Storage._merge_pending(Storage._deferred, section, collection, changes)
+
+    @staticmethod
+    def _mark_dirty(section, collection, changes):
+        with Storage._dirty_lock:
+            Storage._merge_pending(Storage._dirty, section, collection, changes)
+            Storage._dirty_count += 1
+            if Storage._dirty_since is None:
+                Storage._dirty_since = time.monotonic()
+        # Never flush half of an open transaction; it checks again when it ends
+        if Storage._current_transaction() is None:
+            Storage._flush_if_due()
+
+    @staticmethod
+    def _flush_if_due():
+        with Storage._dirty_lock:
+            due = Storage.DURABILITY == 'coalesced' and Storage._dirty and (
+                Storage._dirty_count >= Storage.FLUSH_EVERY
+                or time.monotonic() - Storage._dirty_since >= Storage.FLUSH_INTERVAL)
+        if due:
+            try:
+                Storage._flush_dirty()
+            except StorageError as e:
+                log.error('storage.flush_failed', "Could not write pending changes; will retry: {error}", error=e)
+
+    @staticmethod
+    def _flush_dirty():
+        if not Storage._dirty:
+            return
+        # Take the write lock first, as transactions do, so the two never deadlock
+        with Storage.lock(), Storage._dirty_lock:
+            pending = Storage._dirty
+            if not pending:
+                return
+            count = Storage._dirty_count
+            Storage._dirty, Storage._dirty_count, Storage._dirty_since = {}, 0, None
+            try:
+                Storage.write_prepared(Storage._prepare(pending))
+            except StorageError:
+                # Nothing can have been marked since: the lock is still held
+                Storage._dirty, Storage._dirty_count, Storage._dirty_since = pending, count, time.monotonic()
+                raise
+
+    @staticmethod
+    def _flush_at_exit():
+        try:
+            Storage._flush_dirty()
+        except StorageError as e:
+            log.error('storage.flush_failed', "Could not write pending changes at exit: {error}", error=e)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def deferred():
+        """
+        Hold back commits made inside the block and persist them together.
+
+        Changes are kept as references to the changed objects, so the state
+        written is the state at flush time. Everything pending is flushed in
+        one transaction when the block exits, or earlier by calling flush().
+        Because commits inside the block cannot fail, callers that roll back
+        on StorageError will not see write errors until the flush.
+
+        Examples:
+            with Storage.deferred():
+                for book in books:
+                    book_manager.add_book(book)
+                    if many_pending:
+                        Storage.flush()
+        """
+
+        if Storage._deferred is not None:
+            yield
+            return
+
+        Storage._deferred = {}
+        try:
+            yield
+        finally:
+            try:
+                Storage.flush()
+            finally:
+                Storage._deferred = None
+
+    @staticmethod
+    @metrics.timed
+    def flush():
+        """
+        Persist every commit held back by deferred(), or kept pending by the
+        coalesced and on-exit durability levels.
+
+        Raises:
+            StorageError: If the changes could not be persisted. Changes
+            pending under a durability level are kept for the next flush.
+        """
+
+        Storage._flush_dirty()
+        prepared = Storage.take_deferred()
+        if prepared:
+            Storage.write_prepared(prepared)
+
+    @staticmethod
+    def take_deferred():
+        """
+        Take the commits held back by deferred() and serialize them.
+
+        This does no I/O, so a server can call it between requests and hand
+        the result to write_prepared() on another thread while it keeps
+        serving. Commits made afterwards are held back again as usual.
+
+        Returns:
+            dict: Maps 'books', 'users' and/or 'holds' to {'changes': {key: dict or
+            None}, 'snapshot': list of dicts, or None if no full rewrite is
+            needed}. Empty if nothing is pending.
+        """
+
+        pending = Storage._deferred
+        if not pending:
+            return {}
+
+        Storage._deferred = {}
+        return Storage._prepare(pending)
+
+    @staticmethod
+    def full_rewrite():
+        """
+        Check whether saves rewrite every record of a file, as the JSON
+        backend does in full mode, rather than writing only changed records.
+        """
+
+        return Storage.BACKEND != 'sqlite' and Storage.STORAGE_MODE != 'journal'
+
+    @staticmethod
+    def _prepare(pending):
+        full_rewrite = Storage.full_rewrite()
+        return {
+            section: {
+                'changes': Storage._serialize_changes(changes),
+                'snapshot': [obj.to_dict() for obj in collection] if full_rewrite else None,
+            }
+            for section, (collection, changes) in pending.items()
+        }
+
+    @staticmethod
+    def write_prepared(prepared):
+        """
+        Persist changes serialized by take_deferred() in one transaction.
+
+        Parameters:
+            prepared (dict): The result of take_deferred().
+
+        Raises:
+            StorageError: If the changes could not be persisted.
+        """
+
+        with Storage._write_transaction():
+            for section, filename, _, model in Storage._sections():
+                batch = prepared.get(section)
+                if not batch:
+                    continue
+                if Storage.BACKEND == 'sqlite':
+                    Storage._commit_sqlite(section, {key: model.from_dict(data) if data is not None else None
+                                                     for key, data in batch['changes'].items()})
+                elif Storage.STORAGE_MODE == 'journal':
+                    Storage.append_journal({section: batch['changes']})
+                else:
+                    Storage.save_data(batch['snapshot'], filename)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def transaction():
+        """
+        Group several commits into one durable write.
+
+        With the SQLite backend the block is one database transaction. In
+        journal mode all changes made inside the block become a single
+        journal record. In full mode every file is written to a temporary
+        file and fsynced first, and only once all of them are written are they
+        moved over the originals. If anything fails, nothing is moved into
+        place and StorageError is raised so the caller can roll back.
+
+        Inside deferred() the block only records its commits, without taking
+        the write lock; they are written together when deferred() flushes.
+
+        Raises:
+            StorageError: If the changes could not be persisted.
+
+        Examples:
+            with Storage.transaction():
+                Storage.commit_books(books, {book.isbn: book})
+                Storage.commit_users(users, {user.user_id: user})
+        """
+
+        if Storage._current_transaction() is not None:
+            # Nested transactions join the outer one
+            yield
+            return
+        if Storage._deferred is not None:
+            # Commits are only recorded until the flush, which takes the lock,
+            # so a request is never held up by a write in progress
+            yield
+            return
+
+        with Storage._write_transaction():
+            yield
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _write_transaction():
+        with Storage.lock():
+            transaction = Storage._local.transaction = {'files': [], 'journal': {}, 'sqlite': False}
+            try:
+                try:
+                    yield
+                finally:
+                    Storage._local.transaction = None
+
+                if transaction['sqlite']:
+                    Storage.sqlite_store().commit()
+                if transaction['journal']:
+                    Storage.append_journal(transaction['journal'])
+                for staged, filename in transaction['files']:
+                    Storage._install(staged, filename)
+                if transaction['files']:
+                    log.debug('storage.saved', "Successfully saved data to {file}.",
+                              file=', '.join(f for _, f in transaction['files']))
+            except Exception as e:
+                if Storage.BACKEND == 'sqlite':
+                    Storage.sqlite_store().rollback()
+                for staged, _ in transaction['files']:
+                    if os.path.exists(staged):
+                        os.remove(staged)
+                raise StorageError(f"Transaction failed: {e}") from e
+        Storage._flush_if_due()
+
+    @staticmethod
+    def lock():
+        """
+        Return the lock that serializes writes across threads and processes.
+
+        Returns:
+            FileLock: The re-entrant lock on LOCK_FILE.
+
+        Examples:
+            with Storage.lock():
+                Storage.compact()
+        """
+
+        lock = Storage._file_locks.get(Storage.LOCK_FILE)
+        if lock is None:
+            lock = Storage._file_locks.setdefault(Storage.LOCK_FILE, FileLock(Storage.LOCK_FILE))
+        return lock
+
+    @staticmethod
+    def _current_transaction():
+        return getattr(Storage._local, 'transaction', None)
+
+    @staticmethod
+    def _serialize_changes(changes):
+        return {key: obj.to_dict() if obj is not None else None for key, obj in changes.items()}
+
+    @staticmethod
+    @metrics.timed
+    def append_journal(record):
+        """
+        Append one record to the journal, compacting it once it grows past
+        COMPACT_THRESHOLD records.
+
+        Parameters:
+            record (dict): Maps 'books', 'users' and/or 'holds' to {key: dict or None}.
+        """
+
+        transaction = Storage._current_transaction()
+        if transaction is not None:
+            for section, changes in record.items():
+                transaction['journal'].setdefault(section, {}).update(changes)
+            return
+
+        with Storage.lock():
+            if Storage._journal_length is None:
+                Storage._journal_length = len(Storage._read_journal())
+
+            line = json.dumps(record, separators=(',', ':')) + '\n'
+            with open(Storage.JOURNAL_FILE, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            Storage._journal_length += 1
+            metrics.add('storage.bytes_written', len(line.encode()))
+
+            if Storage._journal_length >= Storage.COMPACT_THRESHOLD:
+                Storage.compact()
+
+    @staticmethod
+    def _read_journal():
+        if not os.path.exists(Storage.JOURNAL_FILE):
+            return []
+
+        records = []
+        with open(Storage.JOURNAL_FILE, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A torn final write; everything before it is still valid
+                    log.warning('journal.corrupt', "Skipping corrupt journal record at line {line} of {file}.",
+                                line=line_number, file=Storage.JOURNAL_FILE)
+        return records
+
+    @staticmethod
+    def replay_journal(section, snapshot, key):
+        """
+        Apply the journal on top of a snapshot.
+
+        Parameters:
+            section (str): 'books', 'users' or 'holds'.
+            snapshot (list): The dictionaries loaded from the JSON snapshot.
+            key (str): The field that identifies a record, e.g. 'isbn'.
+
+        Returns:
+            list: The dictionaries after every journal record is applied.
+        """
+
+        changes = Storage.journal_changes(section)
+        if not changes:
+            return snapshot
+
+        state = {data[key]: data for data in snapshot}
+        for record_key, data in changes.items():
+            if data is None:
+                state.pop(record_key, None)
+            else:
+                state[record_key] = data
+        return list(state.values())
+
+    @staticmethod
+    def journal_changes(section):
+        """
+        Fold every journal record for one section into a single set of changes.
+
+        Parameters:
+            section (str): 'books', 'users' or 'holds'.
+
+        Returns:
+            dict: Maps each changed key to its latest dictionary, or to None if removed.
+        """
+
+        changes = {}
+        for record in Storage._read_journal():
+            changes.update(record.get(section, {}))
+        return changes
+
+    @staticmethod
+    @metrics.timed
+    def compact():
+        """
+        Fold the journal into the JSON snapshots and truncate it.
+
+        Returns:
+            bool: True if the journal was compacted, False otherwise.
+
+        Replaying a record twice is harmless, so a crash between rewriting the
+        snapshots and truncating the journal loses nothing.
+        """
+
+        with Storage.lock():
+            for section, filename, key, _ in Storage._sections():
+                if not Storage.save_data(Storage.replay_journal(section, Storage._load_snapshot(section, filename), key),
+                                         filename):
+                    log.error('journal.compact_failed', "Compaction failed; keeping the journal.",
+                              file=Storage.JOURNAL_FILE)
+                    return False
+            open(Storage.JOURNAL_FILE, 'w').close()
+            Storage._journal_length = 0
+            return True
+
+    @staticmethod
+    def migrate_copies():
+        """
+        Migrate BOOKS_FILE from the flat schema, with one record per copy, to
+        one record per ISBN with copy counts.
+
+        Books are merged the same way whenever they are loaded, and saved
+        merged by the next write; this rewrites the file straight away. The
+        SQLite backend is migrated when the database is opened.
+
+        Returns:
+            bool: True if the books are in the new schema, False otherwise.
+        """
+
+        if Storage.BACKEND == 'sqlite':
+            Storage.sqlite_store()
+            log.info('storage.migrated', "{file} is up to date.", file=Storage.DATABASE_FILE)
+            return True
+
+        with Storage.lock():
+            records = Storage.load_data(Storage.BOOKS_FILE)
+            merged = merge_copies(records)
+            if not Storage.save_data(merged, Storage.BOOKS_FILE):
+                return False
+        log.info('storage.migrated', "Migrated {records} book records to {titles} titles.",
+                 records=len(records), titles=len(merged))
+        return True
+
+
+# Write whatever the coalesced and on-exit durability levels still hold
+atexit.register(Storage._flush_at_exit)
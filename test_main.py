@@ -1,9 +1,37 @@
+import asyncio
+import contextlib
+import io
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from unittest.mock import patch
+import sqlite3
+import sqlite_storage
+import json
+import benchmark
+import binary_storage
+import events
+import main
+import metrics
+import pstats
+from server import LibraryServer
+from importer import import_books
+from storage import Storage, StorageError
 from book import BookManager
 from user import UserManager
 from check import CheckManager
-from models import Book
+from stats import CirculationStats
+from history import LoanHistory
+from identifiers import is_valid_isbn, isbn10_to_13, isbn13_to_10, normalize_isbn
+from models import Book, BookTable, merge_copies
 from models import User
 
 class TestLibraryManagementSystem(unittest.TestCase):
@@ -14,13 +42,21 @@ class TestLibraryManagementSystem(unittest.TestCase):
 
     Methods:
         test_add_book: Test adding a new book to the library.
+        test_add_existing_book_is_rejected: Test that adding a book under an ISBN in use changes nothing.
         test_remove_book: Test removing a book from the library.
         test_add_user: Test adding a new user to the library.
         test_remove_user: Test removing a user from the library.
         test_checkout_book: Test checking out a book for a user.
         test_return_book: Test returning a book that was checked out.
+        test_update_book_reindexes_isbn: Test that renaming an ISBN keeps lookups correct.
+        test_update_user_reindexes_id: Test that renaming a user ID keeps lookups correct.
     """
 
+    def setUp(self):
+        # Books and users are mocked, but checkouts and returns also take the
+        # write lock, load holds and append to the loan history
+        use_temp_storage(self)
+
     @patch('storage.Storage.save_books')
     @patch('storage.Storage.load_books', return_value=[])
     def test_add_book(self, mock_load_books, mock_save_books):
@@ -30,6 +66,14 @@ class TestLibraryManagementSystem(unittest.TestCase):
         self.assertIn(new_book, book_manager.books)
         mock_save_books.assert_called_once()
 
+    @patch('storage.Storage.save_books')
+    @patch('storage.Storage.load_books', return_value=[Book(title="1984", author="George Orwell", isbn="978-0451524935", is_checked_out=True)])
+    def test_add_existing_book_is_rejected(self, mock_load_books, mock_save_books):
+        book_manager = BookManager()
+        self.assertFalse(book_manager.add_book(Book(title="1984", author="George Orwell", isbn="9780451524935")))
+        self.assertTrue(book_manager.find_book_by_isbn("978-0451524935")._is_checked_out)
+        mock_save_books.assert_not_called()
+
     @patch('storage.Storage.save_books')
     @patch('storage.Storage.load_books', return_value=[Book(title="1984", author="George Orwell", isbn="978-0451524935")])
     def test_remove_book(self, mock_load_books, mock_save_books):
@@ -77,6 +121,1826 @@ class TestLibraryManagementSystem(unittest.TestCase):
         check_manager.return_book(user_id="U1001", isbn="978-0451524935")
         self.assertFalse(book_manager.find_book_by_isbn("978-0451524935")._is_checked_out)
 
+    @patch('storage.Storage.save_books')
+    @patch('storage.Storage.load_books', return_value=[Book(title="1984", author="George Orwell", isbn="978-0451524935"),
+                                                       Book(title="Dune", author="Frank Herbert", isbn="978-0441172719")])
+    def test_update_book_reindexes_isbn(self, mock_load_books, mock_save_books):
+        book_manager = BookManager()
+        self.assertTrue(book_manager.update_book("978-0451524935", new_isbn="9780451524935"))
+        self.assertEqual([book.isbn for book in book_manager.books], ["978-0441172719", "9780451524935"])
+        self.assertEqual(book_manager.find_book_by_isbn("978-0451524935").isbn, "9780451524935")  # The same ISBN
+        self.assertEqual(book_manager.find_book_by_isbn("9780451524935").title, "1984")
+        self.assertFalse(book_manager.update_book("9780451524935", title="Animal Farm", new_isbn="978-0441172719"))
+        self.assertEqual(book_manager.find_book_by_isbn("9780451524935").title, "1984")
+        self.assertEqual(book_manager.find_book_by_isbn("978-0441172719").title, "Dune")
+
+    @patch('storage.Storage.save_users')
+    @patch('storage.Storage.load_users', return_value=[User(name="Alice Smith", user_id="U1001")])
+    def test_update_user_reindexes_id(self, mock_load_users, mock_save_users):
+        user_manager = UserManager()
+        self.assertTrue(user_manager.update_user("U1001", new_user_id="U2002"))
+        self.assertIsNone(user_manager.find_user_by_id("U1001"))
+        self.assertEqual(user_manager.find_user_by_id("U2002").name, "Alice Smith")
+        user_manager.remove_user("U2002")
+        self.assertEqual(user_manager.users, [])
+
+
+def use_temp_storage(testcase, **overrides):
+    """
+    Point Storage at a fresh temporary directory for the duration of a test.
+
+    Parameters:
+        testcase (unittest.TestCase): The test to register cleanups on.
+        overrides: Extra Storage attributes to patch, e.g. STORAGE_MODE='journal'.
+    """
+
+    tmpdir = tempfile.TemporaryDirectory()
+    testcase.addCleanup(tmpdir.cleanup)
+    # Detach any log handler a test configured, e.g. by running main.main()
+    testcase.addCleanup(events.shutdown)
+    settings = {
+        'BOOKS_FILE': os.path.join(tmpdir.name, 'books.json'),
+        'USERS_FILE': os.path.join(tmpdir.name, 'users.json'),
+        'JOURNAL_FILE': os.path.join(tmpdir.name, 'library.journal'),
+        'DATABASE_FILE': os.path.join(tmpdir.name, 'library.db'),
+        'LOCK_FILE': os.path.join(tmpdir.name, 'library.lock'),
+        'HOLDS_FILE': os.path.join(tmpdir.name, 'holds.json'),
+        'HISTORY_DIR': os.path.join(tmpdir.name, 'history'),
+        'HISTORY_RETENTION_DAYS': None,
+        'BACKEND': 'json',
+        '_sqlite_stores': {},
+        'STORAGE_MODE': 'full',
+        'COMPACT_THRESHOLD': 1000,
+        '_journal_length': None,
+        'DURABILITY': 'immediate',
+        '_dirty': {},
+        '_dirty_count': 0,
+        '_dirty_since': None,
+    }
+    settings.update(overrides)
+    for attr, value in settings.items():
+        patcher = patch.object(Storage, attr, value)
+        patcher.start()
+        testcase.addCleanup(patcher.stop)
+    testcase.addCleanup(lambda: [store.close() for store in settings['_sqlite_stores'].values()])
+    return tmpdir.name
+
+
+class TestSearchBooks(unittest.TestCase):
+    """
+    Tests for full-text search over titles and authors.
+
+    Methods:
+        test_search_ranks_and_prefix_matches: Test multi-term, prefix and ranked queries.
+        test_index_follows_mutations: Test that the index is updated by add, update and remove.
+    """
+
+    def setUp(self):
+        patcher = patch('storage.Storage.save_books')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        books = [Book(title="1984", author="George Orwell", isbn="978-0451524935"),
+                 Book(title="Animal Farm", author="George Orwell", isbn="978-0451526342"),
+                 Book(title="George and the Big Bang", author="Lucy Hawking", isbn="978-1442440067")]
+        with patch('storage.Storage.load_books', return_value=books):
+            self.book_manager = BookManager()
+
+    def test_search_ranks_and_prefix_matches(self):
+        self.assertEqual([b.isbn for b in self.book_manager.search_books("orwell anim")], ["978-0451526342"])
+        self.assertEqual(self.book_manager.search_books("GEORGE")[0].isbn, "978-1442440067")
+        self.assertEqual(len(self.book_manager.search_books("geo")), 3)
+        self.assertEqual(self.book_manager.search_books("orwell hawking"), [])
+        self.assertEqual(self.book_manager.search_books("   "), [])
+
+    def test_index_follows_mutations(self):
+        self.book_manager.search_books("orwell")
+        self.book_manager.add_book(Book(title="Dune", author="Frank Herbert", isbn="978-0441172719"))
+        self.book_manager.update_book("978-0451524935", title="Nineteen Eighty-Four", new_isbn="9780451524935")
+        self.book_manager.remove_book("978-0451526342")
+
+        self.assertEqual([b.isbn for b in self.book_manager.search_books("dune")], ["978-0441172719"])
+        self.assertEqual([b.isbn for b in self.book_manager.search_books("orwell")], ["9780451524935"])
+        self.assertEqual(self.book_manager.search_books("1984"), [])
+        self.assertEqual(self.book_manager.search_books("farm"), [])
+
+
+class TestBulkImport(unittest.TestCase):
+    """
+    Tests for the bulk catalog import pipeline.
+
+    Methods:
+        test_add_books_persists_per_batch: Test de-duplication and one save per batch.
+        test_import_csv_and_jsonl: Test streaming CSV and JSON Lines feeds from disk.
+    """
+
+    @patch('storage.Storage.save_books')
+    @patch('storage.Storage.load_books', return_value=[Book(title="1984", author="George Orwell", isbn="978-0451524935")])
+    def test_add_books_persists_per_batch(self, mock_load_books, mock_save_books):
+        book_manager = BookManager()
+        books = (Book(title=f"Book {i}", author="Author", isbn=f" isbn-{i % 5} ") for i in range(7))
+        progress = []
+        added, skipped = book_manager.add_books(books, batch_size=2, progress=lambda *counts: progress.append(counts))
+
+        self.assertEqual((added, skipped), (5, 2))
+        self.assertEqual(mock_save_books.call_count, 3)
+        self.assertEqual(progress[-1], (5, 2))
+        self.assertEqual(len(book_manager.books), 6)
+        self.assertIsNotNone(book_manager.find_book_by_isbn("isbn-4"))
+
+    def test_import_csv_and_jsonl(self):
+        tmpdir = use_temp_storage(self)
+        csv_path = os.path.join(tmpdir, 'feed.csv')
+        with open(csv_path, 'w') as f:
+            f.write("title,author,isbn\n1984,George Orwell, 978-0451524935 \n,Nobody,123\nDune,Frank Herbert,978-0441172719\n")
+        jsonl_path = os.path.join(tmpdir, 'feed.jsonl')
+        with open(jsonl_path, 'w') as f:
+            f.write('{"title": "Dune", "author": "Frank Herbert", "isbn": "978-0441172719"}\n')
+            f.write('not json\n')
+            f.write('{"title": "Emma", "author": "Jane Austen", "isbn": "978-0141439587"}\n')
+
+        book_manager = BookManager()
+        self.assertEqual(import_books(book_manager, csv_path), (2, 0))
+        self.assertEqual(import_books(book_manager, jsonl_path), (1, 1))
+        self.assertEqual([b.isbn for b in Storage.load_books()],
+                         ["978-0451524935", "978-0441172719", "978-0141439587"])
+
+
+class TestBookTable(unittest.TestCase):
+    """
+    Tests for the compact model representations.
+
+    Methods:
+        test_models_have_no_instance_dict: Test that Book and User use __slots__.
+        test_book_manager_on_book_table: Test managers and checkouts on a columnar BookTable.
+    """
+
+    def test_models_have_no_instance_dict(self):
+        self.assertFalse(hasattr(Book(title="1984", author="George Orwell", isbn="978-0451524935"), '__dict__'))
+        self.assertFalse(hasattr(User(name="Alice Smith", user_id="U1001"), '__dict__'))
+
+    def test_book_manager_on_book_table(self):
+        use_temp_storage(self, BOOK_STORE='table')
+        Storage.save_books([Book(title="1984", author="George Orwell", isbn="978-0451524935"),
+                            Book(title="Dune", author="Frank Herbert", isbn="978-0441172719")])
+        book_manager = BookManager()
+        user_manager = UserManager()
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        self.assertIsInstance(book_manager._books, BookTable)
+
+        book_manager.add_book(Book(title="Emma", author="Jane Austen", isbn="978-0141439587"))
+        book_manager.update_book("978-0451524935", new_isbn="9780451524935")
+        book_manager.remove_book("978-0441172719")
+        self.assertTrue(CheckManager(book_manager, user_manager).check_out_book("U1001", "9780451524935"))
+
+        self.assertEqual([b.isbn for b in book_manager.books], ["9780451524935", "978-0141439587"])
+        self.assertTrue(book_manager.find_book_by_isbn("9780451524935")._is_checked_out)
+        self.assertEqual([b.to_dict() for b in Storage.load_books()], [b.to_dict() for b in book_manager.books])
+
+        book_manager._books.compact()
+        self.assertEqual(len(book_manager._books._isbns), 2)
+        self.assertEqual(book_manager.find_book_by_isbn("978-0141439587").author, "Jane Austen")
+
+
+class TestLazyLoading(unittest.TestCase):
+    """
+    Tests for lazy, memory-mapped loading of the catalog.
+
+    Methods:
+        test_records_materialize_on_demand: Test that only touched records are parsed.
+        test_mutations_and_reload: Test changes on a lazy catalog, in full and journal mode.
+        test_checkout_loads_only_its_user: Test that checking out does not load every user for the loans index.
+    """
+
+    def setUp(self):
+        use_temp_storage(self, LAZY_LOAD=True)
+        Storage.save_books([Book(title=f"Book [{i}] \"{{x}}\"", author="Author", isbn=f"isbn-{i}") for i in range(50)])
+        Storage.save_users([User(name="Alice Smith", user_id="U1001")])
+
+    def test_records_materialize_on_demand(self):
+        book_manager = BookManager()
+        self.assertIsNone(book_manager._books._index)
+        self.assertEqual(book_manager.find_book_by_isbn("isbn-42").title, 'Book [42] "{x}"')
+        self.assertEqual(book_manager._books.materialized, 1)
+        self.assertEqual(len(book_manager._books), 50)
+        self.assertEqual(len(book_manager.books), 50)
+        self.assertEqual(book_manager._books.materialized, 1)
+        self.assertTrue(os.path.exists(Storage.BOOKS_FILE + '.idx'))
+
+        with patch('lazy_storage.scan_records') as mock_scan:
+            self.assertEqual(BookManager().find_book_by_isbn("isbn-7").isbn, "isbn-7")
+            mock_scan.assert_not_called()
+
+    def test_mutations_and_reload(self):
+        for offset, mode in enumerate(('full', 'journal')):
+            renamed, removed, borrowed = (f"isbn-{3 * offset + i}" for i in range(3))
+            with self.subTest(mode=mode):
+                Storage.STORAGE_MODE = mode
+                book_manager = BookManager()
+                user_manager = UserManager()
+                book_manager.add_book(Book(title="Emma", author="Jane Austen", isbn=f"emma-{mode}"))
+                book_manager.update_book(renamed, new_isbn=f"renamed-{mode}")
+                book_manager.remove_book(removed)
+                self.assertTrue(CheckManager(book_manager, user_manager).check_out_book("U1001", borrowed))
+
+                reloaded = BookManager()
+                self.assertIsNone(reloaded.find_book_by_isbn(removed))
+                self.assertIsNotNone(reloaded.find_book_by_isbn(f"renamed-{mode}"))
+                self.assertTrue(reloaded.find_book_by_isbn(borrowed)._is_checked_out)
+                self.assertEqual(reloaded.find_book_by_isbn(f"emma-{mode}").author, "Jane Austen")
+                self.assertEqual(UserManager().find_user_by_id("U1001").borrowed_books, [borrowed])
+                self.assertEqual([b.to_dict() for b in reloaded.books], [b.to_dict() for b in book_manager.books])
+                CheckManager(book_manager, user_manager).return_book("U1001", borrowed)
+
+    def test_checkout_loads_only_its_user(self):
+        Storage.STORAGE_MODE = 'journal'
+        Storage.save_users([User(name=f"User {i}", user_id=f"U{i}") for i in range(50)])
+        user_manager = UserManager()
+        check_manager = CheckManager(BookManager(), user_manager)
+
+        self.assertTrue(check_manager.check_out_book("U7", "isbn-7"))
+        self.assertTrue(check_manager.return_book("U7", "isbn-7"))
+        self.assertTrue(check_manager.check_out_book("U8", "isbn-8"))
+        self.assertEqual(user_manager._users.materialized, 2)
+        self.assertIsNone(check_manager._loans)
+        self.assertEqual(check_manager.who_has("isbn-8"), {"U8"})
+        self.assertEqual(check_manager.who_has("isbn-7"), frozenset())
+
+
+class TestBatchMode(unittest.TestCase):
+    """
+    Tests for the non-interactive batch mode.
+
+    Methods:
+        test_batch_runs_operations_and_saves_once: Test results per operation and one save at the end.
+        test_flush_every: Test persisting every N operations.
+        test_adding_existing_book_fails: Test that a duplicate add_book is reported as failed.
+    """
+
+    def setUp(self):
+        self.tmpdir = use_temp_storage(self)
+        self.ops_path = os.path.join(self.tmpdir, 'ops.jsonl')
+        self.results_path = os.path.join(self.tmpdir, 'results.jsonl')
+        with open(self.ops_path, 'w') as f:
+            for op in [{"op": "add_book", "title": "1984", "author": "George Orwell", "isbn": "978-0451524935"},
+                       {"op": "add_user", "name": "Alice Smith", "user_id": "U1001"},
+                       {"op": "checkout", "user_id": "U1001", "isbn": "978-0451524935"},
+                       {"op": "checkout", "user_id": "U1001", "isbn": "missing"},
+                       {"op": "fly", "isbn": "978-0451524935"},
+                       {"op": "update_user", "name": "Alice Jones"}]:
+                f.write(json.dumps(op) + '\n')
+            f.write('{broken\n')
+
+    def read_results(self):
+        with open(self.results_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_batch_runs_operations_and_saves_once(self):
+        with patch('storage.Storage.save_data', wraps=Storage.save_data) as spy:
+            exit_code = main.main(['--batch', self.ops_path, '--output', self.results_path])
+
+        self.assertEqual(exit_code, 1)
+        results = self.read_results()
+        self.assertEqual([r['ok'] for r in results], [True, True, True, False, False, False, False])
+        self.assertEqual(results[4]['error'], "unknown operation")
+        self.assertIn("missing field", results[5]['error'])
+        self.assertEqual(results[6]['line'], 7)
+        self.assertEqual(spy.call_count, 2)
+        self.assertTrue(Storage.load_books()[0]._is_checked_out)
+        self.assertEqual(Storage.load_users()[0].borrowed_books, ["978-0451524935"])
+
+    def test_flush_every(self):
+        with patch('storage.Storage.save_data', wraps=Storage.save_data) as spy:
+            main.main(['--batch', self.ops_path, '--output', self.results_path, '--flush-every', '2'])
+        # The flushes after ops 2 and 4 write both files; later operations change nothing
+        self.assertEqual(spy.call_count, 4)
+        self.assertEqual(len(self.read_results()), 7)
+
+    def test_adding_existing_book_fails(self):
+        with open(self.ops_path, 'w') as f:
+            for _ in range(2):
+                f.write(json.dumps({"op": "add_book", "title": "1984", "author": "George Orwell",
+                                    "isbn": "978-0451524935"}) + '\n')
+        self.assertEqual(main.main(['--batch', self.ops_path, '--output', self.results_path]), 1)
+        self.assertEqual([r['ok'] for r in self.read_results()], [True, False])
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+    """
+    Smoke test for the benchmark harness.
+
+    Methods:
+        test_run_suite_reports_every_operation: Test that a small run reports every operation and restores Storage.
+    """
+
+    def test_run_suite_reports_every_operation(self):
+        books_file = Storage.BOOKS_FILE
+        for backend, durability in (('json', 'immediate'), ('sqlite', 'immediate'), ('json', 'coalesced')):
+            with self.subTest(backend=backend, durability=durability):
+                result = benchmark.run_suite(50, 5, backend=backend, durability=durability)
+                self.assertEqual(set(result['operations']), {'lookup', 'add', 'update', 'remove', 'checkout',
+                                                             'return', 'list', 'save', 'flush'})
+                self.assertEqual(result['operations']['lookup']['count'], 5)
+                self.assertGreater(result['operations']['checkout']['count'], 0)
+        self.assertEqual(Storage.BOOKS_FILE, books_file)
+
+
+async def http_request(port, method, path, payload=None):
+    """
+    Send one HTTP request to the local server and return (status, JSON body).
+    """
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(content)
+
+
+class TestLibraryServer(unittest.TestCase):
+    """
+    Tests for the asyncio HTTP/JSON service.
+
+    Methods:
+        test_concurrent_clients: Test many clients mutating and reading concurrently, persisted in the background.
+        test_rejects_malformed_requests: Test 400 responses for bad framing and badly typed fields.
+        test_refuses_sqlite_backend: Test that the service does not start on the SQLite backend.
+        test_requests_do_not_wait_for_writes: Test that a slow background write never delays a request.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+
+    def test_concurrent_clients(self):
+        async def scenario():
+            book_manager = BookManager()
+            user_manager = UserManager()
+            server = LibraryServer(book_manager, user_manager, CheckManager(book_manager, user_manager),
+                                   flush_interval=0.01)
+            port = (await server.start('127.0.0.1', 0)).sockets[0].getsockname()[1]
+            try:
+                created = await asyncio.gather(*(
+                    http_request(port, 'POST', '/books', {"title": f"Book {i}", "author": "Author", "isbn": f"isbn-{i}"})
+                    for i in range(10)), *(
+                    http_request(port, 'POST', '/users', {"name": f"Patron {i}", "user_id": f"U{i}"})
+                    for i in range(10)))
+                self.assertEqual({status for status, _ in created}, {201})
+
+                checkouts = await asyncio.gather(*(
+                    http_request(port, 'POST', '/checkouts', {"user_id": f"U{i}", "isbn": "isbn-0" if i < 2 else f"isbn-{i}"})
+                    for i in range(10)))
+                self.assertEqual(sorted(status for status, _ in checkouts), [200] * 9 + [409])
+
+                self.assertEqual((await http_request(port, 'GET', '/books/isbn-5'))[1]['checked_out'], 1)
+                self.assertEqual((await http_request(port, 'GET', '/books?q=book'))[0], 200)
+                status, missing = await http_request(port, 'GET', '/books/isbn-55')
+                self.assertEqual(status, 404)
+                self.assertEqual(missing['suggestions'], ["isbn-5"])  # One deletion away; the others take two edits
+                self.assertEqual((await http_request(port, 'POST', '/returns', {"user_id": "U5"}))[0], 400)
+                self.assertEqual((await http_request(port, 'DELETE', '/users/U9'))[0], 200)
+                status, reports = await http_request(port, 'GET', '/reports?k=1')
+                self.assertEqual(status, 200)
+                self.assertEqual(reports['summary']['checked_out'], 9)
+                self.assertEqual(reports['top_authors'], [{'author': "Author", 'checkouts': 9}])
+                await asyncio.sleep(0.1)
+                self.assertEqual(len(Storage.load_books()), 10)
+            finally:
+                await server.close()
+
+        asyncio.run(scenario())
+        self.assertEqual(sum(book._is_checked_out for book in Storage.load_books()), 9)
+        self.assertEqual(len(Storage.load_users()), 9)
+        self.assertIsNone(Storage._deferred)
+
+    def test_rejects_malformed_requests(self):
+        async def scenario():
+            book_manager = BookManager()
+            user_manager = UserManager()
+            server = LibraryServer(book_manager, user_manager, CheckManager(book_manager, user_manager))
+            port = (await server.start('127.0.0.1', 0)).sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b"POST /books HTTP/1.1\r\nContent-Length: ten\r\n\r\n")
+                await writer.drain()
+                response = await asyncio.wait_for(reader.read(), 5)
+                writer.close()
+                self.assertEqual(response.split()[1], b'400')
+
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b"GARBAGE\r\n\r\n")
+                await writer.drain()
+                response = await asyncio.wait_for(reader.read(), 5)
+                writer.close()
+                self.assertEqual(response.split()[1], b'400')
+
+                # Failed mutations leave nothing to write
+                self.assertEqual(server.dispatch('POST', '/checkouts', b'{"user_id": "U1", "isbn": "x"}')[0], 409)
+                self.assertEqual(server.dispatch('DELETE', '/books/x', b'')[0], 404)
+                self.assertFalse(server._dirty.is_set())
+
+                for fields in ({"copies": "two"}, {"copies": -1}, {"copies": True}, {"isbn": 978}, {"title": ""}):
+                    payload = {"title": "1984", "author": "George Orwell", "isbn": "978-0451524935", **fields}
+                    self.assertEqual((await http_request(port, 'POST', '/books', payload))[0], 400)
+                self.assertEqual((await http_request(port, 'POST', '/books', {"title": "1984", "author": "George Orwell",
+                                                                               "isbn": "978-0451524935"}))[0], 201)
+                self.assertEqual((await http_request(port, 'PATCH', '/books/978-0451524935', {"copies": 1.5}))[0], 400)
+                self.assertEqual((await http_request(port, 'POST', '/checkouts', {"user_id": ["U1"], "isbn": "978-0451524935"}))[0], 400)
+            finally:
+                await server.close()
+
+        asyncio.run(scenario())
+        self.assertEqual([book.copies for book in Storage.load_books()], [1])
+
+    def test_refuses_sqlite_backend(self):
+        use_temp_storage(self, BACKEND='sqlite')
+        book_manager = BookManager()
+        user_manager = UserManager()
+        server = LibraryServer(book_manager, user_manager, CheckManager(book_manager, user_manager))
+        with self.assertRaises(StorageError):
+            asyncio.run(server.start('127.0.0.1', 0))
+
+
+    def test_requests_do_not_wait_for_writes(self):
+        write_staged = Storage._write_staged
+
+        def slow_write_staged(data, filename):
+            time.sleep(0.5)
+            return write_staged(data, filename)
+
+        async def scenario():
+            book_manager = BookManager()
+            user_manager = UserManager()
+            server = LibraryServer(book_manager, user_manager, CheckManager(book_manager, user_manager),
+                                   flush_interval=0.01)
+            port = (await server.start('127.0.0.1', 0)).sockets[0].getsockname()[1]
+            try:
+                await http_request(port, 'POST', '/books', {"title": "1984", "author": "George Orwell",
+                                                            "isbn": "978-0451524935"})
+                await http_request(port, 'POST', '/users', {"name": "Alice Smith", "user_id": "U1001"})
+                await asyncio.sleep(0.1)  # The writer is now part way through a slow write
+
+                start = time.perf_counter()
+                status, _ = await http_request(port, 'POST', '/checkouts', {"user_id": "U1001", "isbn": "978-0451524935"})
+                self.assertEqual(status, 200)
+                self.assertLess(time.perf_counter() - start, 0.25)
+            finally:
+                await server.close()
+
+        with patch.object(Storage, '_write_staged', side_effect=slow_write_staged):
+            asyncio.run(scenario())
+        self.assertEqual(Storage.load_books()[0].checked_out, 1)
+
+
+class TestJournaledStorage(unittest.TestCase):
+    """
+    Tests for the append-only journal storage mode.
+
+    Methods:
+        test_mutations_append_to_journal: Test that mutations append records and reload correctly.
+        test_compaction_folds_journal_into_snapshot: Test that compaction rewrites the snapshots.
+    """
+
+    def setUp(self):
+        use_temp_storage(self, STORAGE_MODE='journal')
+
+    def test_mutations_append_to_journal(self):
+        book_manager = BookManager()
+        book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        book_manager.add_book(Book(title="Dune", author="Frank Herbert", isbn="978-0441172719"))
+        book_manager.update_book("978-0451524935", new_isbn="9780451524935")
+        book_manager.remove_book("978-0441172719")
+        user_manager = UserManager()
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+
+        self.assertFalse(os.path.exists(Storage.BOOKS_FILE))
+        with open(Storage.JOURNAL_FILE) as f:
+            self.assertEqual(len(f.readlines()), 5)
+
+        reloaded = BookManager()
+        self.assertEqual([book.isbn for book in reloaded.books], ["9780451524935"])
+        self.assertEqual(UserManager().find_user_by_id("U1001").name, "Alice Smith")
+
+    def test_compaction_folds_journal_into_snapshot(self):
+        Storage.COMPACT_THRESHOLD = 3
+        book_manager = BookManager()
+        for i in range(4):
+            book_manager.add_book(Book(title=f"Book {i}", author="Author", isbn=f"isbn-{i}"))
+
+        self.assertEqual(len(Storage.load_data(Storage.BOOKS_FILE)), 3)
+        with open(Storage.JOURNAL_FILE) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual(len(BookManager().books), 4)
+
+
+class TestCheckoutTransaction(unittest.TestCase):
+    """
+    Tests for persisting checkouts and returns as one transaction.
+
+    Methods:
+        test_checkout_persists_book_and_user: Test that both files are saved.
+        test_checkout_rolls_back_on_failure: Test that a failed save rolls back both objects.
+        test_journaled_checkout_is_one_record: Test that a checkout appends a single journal record.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+        self.book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        self.user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        self.check_manager = CheckManager(self.book_manager, self.user_manager)
+
+    def test_checkout_persists_book_and_user(self):
+        self.assertTrue(self.check_manager.check_out_book("U1001", "978-0451524935"))
+        self.assertTrue(Storage.load_books()[0]._is_checked_out)
+        self.assertEqual(Storage.load_users()[0].borrowed_books, ["978-0451524935"])
+
+        self.assertTrue(self.check_manager.return_book("U1001", "978-0451524935"))
+        self.assertFalse(Storage.load_books()[0]._is_checked_out)
+        self.assertEqual(Storage.load_users()[0].borrowed_books, [])
+
+    def test_checkout_rolls_back_on_failure(self):
+        with patch('storage.os.replace', side_effect=OSError("disk full")):
+            self.assertFalse(self.check_manager.check_out_book("U1001", "978-0451524935"))
+
+        self.assertFalse(self.book_manager.find_book_by_isbn("978-0451524935")._is_checked_out)
+        self.assertEqual(self.user_manager.find_user_by_id("U1001").borrowed_books, [])
+        self.assertFalse(Storage.load_books()[0]._is_checked_out)
+        self.assertFalse(os.path.exists(Storage.BOOKS_FILE + '.tmp'))
+
+    def test_journaled_checkout_is_one_record(self):
+        Storage.STORAGE_MODE = 'journal'
+        self.assertTrue(self.check_manager.check_out_book("U1001", "978-0451524935"))
+        with open(Storage.JOURNAL_FILE) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(Storage.load_books()[0]._is_checked_out)
+        self.assertEqual(Storage.load_users()[0].borrowed_books, ["978-0451524935"])
+
+
+class TestLoanIndex(unittest.TestCase):
+    """
+    Tests for the loans index behind who_has and loans_for.
+
+    Methods:
+        test_index_follows_checkouts_and_returns: Test that checkouts and returns update the index.
+        test_index_is_rebuilt_on_load: Test that a new CheckManager rebuilds the index from saved data.
+        test_rebuild_reports_inconsistencies: Test that loans disagreeing with the books are reported.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+        self.book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        self.book_manager.add_book(Book(title="The Alchemist", author="Paulo Coelho", isbn="978-0062315007"))
+        self.user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        self.check_manager = CheckManager(self.book_manager, self.user_manager)
+
+    def test_index_follows_checkouts_and_returns(self):
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), frozenset())
+        self.check_manager.check_out_book("U1001", "978-0451524935")
+        self.check_manager.check_out_book("U1001", " 978-0062315007 ")
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U1001"})
+        self.assertEqual(self.check_manager.loans_for("U1001"), {"978-0451524935", "978-0062315007"})
+
+        self.check_manager.return_book("U1001", "978-0451524935")
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), frozenset())
+        self.assertEqual(self.check_manager.loans_for("U1001"), {"978-0062315007"})
+        self.assertEqual(self.check_manager.loans_for("U9999"), frozenset())
+
+    def test_index_is_rebuilt_on_load(self):
+        self.check_manager.check_out_book("U1001", "978-0451524935")
+        check_manager = CheckManager(BookManager(), UserManager())
+        self.assertEqual(check_manager.who_has("978-0451524935"), {"U1001"})
+        self.assertEqual(check_manager.rebuild_loans(), [])
+
+    def test_rebuild_reports_inconsistencies(self):
+        self.user_manager.find_user_by_id("U1001").borrowed_books.append("978-0451524935")
+        self.book_manager.find_book_by_isbn("978-0062315007")._is_checked_out = True
+        problems = self.check_manager.rebuild_loans()
+        self.assertEqual(len(problems), 2)
+        self.assertIn("has 0 of 1 copies checked out", problems[0])
+        self.assertIn("nobody has borrowed them", problems[1])
+
+
+class TestDueDates(unittest.TestCase):
+    """
+    Tests for loan due dates and the overdue queries.
+
+    Methods:
+        test_overdue_and_due_within: Test that the queries return loans in due date order.
+        test_due_dates_survive_reload: Test that due dates are persisted and re-indexed on load.
+        test_sqlite_database_is_migrated: Test that an existing database gains the date columns.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.now = datetime(2024, 3, 1, 12, 0)
+
+    def build(self):
+        book_manager = BookManager()
+        user_manager = UserManager()
+        for i in range(4):
+            book_manager.add_book(Book(title=f"Book {i}", author="Author", isbn=f"978-{i:010d}"))
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        user_manager.add_user(User(name="Bob Jones", user_id="U1002"))
+        check_manager = CheckManager(book_manager, user_manager)
+        for i, days in enumerate((-3, 5, -1, 20)):
+            check_manager.check_out_book(f"U100{i % 2 + 1}", f"978-{i:010d}", due_date=self.now + timedelta(days=days))
+        return check_manager
+
+    def test_overdue_and_due_within(self):
+        check_manager = self.build()
+        self.assertEqual(check_manager.overdue(self.now), [
+            ("978-0000000000", "U1001", self.now - timedelta(days=3)),
+            ("978-0000000002", "U1001", self.now - timedelta(days=1)),
+        ])
+        self.assertEqual([isbn for isbn, _, _ in check_manager.due_within(7, self.now)],
+                         ["978-0000000000", "978-0000000002", "978-0000000001"])
+
+        check_manager.return_book("U1001", "978-0000000000")
+        self.assertEqual([isbn for isbn, _, _ in check_manager.overdue(self.now)], ["978-0000000002"])
+        # Asking again gives the same answer; nothing was consumed
+        self.assertEqual([isbn for isbn, _, _ in check_manager.overdue(self.now)], ["978-0000000002"])
+
+    def test_due_dates_survive_reload(self):
+        for backend in ('json', 'sqlite'):
+            with self.subTest(backend=backend), patch.object(Storage, 'BACKEND', backend):
+                self.build()
+                Storage._sqlite_stores.clear()
+                check_manager = CheckManager(BookManager(), UserManager())
+                self.assertEqual([isbn for isbn, _, _ in check_manager.overdue(self.now)],
+                                 ["978-0000000000", "978-0000000002"])
+                dates = UserManager().find_user_by_id("U1002").loan_dates["978-0000000001"]
+                self.assertEqual(dates['due'], (self.now + timedelta(days=5)).isoformat())
+
+    def test_sqlite_database_is_migrated(self):
+        conn = sqlite3.connect(Storage.DATABASE_FILE)
+        conn.executescript("""
+            CREATE TABLE loans (isbn TEXT PRIMARY KEY, user_id TEXT NOT NULL);
+            INSERT INTO loans VALUES ('978-0451524935', 'U1001');
+        """)
+        conn.close()
+
+        store = sqlite_storage.SQLiteStore(Storage.DATABASE_FILE)
+        self.addCleanup(store.close)
+        columns = {row[1] for row in store.conn.execute("PRAGMA table_info(loans)")}
+        self.assertTrue({'checked_out_at', 'due_date'} <= columns)
+        self.assertEqual(store.borrowers_of('978-0451524935'), ['U1001'])
+
+
+class TestHolds(unittest.TestCase):
+    """
+    Tests for hold queues on checked-out books.
+
+    Methods:
+        test_place_and_cancel_holds: Test the rules for placing and cancelling holds.
+        test_return_allocates_to_next_holder: Test that a returned book goes to the first holder.
+        test_holds_survive_restart: Test that hold queues are persisted in every storage mode.
+        test_removed_holder_is_skipped: Test that a removed user's hold is dropped on return.
+        test_unsaved_skip_leaves_copy_on_shelf: Test that a removed holder whose hold cannot be dropped stops allocation.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.build()
+
+    def build(self):
+        self.reopen()
+        self.book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        for i in range(1, 4):
+            self.user_manager.add_user(User(name=f"User {i}", user_id=f"U{i}"))
+
+    def reopen(self):
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+        self.check_manager = CheckManager(self.book_manager, self.user_manager)
+
+    def test_place_and_cancel_holds(self):
+        self.assertFalse(self.check_manager.place_hold("U2", "978-0451524935"))  # Available
+        self.check_manager.check_out_book("U1", "978-0451524935")
+        self.assertFalse(self.check_manager.place_hold("U1", "978-0451524935"))  # Already has it
+        self.assertTrue(self.check_manager.place_hold("U2", "978-0451524935"))
+        self.assertFalse(self.check_manager.place_hold("U2", "978-0451524935"))  # Already waiting
+        self.assertTrue(self.check_manager.place_hold("U3", "978-0451524935"))
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), ["U2", "U3"])
+        self.assertEqual(self.check_manager.holds_for("U3"), {"978-0451524935"})
+
+        self.assertTrue(self.check_manager.cancel_hold("U2", "978-0451524935"))
+        self.assertFalse(self.check_manager.cancel_hold("U2", "978-0451524935"))
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), ["U3"])
+        self.assertEqual(self.check_manager.holds_for("U2"), frozenset())
+
+    def test_return_allocates_to_next_holder(self):
+        self.check_manager.check_out_book("U1", "978-0451524935")
+        self.check_manager.place_hold("U2", "978-0451524935")
+        self.check_manager.place_hold("U3", "978-0451524935")
+
+        self.assertTrue(self.check_manager.return_book("U1", "978-0451524935"))
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U2"})
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), ["U3"])
+
+        # Once returned again, the book is kept for U3 rather than the first to ask
+        with patch.object(self.check_manager, '_allocate'):
+            self.check_manager.return_book("U2", "978-0451524935")
+        self.assertFalse(self.check_manager.check_out_book("U1", "978-0451524935"))
+        self.assertTrue(self.check_manager.check_out_book("U3", "978-0451524935"))
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), [])
+
+    def test_holds_survive_restart(self):
+        for mode in ('full', 'journal', 'sqlite'):
+            with self.subTest(mode=mode), patch.object(Storage, 'STORAGE_MODE', 'journal' if mode == 'journal' else 'full'), \
+                    patch.object(Storage, 'BACKEND', 'sqlite' if mode == 'sqlite' else 'json'), \
+                    patch.object(Storage, 'JOURNAL_FILE', Storage.JOURNAL_FILE + mode), \
+                    patch.object(Storage, 'BOOKS_FILE', Storage.BOOKS_FILE + mode), \
+                    patch.object(Storage, 'USERS_FILE', Storage.USERS_FILE + mode), \
+                    patch.object(Storage, 'HOLDS_FILE', Storage.HOLDS_FILE + mode):
+                self.build()
+                self.check_manager.check_out_book("U1", "978-0451524935")
+                self.check_manager.place_hold("U3", "978-0451524935")
+                self.check_manager.place_hold("U2", "978-0451524935")
+                Storage._sqlite_stores.clear()
+
+                self.reopen()
+                self.assertEqual(self.check_manager.hold_queue("978-0451524935"), ["U3", "U2"])
+                self.check_manager.return_book("U1", "978-0451524935")
+                Storage._sqlite_stores.clear()
+
+                self.reopen()
+                self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U3"})
+                self.assertEqual(self.check_manager.hold_queue("978-0451524935"), ["U2"])
+
+    def test_removed_holder_is_skipped(self):
+        self.check_manager.check_out_book("U1", "978-0451524935")
+        self.check_manager.place_hold("U2", "978-0451524935")
+        self.check_manager.place_hold("U3", "978-0451524935")
+        self.user_manager.remove_user("U2")
+
+        self.check_manager.return_book("U1", "978-0451524935")
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U3"})
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), [])
+
+    def test_unsaved_skip_leaves_copy_on_shelf(self):
+        self.check_manager.check_out_book("U1", "978-0451524935")
+        self.check_manager.place_hold("U2", "978-0451524935")
+        self.check_manager.place_hold("U3", "978-0451524935")
+        self.user_manager.remove_user("U2")
+
+        # Retrying the same holder would exhaust the side effects instead of looping forever
+        with patch.object(self.check_manager, '_persist_holds', side_effect=[False] * 3) as persist_holds:
+            self.assertTrue(self.check_manager.return_book("U1", "978-0451524935"))
+        self.assertEqual(persist_holds.call_count, 1)
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), set())
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), ["U2", "U3"])
+
+
+class TestInventory(unittest.TestCase):
+    """
+    Tests for books with several copies.
+
+    Methods:
+        test_copies_are_checked_out_by_count: Test that each copy can be lent to a different user.
+        test_copies_in_every_store: Test that the copy counts work in every in-memory store and backend.
+        test_copies_cannot_drop_below_loans: Test that copies on loan cannot be removed.
+        test_flat_books_file_is_migrated: Test that books listed once per copy are merged.
+        test_flat_books_file_is_merged_on_load: Test that copies are never lost without migrating first.
+        test_sqlite_database_is_migrated: Test that an existing database gains copy counts.
+        test_checkout_fills_hold_anywhere_in_queue: Test that a queued user's checkout drops their hold.
+        test_holder_with_a_copy_is_skipped: Test that a returned copy skips a holder who already has one.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+
+    def build(self, copies=2):
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+        self.book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935", copies=copies))
+        for i in range(1, 4):
+            self.user_manager.add_user(User(name=f"User {i}", user_id=f"U{i}"))
+        self.check_manager = CheckManager(self.book_manager, self.user_manager)
+
+    def test_copies_are_checked_out_by_count(self):
+        self.build()
+        self.assertTrue(self.check_manager.check_out_book("U1", "978-0451524935"))
+        self.assertFalse(self.check_manager.check_out_book("U1", "978-0451524935"))  # One copy each
+        self.assertTrue(self.check_manager.check_out_book("U2", "978-0451524935"))
+        self.assertFalse(self.check_manager.check_out_book("U3", "978-0451524935"))
+        book = self.book_manager.find_book_by_isbn("978-0451524935")
+        self.assertEqual((book.copies, book.checked_out, book.available), (2, 2, 0))
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U1", "U2"})
+
+        self.assertTrue(self.check_manager.place_hold("U3", "978-0451524935"))
+        self.check_manager.return_book("U1", "978-0451524935")
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U2", "U3"})
+        self.assertEqual(self.check_manager.rebuild_loans(), [])
+        self.assertIn("0 of 2 copies available", str(book))
+
+    def test_copies_in_every_store(self):
+        for backend, store in (('json', 'dict'), ('json', 'table'), ('sqlite', 'dict')):
+            with self.subTest(backend=backend, store=store), patch.object(Storage, 'BACKEND', backend), \
+                    patch.object(Storage, 'BOOK_STORE', store), \
+                    patch.object(Storage, 'BOOKS_FILE', f"{Storage.BOOKS_FILE}.{store}"), \
+                    patch.object(Storage, 'USERS_FILE', f"{Storage.USERS_FILE}.{store}"):
+                self.build(copies=3)
+                self.check_manager.check_out_book("U1", "978-0451524935")
+                self.check_manager.check_out_book("U2", "978-0451524935")
+                self.check_manager.return_book("U1", "978-0451524935")
+                Storage._sqlite_stores.clear()
+
+                book = BookManager().find_book_by_isbn("978-0451524935")
+                self.assertEqual((book.copies, book.checked_out), (3, 1))
+                self.assertEqual(CheckManager(BookManager(), UserManager()).who_has("978-0451524935"), {"U2"})
+
+    def test_copies_cannot_drop_below_loans(self):
+        self.build()
+        self.check_manager.check_out_book("U1", "978-0451524935")
+        self.check_manager.check_out_book("U2", "978-0451524935")
+        self.assertFalse(self.book_manager.update_book("978-0451524935", copies=1))
+        self.assertTrue(self.book_manager.update_book("978-0451524935", copies=3))
+        self.assertTrue(self.check_manager.check_out_book("U3", "978-0451524935"))
+        self.assertEqual(Storage.load_books()[0].to_dict()['checked_out'], 3)
+
+    def test_flat_books_file_is_migrated(self):
+        flat = [
+            {"title": "1984", "author": "George Orwell", "isbn": "978-0451524935", "is_checked_out": True},
+            {"title": "The Alchemist", "author": "Paulo Coelho", "isbn": "978-0062315007", "is_checked_out": False},
+            {"title": "1984", "author": "George Orwell", "isbn": " 978-0451524935", "is_checked_out": False},
+            {"title": "1984", "author": "George Orwell", "isbn": "978-0451524935", "is_checked_out": True},
+        ]
+        with open(Storage.BOOKS_FILE, 'w') as f:
+            json.dump(flat, f)
+
+        self.assertEqual(main.main(['migrate']), 0)
+        self.assertEqual(main.main(['migrate']), 0)  # Already migrated; nothing changes
+        books = BookManager()
+        self.assertEqual(len(books.books), 2)
+        book = books.find_book_by_isbn("978-0451524935")
+        self.assertEqual((book.copies, book.checked_out), (3, 2))
+        book = books.find_book_by_isbn("978-0062315007")
+        self.assertEqual((book.copies, book.checked_out), (1, 0))
+
+    def test_flat_books_file_is_merged_on_load(self):
+        flat = [{"title": "Dune", "author": "Frank Herbert", "isbn": "978-0441172719", "is_checked_out": checked_out}
+                for checked_out in (True, False, False)]
+        for settings in ({}, {'BOOK_STORE': 'table'}, {'LAZY_LOAD': True}, {'STORAGE_MODE': 'journal'}):
+            with self.subTest(**settings), contextlib.ExitStack() as stack:
+                for attr, value in settings.items():
+                    stack.enter_context(patch.object(Storage, attr, value))
+                with open(Storage.BOOKS_FILE, 'w') as f:
+                    json.dump(flat, f)
+
+                books = BookManager()
+                book = books.find_book_by_isbn("978-0441172719")
+                self.assertEqual((book.copies, book.checked_out), (3, 1))
+                self.assertTrue(books.add_book(Book(title="Emma", author="Jane Austen", isbn="978-0141439587")))
+                Storage.compact()
+                self.assertEqual([(b.isbn, b.copies, b.checked_out) for b in Storage.load_books()],
+                                 [("978-0441172719", 3, 1), ("978-0141439587", 1, 0)])
+                os.remove(Storage.BOOKS_FILE)
+
+    def test_sqlite_database_is_migrated(self):
+        conn = sqlite3.connect(Storage.DATABASE_FILE)
+        conn.executescript("""
+            CREATE TABLE books (isbn TEXT PRIMARY KEY, title TEXT NOT NULL, author TEXT NOT NULL,
+                                is_checked_out INTEGER NOT NULL DEFAULT 0);
+            INSERT INTO books VALUES ('978-0451524935', '1984', 'George Orwell', 1);
+            CREATE TABLE loans (isbn TEXT PRIMARY KEY, user_id TEXT NOT NULL);
+            INSERT INTO loans VALUES ('978-0451524935', 'U1');
+        """)
+        conn.close()
+
+        store = sqlite_storage.SQLiteStore(Storage.DATABASE_FILE)
+        self.addCleanup(store.close)
+        book = store.books['978-0451524935']
+        self.assertEqual((book.copies, book.checked_out), (1, 1))
+
+        book.copies = 2
+        book.check_out()
+        store.write('books', {book.isbn: book})
+        store.write('users', {'U2': User(name="User 2", user_id="U2", borrowed_books=[book.isbn])})
+        self.assertEqual(store.borrowers_of('978-0451524935'), ['U1', 'U2'])
+
+    def test_checkout_fills_hold_anywhere_in_queue(self):
+        self.build(copies=1)
+        self.user_manager.add_user(User(name="User 4", user_id="U4"))
+        self.check_manager.check_out_book("U1", "978-0451524935")
+        self.check_manager.place_hold("U2", "978-0451524935")
+        self.check_manager.place_hold("U3", "978-0451524935")
+        self.book_manager.update_book("978-0451524935", copies=4)
+
+        self.assertTrue(self.check_manager.check_out_book("U3", "978-0451524935"))
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), ["U2"])
+        self.assertTrue(self.check_manager.check_out_book("U2", "978-0451524935"))
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), [])
+        self.assertTrue(self.check_manager.check_out_book("U4", "978-0451524935"))
+        self.assertTrue(self.check_manager.return_book("U1", "978-0451524935"))
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U2", "U3", "U4"})
+
+    def test_holder_with_a_copy_is_skipped(self):
+        self.build()
+        self.check_manager.check_out_book("U1", "978-0451524935")
+        self.check_manager.check_out_book("U2", "978-0451524935")
+        self.check_manager.holds.place("978-0451524935", "U2")  # Left over from before the checkout
+        self.check_manager.place_hold("U3", "978-0451524935")
+
+        self.assertTrue(self.check_manager.return_book("U1", "978-0451524935"))
+        self.assertEqual(self.check_manager.who_has("978-0451524935"), {"U2", "U3"})
+        self.assertEqual(self.check_manager.hold_queue("978-0451524935"), [])
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests for the opt-in instrumentation and the --profile flag.
+
+    Methods:
+        test_operations_are_timed_and_counted: Test that lookups, mutations and writes are recorded.
+        test_disabled_by_default: Test that nothing is recorded unless enabled.
+        test_max_and_count_cover_every_call: Test that only the percentiles are limited to the sample window.
+        test_profile_flag: Test that --profile prints the statistics and a cProfile report to standard error.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        patcher = patch.object(metrics, 'ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_operations_are_timed_and_counted(self):
+        book_manager = BookManager()
+        user_manager = UserManager()
+        book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        check_manager = CheckManager(book_manager, user_manager)
+        for _ in range(3):
+            book_manager.find_book_by_isbn("978-0451524935")
+        check_manager.check_out_book("U1001", "978-0451524935")
+
+        stats = metrics.snapshot()
+        timers = stats['timers']
+        self.assertEqual(timers['BookManager.find_book_by_isbn']['count'], 4)
+        self.assertEqual(timers['CheckManager.check_out_book']['count'], 1)
+        self.assertEqual(timers['Storage.save_data']['count'], 4)  # Two adds, then the checkout's book and user
+        for timer in timers.values():
+            self.assertLessEqual(timer['p50'], timer['p99'])
+            self.assertLessEqual(timer['p99'], timer['max'])
+        written = sum(os.path.getsize(f) for f in (Storage.BOOKS_FILE, Storage.USERS_FILE))
+        self.assertGreaterEqual(stats['counters']['storage.bytes_written'], written)
+
+    def test_disabled_by_default(self):
+        metrics.enable(False)
+        BookManager().find_book_by_isbn("978-0451524935")
+        self.assertEqual(metrics.snapshot(), {'timers': {}, 'counters': {}})
+
+    def test_max_and_count_cover_every_call(self):
+        metrics.record('slow', 5.0)
+        for _ in range(metrics.SAMPLES):
+            metrics.record('slow', 0.001)
+
+        timer = metrics.snapshot()['timers']['slow']
+        self.assertEqual(timer['count'], metrics.SAMPLES + 1)
+        self.assertEqual(timer['max'], 5.0)
+        self.assertEqual(timer['window'], metrics.SAMPLES)
+        self.assertEqual(timer['p99'], 0.001)
+
+    def test_profile_flag(self):
+        profile_path = os.path.join(os.path.dirname(Storage.BOOKS_FILE), 'migrate.prof')
+        output, errors = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+            self.assertEqual(main.main(['--profile', 'migrate']), 0)
+            main.main(['--profile', '--profile-output', profile_path, 'migrate'])
+        self.assertIn("Operation statistics", errors.getvalue())
+        self.assertIn("Storage.save_data", errors.getvalue())
+        self.assertIn("cumulative", errors.getvalue())
+        self.assertNotIn("Operation statistics", output.getvalue())
+        self.assertGreater(pstats.Stats(profile_path).total_calls, 0)
+
+
+class TestEvents(unittest.TestCase):
+    """
+    Tests for the structured event log.
+
+    Methods:
+        test_json_lines_file: Test that events are written to a file as JSON lines with their fields.
+        test_level_filters_events: Test that debug events are only written at the DEBUG level.
+        test_text_format: Test that the text format shows the plain messages.
+        test_batch_events_go_to_stderr: Test that a batch run keeps events out of its results.
+    """
+
+    def setUp(self):
+        self.tmpdir = use_temp_storage(self)
+        self.log_path = os.path.join(self.tmpdir, 'library.log')
+
+    def read_events(self):
+        events.shutdown()  # Writes out whatever the listener still has queued
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines_file(self):
+        events.configure(level='INFO', fmt='json', path=self.log_path)
+        book_manager = BookManager()
+        user_manager = UserManager()
+        book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        CheckManager(book_manager, user_manager).check_out_book("U1001", "978-0451524935")
+        book_manager.remove_book("000-0000000000")
+
+        logged = self.read_events()
+        self.assertEqual([event['event'] for event in logged],
+                         ['book.added', 'user.added', 'checkout.done', 'book.not_found'])
+        self.assertEqual(logged[0]['isbn'], "978-0451524935")
+        self.assertEqual(logged[0]['message'], "Book '1984' added successfully.")
+        self.assertEqual(logged[0]['logger'], 'library.book')
+        self.assertEqual(logged[2]['user_id'], "U1001")
+        self.assertEqual(logged[3]['level'], 'WARNING')
+
+    def test_level_filters_events(self):
+        book_manager = BookManager()
+        book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+
+        events.configure(level='INFO', fmt='json', path=self.log_path)
+        book_manager.find_book_by_isbn("978-0451524935")
+        self.assertEqual(self.read_events(), [])
+
+        events.configure(level='DEBUG', fmt='json', path=self.log_path)
+        book_manager.find_book_by_isbn("978-0451524935")
+        self.assertEqual([event['event'] for event in self.read_events()], ['book.found'])
+
+    def test_text_format(self):
+        output = io.StringIO()
+        events.configure(level='INFO', fmt='text', stream=output, background=False)
+        BookManager().add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        self.assertEqual(output.getvalue(), "Book '1984' added successfully.\n")
+
+    def test_batch_events_go_to_stderr(self):
+        ops_path = os.path.join(self.tmpdir, 'ops.jsonl')
+        with open(ops_path, 'w') as f:
+            f.write(json.dumps({'op': 'add_user', 'name': "Alice Smith", 'user_id': "U1001"}) + '\n')
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            self.assertEqual(main.main(['--batch', ops_path, '--log-format', 'json']), 0)
+            events.shutdown()
+
+        self.assertEqual([json.loads(line)['ok'] for line in stdout.getvalue().splitlines()], [True])
+        self.assertEqual([json.loads(line)['event'] for line in stderr.getvalue().splitlines()], ['user.added'])
+
+
+class TestPagination(unittest.TestCase):
+    """
+    Tests for the streaming, paginated listings.
+
+    Methods:
+        test_sorted_pages_follow_cursors: Test that cursor pages walk the sorted index as the catalog changes.
+        test_filter_offset_and_limit: Test filtering and offset paging in insertion order.
+        test_users_sorted_by_name: Test that user listings are sorted and kept up to date.
+        test_cli_pages_lazily: Test that the CLI only draws the records it shows.
+        test_server_pages: Test the paging query parameters of the HTTP service.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.book_manager = BookManager()
+        titles = ["Dune", "animal farm", "Brave New World", "Emma", "Catch-22"]
+        self.book_manager.add_books(Book(title=title, author=f"Author {len(titles) - i}", isbn=f"isbn-{i}")
+                                    for i, title in enumerate(titles))
+
+    def titles(self, books):
+        return [book.title for book in books]
+
+    def test_sorted_pages_follow_cursors(self):
+        first = list(self.book_manager.iter_books(sort='title', limit=2))
+        self.assertEqual(self.titles(first), ["animal farm", "Brave New World"])
+
+        # Changes between pages are picked up by the maintained index
+        self.book_manager.add_book(Book(title="Beloved", author="Toni Morrison", isbn="isbn-9"))
+        self.book_manager.add_book(Book(title="Carrie", author="Stephen King", isbn="isbn-8"))
+        self.book_manager.remove_book("isbn-4")
+        self.book_manager.update_book("isbn-0", title="Anna Karenina")
+        second = list(self.book_manager.iter_books(sort='title', limit=2, after=first[-1].isbn))
+        self.assertEqual(self.titles(second), ["Carrie", "Emma"])
+        self.assertEqual(self.titles(self.book_manager.iter_books(sort='title')),
+                         ["animal farm", "Anna Karenina", "Beloved", "Brave New World", "Carrie", "Emma"])
+        self.assertEqual([book.isbn for book in self.book_manager.iter_books(sort='author', limit=2)],
+                         ["isbn-3", "isbn-2"])
+
+        with self.assertRaises(ValueError):
+            self.book_manager.iter_books(sort='price')
+        with self.assertRaises(ValueError):
+            self.book_manager.iter_books(sort='title', after="isbn-4")
+
+    def test_filter_offset_and_limit(self):
+        odd = lambda book: int(book.isbn[-1]) % 2 == 1
+        self.assertEqual(self.titles(self.book_manager.iter_books(filter=odd)), ["animal farm", "Emma"])
+        self.assertEqual(self.titles(self.book_manager.iter_books(offset=1, limit=2)), ["animal farm", "Brave New World"])
+        self.assertEqual(self.titles(self.book_manager.iter_books(after="isbn-3")), ["Catch-22"])
+
+    def test_users_sorted_by_name(self):
+        user_manager = UserManager()
+        for user_id, name in (("U3", "carol"), ("U1", "Bob"), ("U2", "alice")):
+            user_manager.add_user(User(name=name, user_id=user_id))
+        self.assertEqual([user.name for user in user_manager.iter_users(sort='name')], ["alice", "Bob", "carol"])
+        user_manager.update_user("U2", name="Zed", new_user_id="U4")
+        page = list(user_manager.iter_users(sort='name', limit=1, after="U1"))
+        self.assertEqual([user.user_id for user in page], ["U3"])
+        self.assertEqual([user.user_id for user in user_manager.iter_users(sort='user_id')], ["U1", "U3", "U4"])
+
+    def test_cli_pages_lazily(self):
+        drawn = []
+
+        def records():
+            for i in range(100):
+                drawn.append(i)
+                yield f"Record {i}"
+
+        output = io.StringIO()
+        with patch('builtins.input', side_effect=['', 'q']) as prompt, contextlib.redirect_stdout(output):
+            self.assertEqual(main.show_pages(records(), "Nothing here.", page_size=10), 20)
+        self.assertEqual(prompt.call_count, 2)
+        self.assertEqual(len(drawn), 21)
+        self.assertNotIn("Record 20", output.getvalue())
+
+    def test_server_pages(self):
+        server = LibraryServer(self.book_manager, UserManager(), None)
+        status, page = server.dispatch('GET', '/books?sort=title&limit=2&after=isbn-2', b'')
+        self.assertEqual((status, [book['title'] for book in page]), (200, ["Catch-22", "Dune"]))
+        self.assertEqual(server.dispatch('GET', '/books?sort=price', b'')[0], 400)
+        self.assertEqual(server.dispatch('GET', '/users?limit=ten', b'')[0], 400)
+
+
+class TestCirculationStats(unittest.TestCase):
+    """
+    Tests for the incrementally maintained circulation statistics.
+
+    Methods:
+        test_totals_follow_every_change: Test that the totals match a fresh count after each kind of change.
+        test_most_borrowed: Test the top titles, authors and borrowers, ties broken by key.
+        test_report_menu: Test the summary in the reports menu.
+        test_popularity_survives_restart: Test that the rankings are rebuilt from the loan history.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+        self.book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935", copies=2))
+        self.book_manager.add_book(Book(title="Animal Farm", author="George Orwell", isbn="978-0451526342"))
+        self.book_manager.add_book(Book(title="The Alchemist", author="Paulo Coelho", isbn="978-0062315007"))
+        for name, user_id in (("Alice Smith", "U1001"), ("Bob Jones", "U1002"), ("Carol White", "U1003")):
+            self.user_manager.add_user(User(name=name, user_id=user_id))
+        self.check_manager = CheckManager(self.book_manager, self.user_manager)
+
+    def assert_consistent(self):
+        fresh = CirculationStats(self.book_manager.books, self.user_manager.users)
+        self.assertEqual(self.check_manager.stats.summary(), fresh.summary())
+
+    def test_totals_follow_every_change(self):
+        stats = self.check_manager.stats
+        self.check_manager.check_out_book("U1001", "978-0451524935")
+        self.check_manager.check_out_book("U1002", "978-0451524935")
+        self.check_manager.check_out_book("U1002", "978-0062315007")
+        self.assertEqual(stats.summary(), {'titles': 3, 'copies': 4, 'checked_out': 3, 'available': 1,
+                                           'users': 3, 'borrowers': 2, 'loans': 3})
+        self.assertEqual(stats.loans_for("U1002"), 2)
+        self.assert_consistent()
+
+        self.check_manager.return_book("U1001", "978-0451524935")
+        self.book_manager.update_book("978-0451526342", copies=3, new_isbn="978-0000000001")
+        self.book_manager.remove_book("978-0000000001")
+        self.user_manager.update_user("U1003", new_user_id="U2003")
+        self.user_manager.remove_user("U2003")
+        self.user_manager.add_user(User(name="Dan Brown", user_id="U1004"))
+        self.assertEqual(stats.summary(), {'titles': 2, 'copies': 3, 'checked_out': 2, 'available': 1,
+                                           'users': 3, 'borrowers': 1, 'loans': 2})
+        self.assert_consistent()
+
+    def test_most_borrowed(self):
+        stats = self.check_manager.stats
+        for user_id, isbn in (("U1001", "978-0451524935"), ("U1002", "978-0451526342"),
+                              ("U1003", "978-0062315007")):
+            self.check_manager.check_out_book(user_id, isbn)
+        self.check_manager.return_book("U1001", "978-0451524935")
+        self.check_manager.check_out_book("U1001", "978-0451524935")
+
+        self.assertEqual(stats.top_titles(2), [("978-0451524935", 2), ("978-0062315007", 1)])
+        self.assertEqual(stats.top_authors(5), [("George Orwell", 3), ("Paulo Coelho", 1)])
+        self.assertEqual(stats.top_borrowers(1), [("U1001", 2)])
+
+    def test_report_menu(self):
+        self.check_manager.check_out_book("U1001", "978-0451524935")
+        output = io.StringIO()
+        with patch('builtins.input', side_effect=['4', '1', '4', '2', '4', '5']), contextlib.redirect_stdout(output):
+            main.main([])
+        self.assertIn("Copies: 4 (1 checked out, 3 available)", output.getvalue())
+        self.assertIn("1. 1984 (ISBN: 978-0451524935) - 1 checkout(s)", output.getvalue())
+
+    def test_popularity_survives_restart(self):
+        for user_id in ("U1001", "U1002", "U1003"):
+            self.check_manager.check_out_book(user_id, "978-0451526342")
+            self.check_manager.return_book(user_id, "978-0451526342")
+        self.check_manager.check_out_book("U1001", "978-0451524935")
+        self.check_manager.check_out_book("U1002", "978-0062315007")
+        self.book_manager.remove_book("978-0062315007")
+
+        stats = CheckManager(BookManager(), UserManager()).stats
+        self.assertEqual(stats.top_titles(3), [("978-0451526342", 3), ("978-0062315007", 1), ("978-0451524935", 1)])
+        self.assertEqual(stats.top_authors(5), [("George Orwell", 4)])
+        self.assertEqual(stats.top_borrowers(3), [("U1001", 2), ("U1002", 2), ("U1003", 1)])
+        self.assertEqual(stats.summary()['loans'], 2)
+
+
+class TestLoanHistory(unittest.TestCase):
+    """
+    Tests for the append-only loan history.
+
+    Methods:
+        test_checkouts_and_returns_are_recorded: Test that loans are kept after they end and across restarts.
+        test_time_range_queries: Test range and per-book queries over several segments and index entries.
+        test_compact_and_expire: Test merging past days into months and deleting old segments.
+        test_compact_empty_segments: Test merging day segments that hold no events.
+        test_history_command: Test the history command of main.py.
+    """
+
+    def setUp(self):
+        self.tmpdir = use_temp_storage(self)
+        self.history = LoanHistory(Storage.HISTORY_DIR)
+
+    def record_days(self, days, per_day=20):
+        # per_day checkouts of alternating books on each day, one minute apart
+        for day in days:
+            for i in range(per_day):
+                self.history.record('checkout', f"isbn-{i % 2}", f"U{i}", time=day + timedelta(minutes=i))
+
+    def test_checkouts_and_returns_are_recorded(self):
+        book_manager = BookManager()
+        user_manager = UserManager()
+        book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        check_manager = CheckManager(book_manager, user_manager)
+        check_manager.check_out_book("U1001", "978-0451524935")
+        check_manager.return_book("U1001", "978-0451524935")
+        check_manager.return_book("U1001", "978-0451524935")  # Refused; not recorded
+
+        history = list(CheckManager(BookManager(), UserManager()).loan_history(user_id="U1001"))
+        self.assertEqual([event['event'] for event in history], ['checkout', 'return'])
+        self.assertEqual(history[0]['isbn'], "978-0451524935")
+        self.assertIn('due', history[0])
+        self.assertEqual(list(check_manager.loan_history(user_id="U2002")), [])
+
+    def test_time_range_queries(self):
+        days = [datetime(2024, 3, 1), datetime(2024, 3, 2), datetime(2024, 3, 5)]
+        with patch('history.INDEX_INTERVAL', 256):
+            self.record_days(days)
+        self.assertEqual(len(self.history.segments()), 3)
+        with open(self.history.segments()[0][0] + '.idx') as f:
+            self.assertGreater(len(f.readlines()), 1)
+
+        start, end = datetime(2024, 3, 2, 0, 10), datetime(2024, 3, 5, 0, 5)
+        events = list(self.history.events(start=start, end=end))
+        self.assertEqual(len(events), 10 + 5)
+        self.assertEqual(events[0]['time'], '2024-03-02T00:10:00')
+        self.assertEqual(events[-1]['time'], '2024-03-05T00:04:00')
+        self.assertEqual(len(self.history.segments(start, end)), 2)
+        self.assertEqual(len(list(self.history.events(isbn="isbn-1"))), 30)
+        self.assertEqual([event['user_id'] for event in self.history.events(user_id="U3", event='checkout')],
+                         ["U3"] * 3)
+
+    def test_compact_and_expire(self):
+        self.record_days([datetime(2024, 1, 30), datetime(2024, 1, 31), datetime(2024, 2, 1)])
+        before = list(self.history.events())
+
+        self.assertEqual(self.history.compact(as_of=datetime(2024, 2, 10)), 2)
+        names = sorted(os.path.basename(path) for path, _, _ in self.history.segments())
+        self.assertEqual(names, ['loans-2024-01.jsonl', 'loans-2024-02-01.jsonl'])
+        self.assertEqual(list(self.history.events()), before)
+        self.assertEqual(len(list(self.history.events(start=datetime(2024, 1, 31), end=datetime(2024, 2, 1)))), 20)
+
+        self.assertEqual(self.history.expire(as_of=datetime(2024, 2, 20), retention_days=19), 1)
+        self.assertEqual(len(list(self.history.events())), 20)
+        self.assertEqual(self.history.expire(as_of=datetime(2024, 2, 20)), 0)  # No retention configured
+
+    def test_compact_empty_segments(self):
+        os.makedirs(Storage.HISTORY_DIR, exist_ok=True)
+        for day in ('2024-01-30', '2024-01-31'):
+            open(os.path.join(Storage.HISTORY_DIR, f"loans-{day}.jsonl"), 'w').close()
+
+        self.assertEqual(self.history.compact(as_of=datetime(2024, 2, 10)), 2)
+        names = sorted(os.listdir(Storage.HISTORY_DIR))
+        self.assertEqual(names, ['loans-2024-01.jsonl', 'loans-2024-01.jsonl.idx'])
+        self.assertEqual(list(self.history.events(start=datetime(2024, 1, 1))), [])
+
+        self.record_days([datetime(2024, 1, 31)], per_day=2)
+        self.assertEqual(self.history.compact(as_of=datetime(2024, 2, 10)), 1)
+        self.assertEqual(len(list(self.history.events(start=datetime(2024, 1, 31)))), 2)
+
+    def test_history_command(self):
+        self.record_days([datetime(2024, 1, 30)], per_day=3)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            main.main(['history', '--user', 'U1', '--since', '2024-01-01'])
+        self.assertEqual(output.getvalue().splitlines(), ["2024-01-30 00:01:00  checkout  ISBN isbn-1  user U1"])
+
+
+class TestIdentifiers(unittest.TestCase):
+    """
+    Tests for ISBN normalization and typo suggestions.
+
+    Methods:
+        test_normalize_isbn: Test hyphen removal, ISBN-10 conversion and checksum validation.
+        test_equivalent_isbns_are_one_book: Test lookups, adds and checkouts with any form of an ISBN.
+        test_suggestions: Test that unknown ISBNs and user IDs are answered with near-matches.
+        test_suggestions_in_menu: Test that the menu suggests near-matches after a failed checkout.
+        test_duplicate_forms_flagged_on_load: Test that books stored under two forms of one ISBN are reported.
+        test_sqlite_matches_without_loading: Test that the SQLite backend matches ISBN forms with an indexed column.
+        test_bad_check_digits_are_reported: Test that every way of adding a book warns about a bad check digit.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+        self.book_manager.add_book(Book(title="The Alchemist", author="Paulo Coelho", isbn="978-0062315007"))
+        self.book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        self.user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+
+    def test_normalize_isbn(self):
+        for isbn in ("978-0062315007", "9780062315007", " 978 0 06 231500 7 ", "0-06-231500-5", "0062315005"):
+            self.assertEqual(normalize_isbn(isbn), "9780062315007")
+        self.assertEqual(normalize_isbn("0-8044-2957-x"), "9780804429573")
+        self.assertEqual(isbn13_to_10("9780804429573"), "080442957X")
+        self.assertEqual(normalize_isbn("978-0062315008"), "9780062315008")  # Bad check digit: hyphens only
+        self.assertEqual(normalize_isbn(" isbn-0 "), "isbn-0")
+        self.assertTrue(is_valid_isbn("0-06-231500-5"))
+        self.assertFalse(is_valid_isbn("0-06-231500-6"))
+        self.assertFalse(is_valid_isbn("978-0062315008"))
+        with self.assertRaises(ValueError):
+            isbn10_to_13("0-06-231500-6")
+
+    def test_equivalent_isbns_are_one_book(self):
+        for isbn in ("9780062315007", "0-06-231500-5", " 978-0062315007"):
+            self.assertEqual(self.book_manager.find_book_by_isbn(isbn).title, "The Alchemist")
+
+        self.assertFalse(self.book_manager.add_book(Book(title="The Alchemist", author="Paulo Coelho", isbn="0062315005")))
+        self.assertEqual([book.isbn for book in self.book_manager.books], ["978-0062315007", "978-0451524935"])
+        added, skipped = self.book_manager.add_books([Book(title="1984", author="George Orwell", isbn="9780451524935")])
+        self.assertEqual((added, skipped), (0, 1))
+        self.assertFalse(self.book_manager.update_book("978-0451524935", new_isbn="0-06-231500-5"))
+
+        check_manager = CheckManager(self.book_manager, self.user_manager, thread_safe=True)
+        self.assertTrue(check_manager.check_out_book("U1001", "9780062315007"))
+        self.assertEqual(check_manager.who_has("0062315005"), {"U1001"})
+        self.assertEqual(self.user_manager.find_user_by_id("U1001").borrowed_books, ["978-0062315007"])
+        self.assertTrue(check_manager.return_book("U1001", "0-06-231500-5"))
+        self.assertEqual(BookManager().find_book_by_isbn("9780062315007").checked_out, 0)
+
+    def test_suggestions(self):
+        self.assertEqual(self.book_manager.suggest_isbns("978-0062315070"), ["978-0062315007"])
+        self.assertEqual(self.book_manager.suggest_isbns("0062315050"), ["978-0062315007"])  # Swapped in the ISBN-10
+        self.assertEqual(self.book_manager.suggest_isbns("978-00623150077"), ["978-0062315007"])
+        self.assertEqual(self.book_manager.suggest_isbns("999-9999999999"), [])
+        self.assertEqual(self.user_manager.suggest_user_ids("u1011"), ["U1001"])
+        self.assertEqual(self.user_manager.suggest_user_ids("U1001"), [])
+
+        check_manager = CheckManager(self.book_manager, self.user_manager)
+        with self.assertLogs('library.check', 'WARNING') as logs:
+            self.assertFalse(check_manager.check_out_book("U1001", "978-0451529435"))
+        self.assertEqual(logs.records[0].fields, {'isbn': "978-0451529435"})
+
+        self.book_manager.remove_book("978-0451524935")
+        self.assertEqual(self.book_manager.suggest_isbns("978-0451529435"), [])
+
+    def test_suggestions_in_menu(self):
+        output = io.StringIO()
+        with patch('builtins.input', side_effect=['3', '2', 'U1001', '978-0451529435', '3', '7']), \
+                contextlib.redirect_stdout(output):
+            main.main([])
+        self.assertIn("No book has ISBN 978-0451529435. Did you mean 978-0451524935?", output.getvalue())
+        self.assertNotIn("No user has ID", output.getvalue())
+
+    def test_duplicate_forms_flagged_on_load(self):
+        self.book_manager._books["0062315005"] = Book(title="The Alchemist", author="Paulo Coelho", isbn="0062315005")
+        self.book_manager.commit({"0062315005": self.book_manager._books["0062315005"]})
+
+        with self.assertLogs('library.book', 'WARNING') as logs:
+            book_manager = BookManager()
+        self.assertEqual(logs.records[0].event, 'book.duplicate_isbn')
+        self.assertEqual(logs.records[0].fields, {'isbn': "0062315005", 'existing': "978-0062315007"})
+        self.assertEqual(book_manager.find_book_by_isbn("9780062315007").isbn, "978-0062315007")
+        book_manager.remove_book("978-0062315007")
+        self.assertEqual(book_manager.find_book_by_isbn("9780062315007").isbn, "0062315005")
+
+    def test_sqlite_matches_without_loading(self):
+        use_temp_storage(self, BACKEND='sqlite')
+        # A database from before the normalized ISBN column, with one book under two forms
+        conn = sqlite3.connect(Storage.DATABASE_FILE)
+        conn.executescript("""
+            CREATE TABLE books (isbn TEXT PRIMARY KEY, title TEXT NOT NULL, author TEXT NOT NULL,
+                                copies INTEGER NOT NULL DEFAULT 1, checked_out INTEGER NOT NULL DEFAULT 0);
+            INSERT INTO books (isbn, title, author) VALUES ('978-0062315007', 'The Alchemist', 'Paulo Coelho');
+            INSERT INTO books (isbn, title, author) VALUES ('0062315005', 'The Alchemist', 'Paulo Coelho');
+            INSERT INTO books (isbn, title, author) VALUES ('978-0451524935', '1984', 'George Orwell');
+        """)
+        conn.commit()
+        conn.close()
+
+        with self.assertLogs('library.book', 'WARNING') as logs:
+            book_manager = BookManager()
+        self.assertEqual(logs.records[0].fields, {'isbn': "0062315005", 'existing': "978-0062315007"})
+        self.assertIs(book_manager._identifiers, Storage.sqlite_store().isbn_index)
+        self.assertEqual(len(book_manager._books._cache), 0)
+
+        self.assertEqual(book_manager.find_book_by_isbn("0-06-231500-5").isbn, "978-0062315007")
+        self.assertEqual(book_manager.suggest_isbns("978-0451529435"), ["978-0451524935"])
+        self.assertFalse(book_manager.add_book(Book(title="1984", author="George Orwell", isbn="9780451524935")))
+        self.assertTrue(book_manager.add_book(Book(title="Emma", author="Jane Austen", isbn="978-0141439587")))
+        self.assertEqual(book_manager.resolve_isbn("9780141439587"), "978-0141439587")
+
+    def test_bad_check_digits_are_reported(self):
+        for add in (lambda book: self.book_manager.add_book(book),
+                    lambda book: self.book_manager.add_books([book]),
+                    lambda book: self.book_manager.update_book("978-0451524935", new_isbn=book.isbn)):
+            with self.subTest(), self.assertLogs('library.book', 'WARNING') as logs:
+                add(Book(title="Emma", author="Jane Austen", isbn="978-0141439588"))
+                self.book_manager.remove_book("978-0141439588")
+            self.assertEqual([record.event for record in logs.records], ['book.invalid_isbn'])
+            self.book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+
+
+class TestConcurrentCheckouts(unittest.TestCase):
+    """
+    Stress tests for checkouts and returns from many threads at once.
+
+    Methods:
+        test_one_winner_per_book: Test that only one of many racing checkouts of a book succeeds.
+        test_random_checkouts_keep_invariant: Test that every checked-out book has exactly one borrower.
+        test_lock_timeout_fails_cleanly: Test that an operation gives up when its book stays locked.
+        test_rewrite_skips_unfinished_changes: Test that a full rewrite never saves a change that is rolled back.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+        with Storage.deferred():
+            for i in range(10):
+                self.book_manager.add_book(Book(title=f"Book {i}", author="Author", isbn=f"978-{i:010d}"))
+            for i in range(8):
+                self.user_manager.add_user(User(name=f"User {i}", user_id=f"U{i}"))
+        self.check_manager = CheckManager(self.book_manager, self.user_manager, thread_safe=True)
+
+    def run_threads(self, calls, workers=8):
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(lambda call: call[0](*call[1:]), calls))
+
+    def assert_consistent(self, books, users):
+        borrowers = {}
+        for user in users:
+            for isbn in user.borrowed_books:
+                self.assertNotIn(isbn, borrowers)
+                borrowers[isbn] = user.user_id
+        for book in books:
+            self.assertEqual(book._is_checked_out, book.isbn in borrowers)
+
+    def test_one_winner_per_book(self):
+        checkout = self.check_manager.check_out_book
+        results = self.run_threads([(checkout, f"U{i}", "978-0000000000") for i in range(8)])
+        self.assertEqual(results.count(True), 1)
+        self.assert_consistent(self.book_manager.books, self.user_manager.users)
+        self.assert_consistent(Storage.load_books(), Storage.load_users())
+        self.assertEqual(len(self.check_manager._locks), 0)
+
+    def test_random_checkouts_keep_invariant(self):
+        for mode in ('full', 'journal'):
+            with self.subTest(mode=mode), patch.object(Storage, 'STORAGE_MODE', mode):
+                rng = random.Random(mode)
+                calls = [(rng.choice([self.check_manager.check_out_book, self.check_manager.return_book]),
+                          f"U{rng.randrange(8)}", f"978-{rng.randrange(10):010d}") for _ in range(300)]
+                self.run_threads(calls)
+                self.assert_consistent(self.book_manager.books, self.user_manager.users)
+                for user in self.user_manager.users:
+                    self.assertEqual(self.check_manager.loans_for(user.user_id), set(user.borrowed_books))
+                self.assert_consistent(Storage.load_books(), Storage.load_users())
+                self.assertEqual(len(self.check_manager._locks), 0)
+
+    def test_lock_timeout_fails_cleanly(self):
+        self.check_manager.lock_timeout = 0.01
+        with self.check_manager._locks.hold([('book', "978-0000000000")]):
+            self.assertFalse(self.run_threads([(self.check_manager.check_out_book, "U0", "978-0000000000")])[0])
+        self.assertFalse(self.book_manager.find_book_by_isbn("978-0000000000")._is_checked_out)
+
+    def test_rewrite_skips_unfinished_changes(self):
+        persist = self.check_manager._persist
+        started, other_done = threading.Event(), threading.Event()
+
+        def failing_persist(book, user, holds_changed=False):
+            if user.user_id != "U1":
+                return persist(book, user, holds_changed)
+            # Changed in memory but not yet saved; give the other checkout a chance to save
+            started.set()
+            other_done.wait(0.3)
+            return False
+
+        def other_checkout():
+            started.wait(5)
+            self.check_manager.check_out_book("U0", "978-0000000000")
+            other_done.set()
+
+        with patch.object(self.check_manager, '_persist', failing_persist):
+            self.run_threads([(self.check_manager.check_out_book, "U1", "978-0000000001"), (other_checkout,)], workers=2)
+
+        saved = {book.isbn: book._is_checked_out for book in Storage.load_books()}
+        self.assertTrue(saved["978-0000000000"])
+        self.assertFalse(saved["978-0000000001"])
+        self.assertEqual(len(self.check_manager._locks), 0)
+
+
+class TestWriteCoalescing(unittest.TestCase):
+    """
+    Tests for the coalesced and on-exit durability levels.
+
+    Methods:
+        test_coalesced_writes_every_n_commits: Test that FLUSH_EVERY commits trigger one write.
+        test_coalesced_writes_after_interval: Test that an old pending change triggers a write.
+        test_on_exit_writes_only_on_flush: Test that on-exit writes on flush() and at exit only.
+        test_failed_write_is_retried: Test that pending changes survive a failed write.
+        test_checkout_is_not_split: Test that a transaction's commits are written together.
+    """
+
+    def setUp(self):
+        use_temp_storage(self, DURABILITY='coalesced', FLUSH_EVERY=3, FLUSH_INTERVAL=60)
+        self.book_manager = BookManager()
+        self.user_manager = UserManager()
+
+    def add_books(self, count, start=0):
+        for i in range(start, start + count):
+            self.book_manager.add_book(Book(title=f"Book {i}", author="Author", isbn=f"978-{i:010d}"))
+
+    def test_coalesced_writes_every_n_commits(self):
+        with patch.object(Storage, 'save_data', wraps=Storage.save_data) as save_data:
+            self.add_books(2)
+            self.assertEqual(save_data.call_count, 0)
+            self.add_books(1, start=2)
+            self.assertEqual(save_data.call_count, 1)
+        self.assertEqual(len(Storage.load_books()), 3)
+        self.assertEqual(Storage._dirty, {})
+
+    def test_coalesced_writes_after_interval(self):
+        self.add_books(1)
+        self.assertFalse(os.path.exists(Storage.BOOKS_FILE))
+        Storage._dirty_since -= 61
+        self.add_books(1, start=1)
+        self.assertEqual(len(Storage.load_books()), 2)
+
+    def test_on_exit_writes_only_on_flush(self):
+        Storage.DURABILITY = 'on-exit'
+        self.add_books(5)
+        self.assertFalse(os.path.exists(Storage.BOOKS_FILE))
+        Storage.flush()
+        self.assertEqual(len(Storage.load_books()), 5)
+
+        self.book_manager.remove_book("978-0000000000")
+        Storage._flush_at_exit()
+        self.assertEqual(len(Storage.load_books()), 4)
+
+    def test_failed_write_is_retried(self):
+        with patch('storage.os.replace', side_effect=OSError("disk full")):
+            self.add_books(3)
+        self.assertEqual(Storage._dirty_count, 3)
+        Storage.flush()
+        self.assertEqual(len(Storage.load_books()), 3)
+
+    def test_checkout_is_not_split(self):
+        Storage.FLUSH_EVERY = 1
+        self.add_books(1)
+        self.user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        check_manager = CheckManager(self.book_manager, self.user_manager)
+        with patch.object(Storage, 'write_prepared', wraps=Storage.write_prepared) as write_prepared:
+            self.assertTrue(check_manager.check_out_book("U1001", "978-0000000000"))
+        self.assertEqual(write_prepared.call_count, 1)
+        self.assertEqual(set(write_prepared.call_args[0][0]), {'books', 'users'})
+        self.assertTrue(Storage.load_books()[0]._is_checked_out)
+
+
+# Saves new data to the path in argv[1], but is killed halfway through writing it
+KILLED_WRITER = """
+import json, os, signal, sys
+from storage import Storage
+
+def dump_and_die(data, f, **kwargs):
+    f.write(json.dumps(data, **kwargs)[:40])
+    f.flush()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+json.dump = dump_and_die
+Storage.LOCK_FILE = sys.argv[1] + '.lock'
+Storage.save_data([{"title": "New", "author": "Nobody", "isbn": "new", "is_checked_out": False}], sys.argv[1])
+"""
+
+
+class TestCrashRecovery(unittest.TestCase):
+    """
+    Tests for crash-safe saves and falling back to the last good backup.
+
+    Methods:
+        test_killed_writer_leaves_old_data: Test that killing the writer mid-save keeps the previous file.
+        test_corrupt_file_falls_back_to_backup: Test that a corrupt file is replaced by its backup.
+        test_corrupt_file_without_backup_is_kept: Test that an unrecoverable file is moved aside.
+    """
+
+    def setUp(self):
+        use_temp_storage(self)
+        self.old = [{"title": "1984", "author": "George Orwell", "isbn": "978-0451524935", "is_checked_out": False}]
+
+    def test_killed_writer_leaves_old_data(self):
+        self.assertTrue(Storage.save_data(self.old, Storage.BOOKS_FILE))
+        writer = subprocess.run([sys.executable, '-c', KILLED_WRITER, Storage.BOOKS_FILE],
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(writer.returncode, -signal.SIGKILL)
+        self.assertTrue(os.path.exists(Storage.BOOKS_FILE + '.tmp'))
+        self.assertEqual(Storage.load_data(Storage.BOOKS_FILE), self.old)
+
+        # The next save still works and the leftover temporary file is reused
+        self.assertTrue(Storage.save_data([], Storage.BOOKS_FILE))
+        self.assertEqual(Storage.load_data(Storage.BOOKS_FILE), [])
+        self.assertEqual(Storage.load_data(Storage.BOOKS_FILE + Storage.BACKUP_SUFFIX), self.old)
+
+    def test_corrupt_file_falls_back_to_backup(self):
+        Storage.save_data(self.old, Storage.BOOKS_FILE)
+        Storage.save_data(self.old + self.old, Storage.BOOKS_FILE)
+        with open(Storage.BOOKS_FILE, 'w') as f:
+            f.write('[{"title": "19')
+
+        self.assertEqual(Storage.load_data(Storage.BOOKS_FILE), self.old)
+        self.assertTrue(os.path.exists(Storage.BOOKS_FILE + '.corrupt'))
+        # The backup was restored, so saving again does not back up the corrupt file
+        self.assertEqual(len(BookManager().books), 1)
+        Storage.save_data([], Storage.BOOKS_FILE)
+        self.assertEqual(Storage.load_data(Storage.BOOKS_FILE + Storage.BACKUP_SUFFIX), self.old)
+
+    def test_corrupt_file_without_backup_is_kept(self):
+        with open(Storage.BOOKS_FILE, 'w') as f:
+            f.write('[{"title": "19')
+
+        self.assertEqual(Storage.load_data(Storage.BOOKS_FILE), [])
+        self.assertFalse(os.path.exists(Storage.BOOKS_FILE))
+        with open(Storage.BOOKS_FILE + '.corrupt') as f:
+            self.assertEqual(f.read(), '[{"title": "19')
+
+
+class TestBinaryFormat(unittest.TestCase):
+    """
+    Tests for the binary record format.
+
+    Methods:
+        test_managers_round_trip_every_codec: Test that books and users survive a save and load in each codec.
+        test_records_span_several_blocks: Test that records are streamed across block boundaries.
+        test_convert_both_ways: Test that the converter turns JSON into records and back.
+        test_truncated_file_falls_back_to_backup: Test that a truncated record file is recovered.
+        test_books_are_merged_while_streaming: Test that loading streams records and restarts on a corrupt block.
+    """
+
+    def setUp(self):
+        self.tmpdir = use_temp_storage(self)
+
+    def test_managers_round_trip_every_codec(self):
+        for suffix in ('.rec', '.rec.zlib', '.rec.xz'):
+            with self.subTest(suffix=suffix), \
+                    patch.object(Storage, 'BOOKS_FILE', os.path.join(self.tmpdir, 'books' + suffix)), \
+                    patch.object(Storage, 'USERS_FILE', os.path.join(self.tmpdir, 'users' + suffix)):
+                book_manager = BookManager()
+                user_manager = UserManager()
+                book_manager.add_book(Book(title="Cien años de soledad", author="García Márquez", isbn="978-0060883287"))
+                user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+                self.assertTrue(CheckManager(book_manager, user_manager).check_out_book("U1001", "978-0060883287"))
+
+                with open(Storage.BOOKS_FILE, 'rb') as f:
+                    self.assertTrue(binary_storage.is_record_file(f))
+                self.assertEqual([book.to_dict() for book in BookManager().books],
+                                 [book.to_dict() for book in book_manager.books])
+                self.assertEqual(UserManager().find_user_by_id("U1001").borrowed_books, ["978-0060883287"])
+
+    def test_records_span_several_blocks(self):
+        records = [{'isbn': str(i), 'title': 'x' * 100} for i in range(5000)]
+        path = os.path.join(self.tmpdir, 'many.rec.zlib')
+        self.assertEqual(binary_storage.save(path, iter(records)), 5000)
+        with open(path, 'rb') as f:
+            self.assertEqual(list(binary_storage.read_records(f)), records)
+
+    def test_convert_both_ways(self):
+        books = [{'title': "1984", 'author': "George Orwell", 'isbn': "978-0451524935", 'is_checked_out': False}]
+        source = os.path.join(self.tmpdir, 'books.json')
+        packed = os.path.join(self.tmpdir, 'books.rec.xz')
+        unpacked = os.path.join(self.tmpdir, 'copy.json')
+        Storage.save_data(books, source)
+
+        binary_storage.main([source, packed])
+        binary_storage.main([packed, unpacked])
+        self.assertEqual(Storage.load_data(packed), books)
+        with open(unpacked) as f:
+            self.assertEqual(json.load(f), books)
+
+    def test_truncated_file_falls_back_to_backup(self):
+        path = os.path.join(self.tmpdir, 'books.rec.zlib')
+        old = [{'isbn': str(i)} for i in range(10)]
+        Storage.save_data(old, path)
+        Storage.save_data(old + old, path)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 5)
+        self.assertEqual(Storage.load_data(path), old)
+
+    def test_books_are_merged_while_streaming(self):
+        path = os.path.join(self.tmpdir, 'books.rec.zlib')
+        old = [{'title': "Book", 'author': "Author", 'isbn': f"isbn-{i % 50}", 'copies': 1} for i in range(100)]
+        with patch.object(binary_storage, 'BLOCK_SIZE', 512):
+            Storage.save_data(old, path)
+            Storage.save_data(old + old, path)
+        consumed = []
+        merged = Storage.load_data(path, lambda records: consumed.append(type(records)) or merge_copies(records))
+        self.assertNotIn(list, consumed)
+        self.assertEqual([book['copies'] for book in merged], [4] * 50)
+
+        # A corrupt final block restarts the merge on the backup, rather than adding to what was read
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 5)
+        with patch.object(Storage, 'BOOKS_FILE', path):
+            self.assertEqual([book.copies for book in BookManager().books], [2] * 50)
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    """
+    Tests for the SQLite storage backend.
+
+    Methods:
+        test_managers_round_trip: Test that manager changes are queried back from the database.
+        test_checkout_records_loan: Test that a checkout is stored as a loan.
+        test_updates_keep_insertion_order: Test that updated books, users and loans keep their place.
+        test_migrate_from_json: Test the one-shot migration from the JSON files.
+    """
+
+    def setUp(self):
+        use_temp_storage(self, BACKEND='sqlite')
+
+    def test_managers_round_trip(self):
+        book_manager = BookManager()
+        book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        book_manager.add_book(Book(title="Dune", author="Frank Herbert", isbn="978-0441172719"))
+        book_manager.update_book("978-0451524935", title="Nineteen Eighty-Four", new_isbn="9780451524935")
+        book_manager.remove_book("978-0441172719")
+        user_manager = UserManager()
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+
+        Storage._sqlite_stores.clear()
+        self.assertEqual([(b.isbn, b.title) for b in BookManager().books], [("9780451524935", "Nineteen Eighty-Four")])
+        self.assertEqual(UserManager().find_user_by_id("U1001").name, "Alice Smith")
+        self.assertIsNone(BookManager().find_book_by_isbn("978-0441172719"))
+
+    def test_checkout_records_loan(self):
+        book_manager = BookManager()
+        user_manager = UserManager()
+        book_manager.add_book(Book(title="1984", author="George Orwell", isbn="978-0451524935"))
+        user_manager.add_user(User(name="Alice Smith", user_id="U1001"))
+        self.assertTrue(CheckManager(book_manager, user_manager).check_out_book("U1001", "978-0451524935"))
+
+        store = Storage.sqlite_store()
+        self.assertEqual(store.borrowers_of("978-0451524935"), ["U1001"])
+        Storage._sqlite_stores.clear()
+        self.assertTrue(BookManager().find_book_by_isbn("978-0451524935")._is_checked_out)
+        self.assertEqual(UserManager().find_user_by_id("U1001").borrowed_books, ["978-0451524935"])
+
+    def test_updates_keep_insertion_order(self):
+        book_manager = BookManager()
+        user_manager = UserManager()
+        for isbn in ("111", "222", "333"):
+            book_manager.add_book(Book(title=f"Book {isbn}", author="Author", isbn=isbn))
+        for user_id in ("U1", "U2"):
+            user_manager.add_user(User(name=f"User {user_id}", user_id=user_id))
+        check_manager = CheckManager(book_manager, user_manager)
+        self.assertTrue(check_manager.check_out_book("U1", "111"))
+        self.assertTrue(check_manager.check_out_book("U1", "222"))
+        user_manager.update_user("U1", name="Renamed")
+        self.assertTrue(check_manager.return_book("U1", "111"))
+        self.assertTrue(check_manager.check_out_book("U1", "333"))
+
+        Storage._sqlite_stores.clear()
+        self.assertEqual([b.isbn for b in BookManager().books], ["111", "222", "333"])
+        self.assertEqual([u.user_id for u in UserManager().users], ["U1", "U2"])
+        self.assertEqual(UserManager().find_user_by_id("U1").borrowed_books, ["222", "333"])
+
+    def test_migrate_from_json(self):
+        Storage.save_books([Book(title="1984", author="George Orwell", isbn="978-0451524935", is_checked_out=True)])
+        Storage.save_users([User(name="Alice Smith", user_id="U1001", borrowed_books=["978-0451524935"])])
+        sqlite_storage.main(['--books', Storage.BOOKS_FILE, '--users', Storage.USERS_FILE,
+                             '--database', Storage.DATABASE_FILE])
+
+        self.assertEqual(len(BookManager().books), 1)
+        self.assertEqual(UserManager().find_user_by_id("U1001").borrowed_books, ["978-0451524935"])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,33 @@
+import itertools
+import metrics
+from events import EventLogger
+from identifiers import IdentifierIndex
+from search import SortedIndex
 from storage import Storage
 
+
+# The orders iter_users can list users in; ties are broken by user ID
+SORT_KEYS = {
+    'name': lambda user: user.name.casefold(),
+    'user_id': lambda user: user.user_id,
+}
+
+log = EventLogger('user')
+
 class UserManager:
     """
     Manage users in the library.
 
     Attributes:
         users (list): A list of users in the library.
+        _users (dict): Primary index mapping user ID to User, in insertion order
+            (an SQLiteTable when the SQLite backend is selected).
+        _sorted (dict): Maps a SORT_KEYS order to its SortedIndex, built on
+            the first listing in that order and kept up to date afterwards.
+        stats (CirculationStats): Statistics kept up to date by every change,
+            once CheckManager has built them; None until then.
+        _identifiers (IdentifierIndex): The user IDs, ignoring case, for
+            suggestions; built on the first one.
 
     Methods:
         add_user: Add a new user to the library.
@@ -13,6 +35,9 @@ class UserManager:
         remove_user: Remove a user from the library.
         update_user: Update the details of an existing user.
         list_users: List all users in the library.
+        iter_users: Yield users one at a time, filtered, sorted and paged.
+        suggest_user_ids: Suggest the user IDs one typo away from one that was not found.
+        commit: Persist changed users.
 
     Examples:
         user_manager = UserManager()
@@ -23,9 +48,21 @@ class UserManager:
     """
 
     def __init__(self):
-        # Load users from storage during initialization
-        self.users = Storage.load_users()
+        # Open the users in storage, indexed by ID
+        self._users = Storage.open_users()
+        self._sorted = {}
+        self.stats = None
+        self._identifiers = None
+
+    @property
+    def users(self):
+        """
+        The users of the library, in insertion order.
+        """
 
+        return list(self._users.values())
+
+    @metrics.timed
     def add_user(self, user):
         """
         Adds a new user to the library.
@@ -38,13 +75,15 @@ class UserManager:
         """
 
         if self.find_user_by_id(user.user_id):
-            print(f"User with ID {user.user_id} already exists.")
+            log.warning('user.exists', "User with ID {user_id} already exists.", user_id=user.user_id)
             return False
-        self.users.append(user)
-        Storage.save_users(self.users)
-        print(f"User '{user.name}' added successfully.")
+        self._users[user.user_id] = user
+        self._index(user)
+        self.commit({user.user_id: user})
+        log.info('user.added', "User '{name}' added successfully.", name=user.name, user_id=user.user_id)
         return True
 
+    @metrics.timed
     def find_user_by_id(self, user_id):
         """
         Find a user by their ID.
@@ -56,11 +95,9 @@ class UserManager:
             Object: The user is returned if found, None otherwise.
         """
 
-        for user in self.users:
-            if user.user_id == user_id:
-                return user
-        return None
+        return self._users.get(user_id)
 
+    @metrics.timed
     def remove_user(self, user_id):
         """
         Remove a user from the existing users.
@@ -74,14 +111,16 @@ class UserManager:
 
         user = self.find_user_by_id(user_id)
         if user:
-            self.users.remove(user)
-            Storage.save_users(self.users)
-            print(f"User '{user.name}' removed successfully.")
+            del self._users[user.user_id]
+            self._unindex(user.user_id)
+            self.commit({user.user_id: None})
+            log.info('user.removed', "User '{name}' removed successfully.", name=user.name, user_id=user.user_id)
             return True
-        print(f"User with ID {user_id} not found.")
+        log.warning('user.not_found', "User with ID {user_id} not found.", user_id=user_id)
         return False
 
 
+    @metrics.timed
     def update_user(self, user_id, name=None, new_user_id=None):
         """
         Update the details of an existing user.
@@ -97,27 +136,141 @@ class UserManager:
 
         user = self.find_user_by_id(user_id)
         if user:
+            if new_user_id and new_user_id != user.user_id and new_user_id in self._users:
+                log.warning('user.exists', "User with ID {user_id} already exists.", user_id=new_user_id)
+                return False
             if name:
                 user.name = name
+            self._unindex(user.user_id)
+            changes = {user.user_id: user}
             if new_user_id:
+                del self._users[user.user_id]
+                changes[user.user_id] = None
                 user.user_id = new_user_id
+                self._users[new_user_id] = user
+                changes[new_user_id] = user
+            self._index(user)
 
-            # Save the updated list of users
-            Storage.save_users(self.users)
-            print(f"User '{user.name}' updated successfully.")
+            # Save the updated users
+            self.commit(changes)
+            log.info('user.updated', "User '{name}' updated successfully.", name=user.name, user_id=user.user_id)
             return True
         else:
-            print(f"User with ID {user_id} not found.")
+            log.warning('user.not_found', "User with ID {user_id} not found.", user_id=user_id)
             return False
     
 
-    def list_users(self):
+    @metrics.timed
+    def list_users(self, sort=None):
         """
         List all users in the library.
+
+        Parameters:
+            sort (str): 'name' or 'user_id'; insertion order if omitted.
         """
         
-        if self.users:
-            for user in self.users:
+        if self._users:
+            for user in self.iter_users(sort=sort):
                 print(user)
         else:
-            print("No users found. Add users to the library.")
\ No newline at end of file
+            print("No users found. Add users to the library.")
+
+
+    def iter_users(self, filter=None, sort=None, offset=0, limit=None, after=None):
+        """
+        Yield users one at a time, so a listing can be shown page by page.
+
+        Sorted orders come from an index kept up to date by every change. To
+        page with a cursor, pass the ID of the last user of one page as after
+        to get the next.
+
+        Parameters:
+            filter (callable): Only yield users for which filter(user) is true (optional).
+            sort (str): 'name' or 'user_id'; insertion order if omitted.
+            offset (int): The number of matching users to skip.
+            limit (int): The maximum number of users to yield (optional).
+            after (str): The cursor: continue right after the user with this ID (optional).
+
+        Returns:
+            iterator: The users.
+
+        Raises:
+            ValueError: If the sort order or the cursor is unknown.
+
+        Examples:
+            page = list(user_manager.iter_users(sort='name', limit=20))
+            page = list(user_manager.iter_users(sort='name', limit=20, after=page[-1].user_id))
+        """
+
+        if sort is not None and sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort order {sort!r}; use one of {', '.join(SORT_KEYS)}.")
+        if after is not None and after not in self._users:
+            raise ValueError(f"Unknown cursor {after!r}.")
+
+        if sort is None:
+            users = iter(self._users.values())
+            if after is not None:
+                # Insertion order has no index to seek in; skip up to the cursor
+                for user in users:
+                    if user.user_id == after:
+                        break
+        else:
+            users = (self._users[user_id] for user_id in self._sorted_index(sort).keys(after))
+        if filter is not None:
+            users = (user for user in users if filter(user))
+        return itertools.islice(users, offset, None if limit is None else offset + limit)
+
+
+    def _sorted_index(self, sort):
+        index = self._sorted.get(sort)
+        if index is None:
+            index = self._sorted[sort] = SortedIndex(SORT_KEYS[sort], ((user.user_id, user) for user in self._users.values()))
+        return index
+
+
+    @metrics.timed
+    def suggest_user_ids(self, user_id, limit=5):
+        """
+        Suggest the user IDs one typo away from one that was not found,
+        ignoring case.
+
+        Parameters:
+            user_id (str): The user ID that was not found.
+            limit (int): The maximum number of suggestions.
+
+        Returns:
+            list: The suggested user IDs.
+        """
+
+        if self._identifiers is None:
+            self._identifiers = IdentifierIndex(lambda key: key.strip().casefold(), self._users.keys())
+        return self._identifiers.suggest(user_id, limit)
+
+
+    def _index(self, user):
+        for index in self._sorted.values():
+            index.add(user.user_id, user)
+        if self._identifiers is not None:
+            self._identifiers.add(user.user_id)
+        if self.stats is not None:
+            self.stats.track_user(user.user_id, user)
+
+
+    def _unindex(self, user_id):
+        for index in self._sorted.values():
+            index.remove(user_id)
+        if self._identifiers is not None:
+            self._identifiers.remove(user_id)
+        if self.stats is not None:
+            self.stats.track_user(user_id, None)
+
+
+    def commit(self, changes):
+        """
+        Persist changed users.
+
+        Parameters:
+            changes (dict): Maps each changed user ID to its User, or to None if removed.
+        """
+
+        Storage.commit_users(self._users.values(), changes)